@@ -1,42 +1,492 @@
 import streamlit as st
 import yaml
 import json
-from datetime import datetime
+import base64
+import math
+from datetime import date, datetime, timedelta
 from typing import List, Dict, Any, Optional, TypedDict
 import mlflow.deployments
 import os
+import re
+import unicodedata
 from databricks import sql
+import sqlite3
 import uuid
+import zlib
+import copy
+import atexit
+import bisect
+import functools
+import hashlib
+import inspect
+import queue
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from types import MappingProxyType
 import pandas as pd
 
 
 # 設定ファイルの読み込み
+CONFIG_PATH = 'config.yaml'
+
+
+def normalize_product_name(name):
+    """Fold width, case, punctuation and spacing so that spelling variants of a product name compare equal"""
+    return " ".join(re.sub(r"[^\w]+", " ", unicodedata.normalize("NFKC", name).casefold()).split())
+
+
+def _trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductIndex:
+    """Type-ahead search over every product in PRODUCTS_BY_CLOUD, including PRODUCT_ALIASES
+
+    Names listed in PRODUCT_ALIASES are folded onto their canonical
+    product, whose ID (the normalized canonical name with hyphens) is what
+    gets recorded. A query is matched by word prefix against every name
+    and alias, and by trigram similarity for misspellings and partial
+    words. Products offered for the cloud and component being edited
+    rank higher.
+    """
+    # 類似度がこれ未満の候補は表示しない
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self, products_by_cloud, aliases):
+        canonical_by_name = {}
+        for canonical, names in aliases.items():
+            for name in [canonical] + list(names):
+                canonical_by_name[normalize_product_name(name)] = canonical
+
+        # 製品ID -> {"id", "name", "names", "locations"}
+        products = {}
+        for cloud, components in products_by_cloud.items():
+            for component, names in components.items():
+                for name in names:
+                    canonical = canonical_by_name.get(normalize_product_name(name), name)
+                    product_id = self.product_id(canonical)
+                    product = products.setdefault(product_id, {"id": product_id, "name": canonical,
+                                                               "names": [canonical], "locations": []})
+                    if name not in product["names"]:
+                        product["names"].append(name)
+                    product["locations"].append((cloud, component))
+        for canonical, names in aliases.items():
+            product = products.get(self.product_id(canonical))
+            if product:
+                product["names"].extend(name for name in names if name not in product["names"])
+        self._products = {product_id: MappingProxyType(dict(product, names=tuple(product["names"]),
+                                                            locations=tuple(product["locations"])))
+                          for product_id, product in products.items()}
+        self._ids_by_name = {normalize_product_name(name): product_id
+                             for product_id, product in self._products.items() for name in product["names"]}
+
+        # 検索キー: (正規化した名前, 製品ID, 表示名)
+        self._keys = [(normalize_product_name(name), product_id, name)
+                      for product_id, product in self._products.items() for name in product["names"]]
+        # 単語の先頭から始まる部分文字列の整列済みリスト（前方一致を二分探索で引く）
+        self._prefixes = sorted(
+            (key[start:], i)
+            for i, (key, _, _) in enumerate(self._keys)
+            for start in [0] + [m.end() for m in re.finditer(" ", key)]
+        )
+        self._postings = {}
+        self._trigram_counts = []
+        for i, (key, _, _) in enumerate(self._keys):
+            trigrams = _trigrams(key)
+            self._trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, []).append(i)
+
+    @staticmethod
+    def product_id(name):
+        return normalize_product_name(name).replace(" ", "-")
+
+    def __len__(self):
+        return len(self._products)
+
+    def get(self, product_id):
+        """The product with this ID, or None"""
+        return self._products.get(product_id)
+
+    def canonical_id(self, name):
+        """The canonical product ID of a product name or alias, or None if it is not in the catalog"""
+        return self._ids_by_name.get(normalize_product_name(name or ""))
+
+    def search(self, query, limit=10, cloud=None, component=None):
+        """Rank products for a partial or misspelled query
+
+        Returns up to limit dicts with id, name, matched (the name or alias
+        that matched) and locations, best first.
+        """
+        query = normalize_product_name(query or "")
+        if not query:
+            return []
+
+        # 製品ID -> (スコア, 一致した名前)
+        best = {}
+
+        def consider(i, score):
+            _, product_id, name = self._keys[i]
+            if score > best.get(product_id, (0, None))[0]:
+                best[product_id] = (score, name)
+
+        start = bisect.bisect_left(self._prefixes, (query,))
+        for suffix, i in islice(self._prefixes, start, None):
+            if not suffix.startswith(query):
+                break
+            # 名前全体の先頭に一致するものを単語の途中からの一致より優先する
+            consider(i, 2.0 if self._keys[i][0].startswith(query) else 1.5)
+
+        query_trigrams = _trigrams(query)
+        shared = Counter(i for trigram in query_trigrams for i in self._postings.get(trigram, ()))
+        for i, count in shared.items():
+            similarity = 2 * count / (len(query_trigrams) + self._trigram_counts[i])
+            if similarity >= self.MIN_SIMILARITY:
+                consider(i, similarity)
+
+        ranked = []
+        for product_id, (score, matched) in best.items():
+            product = self._products[product_id]
+            if (cloud, component) in product["locations"]:
+                score += 0.3
+            elif any(location[0] == cloud for location in product["locations"]):
+                score += 0.1
+            ranked.append((-score, product["name"], {"id": product_id, "name": product["name"], "matched": matched,
+                                                     "locations": product["locations"]}))
+        ranked.sort(key=lambda item: item[:2])
+        return [suggestion for _, _, suggestion in ranked[:limit]]
+
+
+class ConfigCatalog:
+    """Read-only, indexed view of config.yaml
+
+    Built once per version of the file. The option lists stay available
+    through `config`; the lookups used while rendering (products of a
+    cloud component, where a product is offered, components of a persona,
+    questions and contribution points of an issue, category of a
+    component) are precomputed so that each is a single dict access.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.data_stack = MappingProxyType({
+            category: tuple(components) for category, components in config.get("DATA_STACK", {}).items()
+        })
+        # データスタックの定義順に並んだ全コンポーネント
+        self.components = tuple(component for components in self.data_stack.values() for component in components)
+        self._category_by_component = {
+            component: category for category, components in self.data_stack.items() for component in components
+        }
+        self._persona_components = {
+            persona: frozenset(components) for persona, components in config.get("PERSONA_STACK_MAPPING", {}).items()
+        }
+        self._common_issues = {component: tuple(issues) for component, issues in config.get("COMMON_ISSUES", {}).items()}
+
+        self._products = {}
+        product_locations = {}
+        for cloud, components in config.get("PRODUCTS_BY_CLOUD", {}).items():
+            for component, products in components.items():
+                self._products[(cloud, component)] = tuple(products)
+                for product in products:
+                    product_locations.setdefault(product, []).append((cloud, component))
+        self._product_locations = {product: tuple(locations) for product, locations in product_locations.items()}
+        # 別名を含む全製品の検索索引（設定の読み込み時に一度だけ作る）
+        self.product_search = ProductIndex(config.get("PRODUCTS_BY_CLOUD", {}), config.get("PRODUCT_ALIASES", {}))
+
+        self._deepdive_questions = dict(config.get("DEEPDIVE_QUESTIONS", {}))
+        self._contributions = dict(config.get("DATABRICKS_CONTRIBUTIONS", {}))
+        self._issue_questions = dict(config.get("ISSUE_SPECIFIC_QUESTIONS", {}))
+        self._issue_contributions = dict(config.get("ISSUE_SPECIFIC_CONTRIBUTIONS", {}))
+
+    def category_of(self, component):
+        """The DATA_STACK category of a component, or None"""
+        return self._category_by_component.get(component)
+
+    def persona_components(self, persona):
+        """The components highlighted for a persona, as a frozenset"""
+        return self._persona_components.get(persona, frozenset())
+
+    def common_issues(self, component):
+        return self._common_issues.get(component, ())
+
+    def products(self, cloud, component):
+        """The products offered for a component on a cloud, in config order"""
+        return self._products.get((cloud, component), ())
+
+    def product_locations(self, product):
+        """The (cloud, component) pairs offering a product"""
+        return self._product_locations.get(product, ())
+
+    def deepdive_question(self, component, default=None):
+        return self._deepdive_questions.get(component, default)
+
+    def contribution(self, component, default=None):
+        return self._contributions.get(component, default)
+
+    def issue_question(self, issue):
+        return self._issue_questions.get(issue)
+
+    def issue_contribution(self, issue):
+        return self._issue_contributions.get(issue)
+
+
+# 設定ファイルの検証ルール（型は値の形、[t] は t のリスト、{str: t} はキーが文字列で値が t の辞書）
+CONFIG_SCHEMA = {
+    "STORAGE": dict,
+    "DELTA_TABLE": dict,
+    "PERSONA_OPTIONS": [str],
+    "INTEREST_OPTIONS": [str],
+    "NEXT_ACTION_OPTIONS": [str],
+    "CLOUD_OPTIONS": [str],
+    "DATA_STACK": {str: [str]},
+    "PERSONA_STACK_MAPPING": {str: [str]},
+    "COMMON_ISSUES": {str: [str]},
+    "PRODUCTS_BY_CLOUD": {str: {str: [str]}},
+    "DATABRICKS_CONTRIBUTIONS": {str: str},
+    "DEEPDIVE_QUESTIONS": {str: str},
+    "ISSUE_SPECIFIC_QUESTIONS": {str: str},
+    "ISSUE_SPECIFIC_CONTRIBUTIONS": {str: str},
+    "PRODUCT_ALIASES": {str: [str]}
+}
+
+# 検証済みの設定を高速に読み込むためのスナップショット（python cli.py build-config で作成する）
+# マジック + バージョン + 元のYAMLのSHA-256 + ペイロード
+CONFIG_SNAPSHOT_PATH = 'config.snapshot'
+CONFIG_SNAPSHOT_MAGIC = b"DDC"
+CONFIG_SNAPSHOT_VERSION = 1
+CONFIG_SNAPSHOT_DECODERS = {
+    1: lambda payload: json.loads(payload.decode("utf-8")),
+}
+CONFIG_RELOAD_INTERVAL_SECONDS = 2
+
+
+class ConfigError(ValueError):
+    """config.yaml does not match CONFIG_SCHEMA"""
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def _check_schema(value, spec, path, problems):
+    if isinstance(spec, list):
+        if not isinstance(value, list):
+            problems.append(f"{path}: リストである必要があります")
+            return
+        for i, item in enumerate(value):
+            _check_schema(item, spec[0], f"{path}[{i}]", problems)
+    elif isinstance(spec, dict):
+        if not isinstance(value, dict):
+            problems.append(f"{path}: 辞書である必要があります")
+            return
+        ((_, value_spec),) = spec.items()
+        for key, item in value.items():
+            if not isinstance(key, str):
+                problems.append(f"{path}: キー {key!r} は文字列である必要があります")
+            _check_schema(item, value_spec, f"{path}.{key}", problems)
+    elif not isinstance(value, spec):
+        problems.append(f"{path}: {spec.__name__} である必要があります")
+
+
+def validate_config(config):
+    """Check a parsed config against CONFIG_SCHEMA and its cross references; returns a list of problems"""
+    if not isinstance(config, dict):
+        return ["設定全体が辞書になっていません"]
+    problems = []
+    for key, spec in CONFIG_SCHEMA.items():
+        if key not in config:
+            problems.append(f"{key}: 必須の項目がありません")
+        else:
+            _check_schema(config[key], spec, key, problems)
+    if problems:
+        return problems
+
+    # 他の項目から参照される名前が定義済みかを確かめる（打ち間違いで選択肢が黙って消えるのを防ぐ）
+    components = {component for components in config["DATA_STACK"].values() for component in components}
+    references = [
+        ("PERSONA_STACK_MAPPING", config["PERSONA_STACK_MAPPING"].keys(), set(config["PERSONA_OPTIONS"]), "PERSONA_OPTIONS"),
+        ("PRODUCTS_BY_CLOUD", config["PRODUCTS_BY_CLOUD"].keys(), set(config["CLOUD_OPTIONS"]), "CLOUD_OPTIONS"),
+        ("PERSONA_STACK_MAPPING", [c for cs in config["PERSONA_STACK_MAPPING"].values() for c in cs], components, "DATA_STACK"),
+        ("PRODUCTS_BY_CLOUD", [c for cs in config["PRODUCTS_BY_CLOUD"].values() for c in cs], components, "DATA_STACK"),
+        ("COMMON_ISSUES", config["COMMON_ISSUES"].keys(), components, "DATA_STACK"),
+        ("DEEPDIVE_QUESTIONS", config["DEEPDIVE_QUESTIONS"].keys(), components, "DATA_STACK"),
+        ("DATABRICKS_CONTRIBUTIONS", config["DATABRICKS_CONTRIBUTIONS"].keys(), components, "DATA_STACK"),
+    ]
+    for key, names, defined, source in references:
+        for name in dict.fromkeys(names):
+            if name not in defined:
+                problems.append(f"{key}: {name!r} は {source} に定義されていません")
+
+    # 同じ表記が複数の製品の別名になっていると、どの製品として記録するか決まらない
+    canonical_by_name = {}
+    for canonical, aliases in config["PRODUCT_ALIASES"].items():
+        for name in [canonical] + aliases:
+            normalized = normalize_product_name(name)
+            if canonical_by_name.setdefault(normalized, canonical) != canonical:
+                problems.append(f"PRODUCT_ALIASES: {name!r} が {canonical_by_name[normalized]!r} と {canonical!r} の両方に含まれています")
+    return problems
+
+
+def encode_config_snapshot(config, digest):
+    """Encode a validated config and the SHA-256 of the YAML it was parsed from"""
+    payload = json.dumps(config, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return CONFIG_SNAPSHOT_MAGIC + bytes([CONFIG_SNAPSHOT_VERSION]) + digest + payload
+
+
+def decode_config_snapshot(data, digest=None):
+    """Decode a snapshot; returns None if it is unreadable or, when digest is given, built from another file"""
+    header = len(CONFIG_SNAPSHOT_MAGIC) + 1
+    if not data.startswith(CONFIG_SNAPSHOT_MAGIC) or len(data) < header + 32:
+        return None
+    version = data[len(CONFIG_SNAPSHOT_MAGIC)]
+    if version not in CONFIG_SNAPSHOT_DECODERS:
+        return None
+    if digest is not None and data[header:header + 32] != digest:
+        return None
+    return CONFIG_SNAPSHOT_DECODERS[version](data[header + 32:])
+
+
+def _read_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def build_config_snapshot(path=CONFIG_PATH, snapshot_path=CONFIG_SNAPSHOT_PATH):
+    """Validate the config file and write its snapshot; returns the config, raising ConfigError if invalid"""
+    with open(path, 'rb') as file:
+        source = file.read()
+    config = yaml.safe_load(source)
+    problems = validate_config(config)
+    if problems:
+        raise ConfigError(problems)
+    data = encode_config_snapshot(config, hashlib.sha256(source).digest())
+    # 読み込み中のプロセスが書きかけのファイルを見ないよう、別名で書いてから置き換える
+    temporary_path = f"{snapshot_path}.tmp"
+    with open(temporary_path, 'wb') as file:
+        file.write(data)
+    os.replace(temporary_path, snapshot_path)
+    return config
+
+
+def read_config(path=CONFIG_PATH, snapshot_path=CONFIG_SNAPSHOT_PATH):
+    """Load the config, from the snapshot if it was built from the current file; returns (config, source)"""
+    with open(path, 'rb') as file:
+        source = file.read()
+    snapshot = _read_snapshot(snapshot_path)
+    if snapshot is not None:
+        config = decode_config_snapshot(snapshot, hashlib.sha256(source).digest())
+        if config is not None:
+            return config, "snapshot"
+
+    # スナップショットがない・古い場合だけYAMLを解析する
+    config = yaml.safe_load(source)
+    problems = validate_config(config)
+    if problems:
+        raise ConfigError(problems)
+    return config, "yaml"
+
+
+class ConfigWatcher:
+    """Hold the current ConfigCatalog and reload it in the background when the config file changes
+
+    An edit that fails to load or validate is reported through `error`
+    while the last valid catalog stays in use. If the file is invalid at
+    start-up, the last built snapshot is used regardless of its hash,
+    and if that cannot be used either, catalog stays None so that
+    load_config falls back to its defaults.
+    """
+
+    def __init__(self, path, snapshot_path, interval=CONFIG_RELOAD_INTERVAL_SECONDS):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.catalog = None
+        self.source = None
+        self.error = None
+        self._signature = self._stat()
+        try:
+            self._load()
+        except Exception as e:
+            self.error = e
+            try:
+                snapshot = _read_snapshot(snapshot_path)
+                config = decode_config_snapshot(snapshot) if snapshot is not None else None
+                if config is not None:
+                    self.catalog = ConfigCatalog(config)
+                    self.source = "snapshot (stale)"
+            except Exception:
+                # スナップショットも壊れている場合は catalog を None のままにし、load_config のデフォルト設定を使う
+                self.catalog = None
+                self.source = None
+        threading.Thread(target=self._run, name="config-watcher", daemon=True).start()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        config, source = read_config(self.path, self.snapshot_path)
+        # 参照の差し替えだけなので、描画中のセッションは古いカタログか新しいカタログのどちらかを一貫して見る
+        self.catalog = ConfigCatalog(config)
+        self.source = source
+        self.error = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            signature = self._stat()
+            if signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                self._load()
+            except Exception as e:
+                self.error = e
+
+
+@st.cache_resource(show_spinner=False)
+def get_config_watcher(path, snapshot_path):
+    """Load the config once per process and keep it current as the file changes"""
+    return ConfigWatcher(path, snapshot_path)
+
+
 def load_config():
     """YAMLファイルから設定を読み込む"""
-    try:
-        with open('config.yaml', 'r', encoding='utf-8') as file:
-            config = yaml.safe_load(file)
-        return config
-    except Exception as e:
-        st.error(f"設定ファイルの読み込みエラー: {e}")
-        # デフォルト値を返す（実際はもっと簡略化されたバージョン）
-        return {
-            "PERSONA_OPTIONS": ["データエンジニア", "データサイエンティスト"],
-            "INTEREST_OPTIONS": ["データガバナンス", "生成AI"],
-            "NEXT_ACTION_OPTIONS": ["詳細製品説明", "製品デモ"],
-            "CLOUD_OPTIONS": ["AWS", "Azure", "GCP", "オンプレミス"],
-            "DATA_STACK": {"データエンジニアリング": ["ジョブ管理", "データ取り込み"]},
-            "PERSONA_STACK_MAPPING": {"データエンジニア": ["ジョブ管理"]},
-            "COMMON_ISSUES": {"ジョブ管理": ["スケジューリングが複雑"]},
-            "PRODUCTS_BY_CLOUD": {"AWS": {"ジョブ管理": ["AWS Step Functions"]}},
-            "DATABRICKS_CONTRIBUTIONS": {},
-            "DEEPDIVE_QUESTIONS": {},
-            "ISSUE_SPECIFIC_QUESTIONS": {},
-            "ISSUE_SPECIFIC_CONTRIBUTIONS": {}
-        }
+    # 再実行のたびにYAMLを解析せず、プロセス内で共有するカタログを使う（ファイルの変更は監視スレッドが反映する）
+    catalog = get_config_watcher(CONFIG_PATH, CONFIG_SNAPSHOT_PATH).catalog
+    if catalog is not None:
+        return catalog
+    # デフォルト値を返す（実際はもっと簡略化されたバージョン）
+    return ConfigCatalog({
+        "PERSONA_OPTIONS": ["データエンジニア", "データサイエンティスト"],
+        "INTEREST_OPTIONS": ["データガバナンス", "生成AI"],
+        "NEXT_ACTION_OPTIONS": ["詳細製品説明", "製品デモ"],
+        "CLOUD_OPTIONS": ["AWS", "Azure", "GCP", "オンプレミス"],
+        "DATA_STACK": {"データエンジニアリング": ["ジョブ管理", "データ取り込み"]},
+        "PERSONA_STACK_MAPPING": {"データエンジニア": ["ジョブ管理"]},
+        "COMMON_ISSUES": {"ジョブ管理": ["スケジューリングが複雑"]},
+        "PRODUCTS_BY_CLOUD": {"AWS": {"ジョブ管理": ["AWS Step Functions"]}},
+        "DATABRICKS_CONTRIBUTIONS": {},
+        "DEEPDIVE_QUESTIONS": {},
+        "ISSUE_SPECIFIC_QUESTIONS": {},
+        "ISSUE_SPECIFIC_CONTRIBUTIONS": {}
+    })
 
-# 設定の読み込み
-CONFIG = load_config()
+# 設定の読み込み（CONFIG はプロセス内で共有されるため変更しないこと）
+CATALOG = load_config()
+CONFIG = CATALOG.config
 
 # Constants from config
 PERSONA_OPTIONS = CONFIG["PERSONA_OPTIONS"]
@@ -83,40 +533,158 @@ def load_css():
 # CSSを読み込む
 load_css()
 
+def new_state():
+    """Build the state of a new engagement"""
+    return {
+        "customer_info": {},
+        "platform_data": {
+            "AWS": [],
+            "Azure": [],
+            "GCP": [],
+            "オンプレミス": []
+        },
+        "project_data": {},
+        "next_actions": [],
+        "current_step": "customer_info",
+        "current_cloud": "AWS",
+        "event_seq": 0
+    }
+
+
+# 各イベントが書き換える状態のセクション（画面遷移だけのイベントは含めない）
+EVENT_SECTIONS = {
+    "update_customer_info": "customer_info",
+    "update_platform_data": "platform_data",
+    "update_project_data": "project_data",
+    "update_next_actions": "next_actions",
+}
+
+
+def apply_state_event(state, event_type, payload):
+    """Apply one recorded StateManager mutation to a state dict"""
+    payload = copy.deepcopy(payload)
+    if event_type == "update_customer_info":
+        state["customer_info"] = payload["customer_info"]
+        state["current_step"] = "platform_discovery"
+    elif event_type == "update_platform_data":
+        state["platform_data"][payload["cloud"]] = payload["platform_data"]
+        state["current_cloud"] = payload["cloud"]
+        state["current_step"] = "platform_discovery"
+    elif event_type == "move_to_project_data":
+        state["current_step"] = "project_data"
+    elif event_type == "update_project_data":
+        state["project_data"] = payload["project_data"]
+        state["current_step"] = "next_actions"
+    elif event_type == "update_next_actions":
+        state["next_actions"] = payload["next_actions"]
+        state["current_step"] = "summary"
+    else:
+        raise ValueError(f"未知の状態イベントです: {event_type}")
+    return state
+
+
+def state_fields(state):
+    """Flatten the editable parts of a state into {field path: value}
+
+    Customer and project details are split per item, platform data per
+    (cloud, component) and the next actions are a single field.
+    """
+    fields = {}
+    for key, value in state.get("customer_info", {}).items():
+        fields[("customer_info", key)] = value
+    for cloud, items in state.get("platform_data", {}).items():
+        for item in items:
+            fields[("platform_data", cloud, item.get("component"))] = item
+    for key, value in state.get("project_data", {}).items():
+        fields[("project_data", key)] = value
+    fields[("next_actions",)] = state.get("next_actions", [])
+    return fields
+
+
+def three_way_merge(base, mine, theirs):
+    """Merge two states edited from the same base, field by field
+
+    A field changed on only one side takes that side's value. Returns
+    (merged fields, conflicting paths); a conflicting field keeps theirs
+    until resolved, and a field missing from the merge was deleted.
+    """
+    missing = object()
+    base_fields, my_fields, their_fields = state_fields(base), state_fields(mine), state_fields(theirs)
+    merged, conflicts = {}, []
+    # 並び順は相手側の状態に揃え、自分だけが追加した項目を後ろに付ける
+    for path in dict.fromkeys([*their_fields, *my_fields, *base_fields]):
+        base_value = base_fields.get(path, missing)
+        my_value = my_fields.get(path, missing)
+        their_value = their_fields.get(path, missing)
+        if my_value == their_value or my_value == base_value:
+            value = their_value
+        elif their_value == base_value:
+            value = my_value
+        else:
+            conflicts.append(path)
+            value = their_value
+        if value is not missing:
+            merged[path] = value
+    return merged, conflicts
+
+
+def state_from_fields(template, fields):
+    """Build a state from template with its editable parts replaced by fields"""
+    state = copy.deepcopy(template)
+    state["customer_info"] = {}
+    state["project_data"] = {}
+    state["platform_data"] = {cloud: [] for cloud in template.get("platform_data", {})}
+    state["next_actions"] = []
+    for path, value in fields.items():
+        if path[0] == "platform_data":
+            state["platform_data"].setdefault(path[1], []).append(copy.deepcopy(value))
+        elif path[0] == "next_actions":
+            state["next_actions"] = copy.deepcopy(value)
+        else:
+            state[path[0]][path[1]] = copy.deepcopy(value)
+    return state
+
 # Simple State Manager class
 class StateManager:
     def __init__(self):
         self.state = None
+        self.pending_events = []
+        # 同じ履歴を別のセッションでも編集している場合に、保存を区別するためのID
+        self.writer_id = str(uuid.uuid4())
         self.initialize()
         
     def initialize(self):
         """Initialize a new state"""
         # Create default state
-        self.state = {
-            "customer_info": {},
-            "platform_data": {
-                "AWS": [],
-                "Azure": [],
-                "GCP": [],
-                "オンプレミス": []
-            },
-            "project_data": {},
-            "next_actions": [],
-            "current_step": "customer_info",
-            "current_cloud": "AWS"
-        }
+        self.state = new_state()
+        self.pending_events = []
         return self.state["current_step"]
     
+    def _record(self, event_type, payload):
+        """Apply a mutation to the state and record it as an event for the next save"""
+        payload = copy.deepcopy(payload)
+        apply_state_event(self.state, event_type, payload)
+        self.state["event_seq"] = self.state.get("event_seq", 0) + 1
+        self.pending_events.append({
+            "seq": self.state["event_seq"],
+            "type": event_type,
+            "payload": payload,
+            "created_at": datetime.now().isoformat()
+        })
+        return self.state["current_step"]
+    
+    def drain_events(self):
+        """Take the events recorded since the last call"""
+        events, self.pending_events = self.pending_events, []
+        return events
+    
     def update_customer_info(self, customer_info):
         """Update customer basic information"""
         if not isinstance(customer_info, dict):
             print("Error: customer_info is not a dictionary")
             return self.state["current_step"]
             
-        self.state["customer_info"] = customer_info.copy()
-        self.state["current_step"] = "platform_discovery"
-        
-        return self.state["current_step"]
+        return self._record("update_customer_info", {"customer_info": customer_info})
     
     def update_platform_data(self, platform_data, cloud):
         """Update platform data for a specific cloud"""
@@ -124,41 +692,48 @@ class StateManager:
             print("Error: platform_data is not a list")
             return self.state["current_step"]
             
-        self.state["platform_data"][cloud] = platform_data.copy()
-        self.state["current_cloud"] = cloud
-        self.state["current_step"] = "platform_discovery"
-            
-        return self.state["current_step"]
+        return self._record("update_platform_data", {"cloud": cloud, "platform_data": platform_data})
     
     def move_to_project_data(self):
         """Move to project data step"""
-        self.state["current_step"] = "project_data"
-        return self.state["current_step"]
+        return self._record("move_to_project_data", {})
     
     def update_project_data(self, project_data):
         """Update project data information"""
-        self.state["project_data"] = project_data
-        self.state["current_step"] = "next_actions"
-        return self.state["current_step"]
+        return self._record("update_project_data", {"project_data": project_data})
     
     def update_next_actions(self, next_actions):
         """Update next actions"""
-        self.state["next_actions"] = next_actions
-        self.state["current_step"] = "summary"
-        return self.state["current_step"]
+        return self._record("update_next_actions", {"next_actions": next_actions})
     
     # StateManager クラスに以下のメソッドを追加
     def get_state(self):
         """Get the current state"""
         return self.state
 
-    def set_state(self, new_state):
+    def set_state(self, state):
         """Set entire state from external source"""
-        if not isinstance(new_state, dict):
-            print("Error: new_state is not a dictionary")
+        if not isinstance(state, dict):
+            print("Error: state is not a dictionary")
             return self.state["current_step"]
             
-        self.state = new_state.copy()
+        self.state = state.copy()
+        # 読み込んだ状態は保存済みのため、未保存イベントは破棄する
+        self.pending_events = []
+        return self.state["current_step"]
+
+    def rebase(self, latest, merged):
+        """Replace the state with the latest saved one and record merged's differences as new events"""
+        self.set_state(latest)
+        if merged["customer_info"] != latest["customer_info"]:
+            self.update_customer_info(merged["customer_info"])
+        for cloud, items in merged["platform_data"].items():
+            if items != latest["platform_data"].get(cloud, []):
+                self.update_platform_data(items, cloud)
+        if merged["project_data"] != latest["project_data"]:
+            self.update_project_data(merged["project_data"])
+        if merged["next_actions"] != latest["next_actions"]:
+            self.update_next_actions(merged["next_actions"])
         return self.state["current_step"]
 
     def get_id(self):
@@ -170,181 +745,3044 @@ class StateManager:
         self.state["id"] = state_id
         return state_id
 
-# DeltaTableManager クラスを追加
-class DeltaTableManager:
-    def __init__(self, config):
-        """Initialize the DeltaTableManager"""
-        self.config = config
-        self.catalog = os.environ.get("CATALOG_NAME", config["DELTA_TABLE"]["DEFAULT_CATALOG"])
-        self.schema = os.environ.get("SCHEMA_NAME", config["DELTA_TABLE"]["DEFAULT_SCHEMA"])
-        self.table_name = config["DELTA_TABLE"]["TABLE_NAME"]
-        self.full_table_name = f"{self.catalog}.{self.schema}.{self.table_name}"
-        self._init_connection()
-        self._ensure_table_exists()
-        
-    def _init_connection(self):
-        """Initialize connection to Databricks SQL"""
+class PoolExhausted(Exception):
+    """Raised when every pooled connection stays checked out for the whole checkout timeout
+
+    Not a TimeoutError: the warehouse itself may be healthy, so this is
+    kept out of the transient errors that feed the circuit breaker.
+    """
+
+
+# Databricks SQL コネクションプール
+class ConnectionPool:
+    """Thread-safe pool of Databricks SQL connections shared across reruns and sessions"""
+
+    def __init__(self, connect, size=4, idle_timeout=600, health_check_interval=60, checkout_timeout=30):
+        self._connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        # (connection, last_used) のリスト。末尾が最も最近使われた接続
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def checkout(self):
+        """Take a healthy connection from the pool, opening a new one if needed"""
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolExhausted(f"コネクションプールから接続を取得できませんでした (size={self.size})")
+
         try:
-            # 環境変数から接続情報を取得
-            server_hostname = os.environ.get("DATABRICKS_SERVER_HOSTNAME")
-            http_path = os.environ.get("DATABRICKS_HTTP_PATH")
-            access_token = os.environ.get("DATABRICKS_TOKEN")
-            
-            if not server_hostname or not http_path:
-                st.warning("Databricks接続情報が設定されていません。履歴機能は無効です。")
-                self.connection = None
+            self._evict_idle()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, last_used = self._idle.pop()
+
+                # 直近に使われた接続はヘルスチェックを省略する
+                if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(connection):
+                    return connection
+                self._close(connection)
+
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, connection):
+        """Return a connection to the pool"""
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+        self._slots.release()
+
+    def discard(self, connection):
+        """Close a broken connection so that the next checkout reconnects"""
+        self._close(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block"""
+        connection = self.checkout()
+        try:
+            yield connection
+        except sql.exc.ServerOperationError:
+            # ステートメント自体の失敗ではセッションは壊れていないため再利用する
+            self.checkin(connection)
+            raise
+        except Exception:
+            self.discard(connection)
+            raise
+        else:
+            self.checkin(connection)
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _evict_idle(self):
+        """Close connections that have been idle longer than idle_timeout"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [c for c, last_used in self._idle if now - last_used >= self.idle_timeout]
+            self._idle = [(c, last_used) for c, last_used in self._idle if now - last_used < self.idle_timeout]
+        for connection in expired:
+            self._close(connection)
+
+    @staticmethod
+    def _is_healthy(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+@st.cache_resource(show_spinner=False)
+def get_connection_pool(server_hostname, http_path, access_token, size, idle_timeout, health_check_interval, checkout_timeout,
+                        connect_timeout=900):
+    """Get the process-wide connection pool for the given warehouse"""
+    def connect():
+        return sql.connect(
+            server_hostname=server_hostname,
+            http_path=http_path,
+            access_token=access_token,
+            # ドライバ内部の再試行（既定では最大15分）で画面が固まらないよう上限を設ける
+            _retry_stop_after_attempts_duration=connect_timeout
+        )
+
+    return ConnectionPool(
+        connect,
+        size=size,
+        idle_timeout=idle_timeout,
+        health_check_interval=health_check_interval,
+        checkout_timeout=checkout_timeout
+    )
+
+def backoff_delay(attempt, base_delay, max_delay=None):
+    """Exponential backoff with full jitter for the given 0-based attempt"""
+    delay = base_delay * (2 ** attempt)
+    if max_delay is not None:
+        delay = min(delay, max_delay)
+    # 複数のセッションが同時に再試行して負荷が集中しないよう、待ち時間を0〜上限で散らす
+    return random.uniform(0, delay)
+
+
+# 再試行や回路遮断の対象とする一時的な障害（SQLの誤りなど、再試行しても結果が変わらないものは含めない）
+TRANSIENT_ERRORS = (sql.exc.OperationalError, TimeoutError, ConnectionError)
+
+
+class WarehouseUnavailable(Exception):
+    """Raised without contacting the warehouse while its circuit breaker is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"SQL Warehouseが応答しないため接続を停止しています（約{retry_after:.0f}秒後に再確認します）")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency keeps failing, and probe it in the background until it recovers
+
+    After failure_threshold consecutive failures the breaker opens:
+    allow() returns False and a daemon thread calls probe every
+    probe_interval seconds, closing the breaker on the first success.
+    """
+
+    def __init__(self, probe, failure_threshold=3, probe_interval=15):
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self._failures = 0
+        self._opened_at = None
+        self._next_probe_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """Whether calls may go to the dependency"""
+        return not self.is_open
+
+    def retry_after(self):
+        """Seconds until the next background probe, or 0 when closed"""
+        with self._lock:
+            if self._next_probe_at is None:
+                return 0
+            return max(0, self._next_probe_at - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.failure_threshold:
                 return
-                
-            self.connection = sql.connect(
-                server_hostname=server_hostname,
-                http_path=http_path,
-                access_token=access_token
-            )
-        except Exception as e:
-            st.error(f"Delta Tableへの接続エラー: {e}")
-            self.connection = None
-    
-    def _ensure_table_exists(self):
-        """Ensure that the history table exists"""
-        if not self.connection:
+        self.trip()
+
+    def trip(self):
+        """Open the breaker immediately and start probing"""
+        with self._lock:
+            if self._opened_at is not None:
+                return
+            self._opened_at = time.monotonic()
+            self._next_probe_at = self._opened_at + self.probe_interval
+        threading.Thread(target=self._run_probe, name="circuit-probe", daemon=True).start()
+
+    def _run_probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self._probe()
+            except Exception:
+                with self._lock:
+                    self._next_probe_at = time.monotonic() + self.probe_interval
+                continue
+            with self._lock:
+                self._opened_at = None
+                self._next_probe_at = None
+                self._failures = 0
             return
-            
+
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breaker(_pool, server_hostname, http_path, failure_threshold, probe_interval):
+    """Get the process-wide circuit breaker for the given warehouse"""
+    def probe():
+        with _pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+
+    return CircuitBreaker(probe, failure_threshold=failure_threshold, probe_interval=probe_interval)
+
+
+def statement_kind(operation):
+    """Classify a SQL statement as "read", "write" or "maintenance" by its first keyword"""
+    keyword = operation.lstrip().split(None, 1)[0].upper() if operation.strip() else ""
+    if keyword in ("SELECT", "WITH", "DESCRIBE", "SHOW"):
+        return "read"
+    if keyword in ("OPTIMIZE", "VACUUM", "REORG", "ANALYZE"):
+        return "maintenance"
+    return "write"
+
+
+class WarehouseCursor:
+    """Cursor over a pooled connection with per-statement timeouts, read retries and circuit breaking
+
+    Statements are cancelled after the timeout of their kind (None means
+    no timeout). Reads that fail with a transient error are retried on a
+    fresh connection with jittered exponential backoff; writes are not,
+    because Delta commits each statement separately and whole saves are
+    retried by the save queue instead. Every transient failure is
+    reported to the breaker, and nothing is sent while it is open.
+    PoolExhausted is not counted, since waiting for a pooled connection
+    says nothing about the warehouse.
+    """
+
+    def __init__(self, pool, breaker, timeouts, read_retries=2, retry_base_delay=0.5, retry_max_delay=5):
+        self._pool = pool
+        self._breaker = breaker
+        self._timeouts = timeouts
+        self._read_retries = read_retries
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+        self._connection = None
+        self._cursor = None
+        # 直前のステートメントで再試行した回数
+        self.retries = 0
+
+    def execute(self, operation, parameters=None):
+        kind = statement_kind(operation)
+        attempts = self._read_retries + 1 if kind == "read" else 1
+        for attempt in range(attempts):
+            self.retries = attempt
+            if not self._breaker.allow():
+                raise WarehouseUnavailable(self._breaker.retry_after())
+            try:
+                if self._cursor is None:
+                    self._connection = self._pool.checkout()
+                    self._cursor = self._connection.cursor()
+                self._execute_with_timeout(operation, parameters, self._timeouts.get(kind))
+                self._breaker.record_success()
+                return
+            except TRANSIENT_ERRORS:
+                self.close(broken=True)
+                self._breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(backoff_delay(attempt, self._retry_base_delay, self._retry_max_delay))
+
+    def _execute_with_timeout(self, operation, parameters, timeout):
+        if timeout is None:
+            self._cursor.execute(operation, parameters)
+            return
+
+        timed_out = threading.Event()
+        cursor = self._cursor
+
+        def cancel():
+            timed_out.set()
+            cursor.cancel()
+
+        timer = threading.Timer(timeout, cancel)
+        timer.daemon = True
+        timer.start()
         try:
-            with self.connection.cursor() as cursor:
-                # Check if table exists
-                cursor.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {self.full_table_name} (
-                        id STRING,
-                        company STRING, 
-                        record_date TIMESTAMP,
-                        recorder STRING,
-                        state_json STRING
-                    )
-                    USING DELTA
-                """)
+            cursor.execute(operation, parameters)
         except Exception as e:
-            st.error(f"Delta Table作成エラー: {e}")
-    
-    def save_state(self, state):
-        """Save state to Delta table"""
-        if not self.connection:
-            return None
-            
+            if timed_out.is_set():
+                raise TimeoutError(f"SQLの実行が{timeout}秒以内に終わりませんでした") from e
+            raise
+        finally:
+            timer.cancel()
+
+    def __getattr__(self, name):
+        # fetchone / fetchall / fetchmany / description などは実際のカーソルに委ねる
+        return getattr(self._cursor, name)
+
+    def close(self, broken=False):
+        """Close the cursor and return its connection to the pool, or discard it if broken"""
+        if self._cursor is None:
+            return
+        cursor, connection = self._cursor, self._connection
+        self._cursor = self._connection = None
         try:
-            # Generate new ID if not exists
-            if "id" not in state or not state["id"]:
-                state["id"] = str(uuid.uuid4())
-            
-            # Extract basic info
-            state_id = state["id"]
-            company = state.get("customer_info", {}).get("company", "不明")
-            recorder = state.get("customer_info", {}).get("writer", "不明")
-            record_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Convert state to JSON
-            state_json = json.dumps(state, ensure_ascii=False)
-            
-            with self.connection.cursor() as cursor:
-                # Check if record exists
-                cursor.execute(f"""
-                    SELECT COUNT(*) FROM {self.full_table_name}
-                    WHERE id = '{state_id}'
-                """)
-                count = cursor.fetchone()[0]
-                
-                if count > 0:
-                    # Update existing record
-                    cursor.execute(f"""
-                        UPDATE {self.full_table_name}
-                        SET company = '{company}',
-                            record_date = '{record_date}',
-                            recorder = '{recorder}',
-                            state_json = '{state_json}'
-                        WHERE id = '{state_id}'
-                    """)
-                else:
-                    # Insert new record
-                    cursor.execute(f"""
-                        INSERT INTO {self.full_table_name}
-                        VALUES ('{state_id}', '{company}', '{record_date}', '{recorder}', '{state_json}')
-                    """)
-                    
-            return state_id
-        except Exception as e:
-            st.error(f"状態の保存エラー: {e}")
-            return None
-    
-    def get_history_list(self):
-        """Get list of all history records"""
-        if not self.connection:
-            return []
-            
+            cursor.close()
+        except Exception:
+            broken = True
+        if broken:
+            self._pool.discard(connection)
+        else:
+            self._pool.checkin(connection)
+
+
+# SQL実行の計測（操作ごとのレイテンシ分布・スローログ・再実行ごとの呼び出し一覧）
+_query_context = threading.local()
+
+# 状態本体を運ぶ列・パラメータ（複数行のパラメータ名には "_<行番号>" が付く）
+STATE_PAYLOAD_COLUMNS = ("state_blob", "state_json", "payload")
+
+
+@contextmanager
+def query_operation(name):
+    """Label the statements the current thread issues inside the block; the outermost label wins"""
+    outer = getattr(_query_context, "operation", None)
+    if outer is None:
+        _query_context.operation = name
+    try:
+        yield
+    finally:
+        _query_context.operation = outer
+
+
+def track_operation(name):
+    """Decorator labelling every statement a HistoryStore method issues with an operation name
+
+    Generators are labelled only while they run, not while suspended in
+    the caller.
+    """
+    def decorator(method):
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def generator(*args, **kwargs):
+                iterator = method(*args, **kwargs)
+                while True:
+                    with query_operation(name):
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                    yield item
+            return generator
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with query_operation(name):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _payload_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return 0
+
+
+class QueryStats:
+    """Process-wide rolling latency histograms per operation, with a JSON Lines slow-query log
+
+    Keeps the wall times of the last `window` statements of each
+    operation. Statements taking slow_threshold_ms or more are appended
+    to slow_log_path. start_trace() additionally collects the statements
+    issued by the calling thread, e.g. during one Streamlit rerun.
+    """
+    # ヒストグラムの各区間の上限（ミリ秒）。最後の区間より遅いものは "それ以上" に数える
+    BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, window=500, slow_threshold_ms=1000, slow_log_path=None):
+        self.window = window
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_log_path = slow_log_path
+        self._timings = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def record(self, entry):
+        """Add a finished statement: a dict with operation, kind, statement, ms, rows, payload_bytes, retries and error"""
+        with self._lock:
+            self._timings.setdefault(entry["operation"], deque(maxlen=self.window)).append(entry["ms"])
+        trace = getattr(_query_context, "trace", None)
+        if trace is not None:
+            trace.append(entry)
+        if self.slow_log_path and entry["ms"] >= self.slow_threshold_ms:
+            self._log_slow(entry)
+
+    def _log_slow(self, entry):
+        line = json.dumps(dict(entry, logged_at=datetime.now().isoformat()), ensure_ascii=False)
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute(f"""
-                    SELECT id, company, record_date, recorder
-                    FROM {self.full_table_name}
-                    ORDER BY record_date DESC
-                """)
-                
-                # Convert to list of dicts
-                columns = [col[0] for col in cursor.description]
-                history = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                
-                return history
-        except Exception as e:
-            st.error(f"履歴の取得エラー: {e}")
-            return []
-    
+            with self._log_lock, open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            # ログを書けなくても本来の処理は止めない
+            pass
+
+    def histograms(self):
+        """Summarize the window of each operation
+
+        Returns {operation: {"count", "p50_ms", "p95_ms", "max_ms", "buckets"}},
+        where buckets holds one count per BUCKETS_MS bound plus one for
+        slower statements.
+        """
+        with self._lock:
+            timings = {operation: sorted(values) for operation, values in self._timings.items()}
+        summary = {}
+        for operation, values in sorted(timings.items()):
+            buckets = [0] * (len(self.BUCKETS_MS) + 1)
+            for ms in values:
+                buckets[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            summary[operation] = {
+                "count": len(values),
+                "p50_ms": values[(len(values) - 1) // 2],
+                "p95_ms": values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)],
+                "max_ms": values[-1],
+                "buckets": buckets
+            }
+        return summary
+
+    @staticmethod
+    def start_trace():
+        """Start collecting the statements of the calling thread; returns the list they are appended to"""
+        _query_context.trace = []
+        return _query_context.trace
+
+    @staticmethod
+    def stop_trace():
+        """Stop collecting for the calling thread and return what was collected"""
+        trace = getattr(_query_context, "trace", None)
+        _query_context.trace = None
+        return trace or []
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_stats(window, slow_threshold_ms, slow_log_path):
+    """Shared statement statistics for every session in this process"""
+    return QueryStats(window=window, slow_threshold_ms=slow_threshold_ms, slow_log_path=slow_log_path)
+
+
+class InstrumentedCursor:
+    """Cursor wrapper that records every statement in a QueryStats
+
+    A statement's wall time covers its execute (including retries) and
+    the fetches that follow it; it is recorded when the next statement
+    starts or finish() is called. Rows counts fetched rows, and
+    payload_bytes the state columns sent as parameters or fetched.
+    """
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._entry = None
+        self._payload_indexes = []
+
+    def execute(self, operation, *args):
+        self._run(self._cursor.execute, operation, args, args[:1])
+
+    def executemany(self, operation, parameter_sets):
+        # 同じ文を複数行分まとめて実行したものを1件として記録する
+        parameter_sets = list(parameter_sets)
+        self._run(self._cursor.executemany, operation, (parameter_sets,), parameter_sets)
+
+    def _run(self, call, operation, args, parameter_sets):
+        self.finish()
+        kind = statement_kind(operation)
+        entry = {
+            "operation": getattr(_query_context, "operation", None) or kind,
+            "kind": kind,
+            "statement": " ".join(operation.split())[:300],
+            "ms": 0.0,
+            "rows": 0,
+            "payload_bytes": sum(_payload_size(value) for parameters in parameter_sets if isinstance(parameters, dict)
+                                 for name, value in parameters.items()
+                                 if re.sub(r"_\d+$", "", name) in STATE_PAYLOAD_COLUMNS),
+            "retries": 0,
+            "error": None
+        }
+        start = time.perf_counter()
+        try:
+            call(operation, *args)
+        except Exception as e:
+            entry["error"] = type(e).__name__
+            raise
+        finally:
+            entry["ms"] += (time.perf_counter() - start) * 1000
+            entry["retries"] = getattr(self._cursor, "retries", 0)
+            self._entry = entry
+            if entry["error"]:
+                self.finish()
+        description = self._cursor.description or []
+        self._payload_indexes = [i for i, column in enumerate(description) if column[0] in STATE_PAYLOAD_COLUMNS]
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+        self._count([] if row is None else [row])
+        return row
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._count(rows)
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self._fetch(self._cursor.fetchmany, *args)
+        self._count(rows)
+        return rows
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._entry is not None:
+                self._entry["ms"] += (time.perf_counter() - start) * 1000
+
+    def _count(self, rows):
+        if self._entry is None:
+            return
+        self._entry["rows"] += len(rows)
+        self._entry["payload_bytes"] += sum(_payload_size(row[i]) for row in rows for i in self._payload_indexes)
+
+    def __getattr__(self, name):
+        # rowcount / description などは実際のカーソルに委ねる
+        return getattr(self._cursor, name)
+
+    def finish(self):
+        """Record the statement in progress, if any"""
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            entry["ms"] = round(entry["ms"], 2)
+            self._stats.record(entry)
+
+
+# 履歴一覧ページのプロセス内共有キャッシュ
+class HistoryPageCache:
+    """Process-wide TTL cache of history pages, cleared whenever history is written"""
+
+    def __init__(self, ttl_seconds=60, max_entries=256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (cached_at, page)。挿入順に並ぶため先頭が最も古い
+        self._pages = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """Counter bumped by every invalidation"""
+        return self._generation
+
+    def get(self, key, allow_stale=False):
+        """Return the cached page for key, or None if missing or expired
+
+        allow_stale also returns expired pages, e.g. while the store cannot be read.
+        """
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                return None
+            cached_at, page = entry
+            if time.monotonic() - cached_at >= self.ttl_seconds and not allow_stale:
+                # 期限切れのページも件数の上限までは残し、障害時の表示に使う
+                return None
+            return page
+
+    def put(self, key, page, generation):
+        """Cache a page read while the cache was at the given generation"""
+        with self._lock:
+            # 読み取り中に書き込みがあった場合、古い結果はキャッシュしない
+            if generation != self._generation:
+                return
+            self._pages.pop(key, None)
+            self._pages[key] = (time.monotonic(), page)
+            while len(self._pages) > self.max_entries:
+                del self._pages[next(iter(self._pages))]
+
+    def invalidate(self):
+        """Drop every cached page"""
+        with self._lock:
+            self._generation += 1
+            self._pages.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def get_history_cache(full_table_name, ttl_seconds):
+    """Get the history page cache shared by all sessions for a table"""
+    return HistoryPageCache(ttl_seconds=ttl_seconds)
+
+# 編集中の保存をUIスレッドから切り離す書き込みキュー
+class SaveConflict(Exception):
+    """Raised when a save was made on an older version of a record than the one stored"""
+
+    def __init__(self, state_id, base_seq):
+        super().__init__(f"履歴 {state_id} は他のユーザーによって更新されています（編集元のバージョン: {base_seq}）")
+        self.state_id = state_id
+        self.base_seq = base_seq
+
+
+class SaveQueue:
+    """Write-behind queue that coalesces saves per state id and writer and flushes them in the background
+    
+    Only the latest enqueued state of each id is written, together with
+    every event recorded since the last successful save. Saves of the same
+    record from different writers (sessions) are kept apart so that the
+    store can detect their conflict. Saves that still fail after retries
+    are kept and, like anything unsaved at shutdown, are spooled to a
+    local file and replayed when the next process starts. Only transient
+    errors are retried: the save goes back into the queue with a
+    not-before time, so one failing record never holds up the others.
+    Conflicting saves are not retried and stay queued until they are
+    discarded. While the store reports WarehouseUnavailable or
+    PoolExhausted, saves stay pending as local drafts without using up
+    their retries.
+    """
+
+    PENDING = "pending"
+    SAVED = "saved"
+    FAILED = "failed"
+    CONFLICT = "conflict"
+
+    def __init__(self, write, max_retries=5, retry_backoff=1.0, spool_path=None):
+        self._write = write
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.spool_path = spool_path
+        # (state_id, writer) -> {"state", "events", "snapshot", "writer"}（同一キーは状態を最新に置き換え、イベントは連結する）
+        self._pending = {}
+        self._failed = {}
+        self._in_flight = set()
+        self._status = {}
+        # 再試行待ちのキー -> (失敗した回数, 次に書き込んでよい時刻 time.monotonic())
+        self._retry_at = {}
+        self._cond = threading.Condition()
+        
+        self._load_spool()
+        self._worker = threading.Thread(target=self._run, name="save-queue", daemon=True)
+        self._worker.start()
+        atexit.register(self.shutdown)
+
+    def enqueue(self, state, events=None, snapshot=False, writer=None):
+        """Queue a copy of state and its new events for saving and return its id
+        
+        events=None saves the full state as a snapshot, overwriting the
+        stored record without a conflict check.
+        """
+        if not state.get("id"):
+            state["id"] = str(uuid.uuid4())
+        key = (state["id"], writer)
+        entry = {"state": copy.deepcopy(state), "events": copy.deepcopy(events), "snapshot": snapshot, "writer": writer}
+        
+        with self._cond:
+            # 未保存のイベント（失敗分を含む）は失わないよう引き継ぐ
+            previous = self._pending.pop(key, None) or self._failed.pop(key, None)
+            if previous:
+                entry = self._coalesce(previous, entry)
+            self._pending[key] = entry
+            self._status[key] = (self.PENDING, None)
+            self._cond.notify_all()
+        return state["id"]
+
+    @staticmethod
+    def _coalesce(older, newer):
+        """Merge two queued saves of the same state, keeping the newer state"""
+        if older["events"] is None or newer["events"] is None:
+            events = None
+        else:
+            events = older["events"] + newer["events"]
+        return {"state": newer["state"], "events": events, "snapshot": older["snapshot"] or newer["snapshot"],
+                "writer": newer.get("writer")}
+
+    def retry(self, state_id, writer=None):
+        """Re-queue a save that failed"""
+        with self._cond:
+            entry = self._failed.pop((state_id, writer), None)
+            if entry is None:
+                return False
+            self._retry_at.pop((state_id, writer), None)
+            self._pending[(state_id, writer)] = entry
+            self._status[(state_id, writer)] = (self.PENDING, None)
+            self._cond.notify_all()
+        return True
+
+    def discard(self, state_id, writer=None):
+        """Drop a failed or conflicting save, e.g. once its changes have been merged into a new one"""
+        with self._cond:
+            entry = self._failed.pop((state_id, writer), None)
+            if entry is not None:
+                self._status.pop((state_id, writer), None)
+            return entry is not None
+
+    def base_seq(self, state_id, writer=None):
+        """Return the version the unsaved changes of a state were made on, or None if nothing is queued"""
+        with self._cond:
+            entry = self._pending.get((state_id, writer)) or self._failed.get((state_id, writer))
+        if entry is None:
+            return None
+        if entry["events"]:
+            return entry["events"][0]["seq"] - 1
+        return entry["state"].get("event_seq", 0)
+
+    def status(self, state_id, writer=None):
+        """Return (status, error message) for a state id, or (None, None) if never queued"""
+        with self._cond:
+            return self._status.get((state_id, writer), (None, None))
+
+    def wait(self, state_id, timeout=None, writer=None):
+        """Wait until the save of state_id is no longer pending and return its status"""
+        key = (state_id, writer)
+        with self._cond:
+            self._cond.wait_for(
+                lambda: key not in self._pending and key not in self._in_flight,
+                timeout
+            )
+            return self._status.get(key, (None, None))
+
+    def flush(self, timeout=None):
+        """Wait until every queued save has been written or has failed"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    def shutdown(self, timeout=30):
+        """Flush the queue and spool anything still unsaved to disk"""
+        self.flush(timeout)
+        with self._cond:
+            unsaved = {**self._failed, **self._pending}
+        if not unsaved or not self.spool_path:
+            return
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for entry in unsaved.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _load_spool(self):
+        """Queue states left over from a previous process"""
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    key = (entry["state"]["id"], entry.get("writer"))
+                    if key in self._pending:
+                        entry = self._coalesce(self._pending[key], entry)
+                    self._pending[key] = entry
+                    self._status[key] = (self.PENDING, None)
+        os.remove(self.spool_path)
+
+    def _next_key(self):
+        """Return (the oldest pending key that may be written now, None) or (None, seconds until one may be)"""
+        now = time.monotonic()
+        wait = None
+        for key in self._pending:
+            not_before = self._retry_at.get(key, (0, 0))[1]
+            if not_before <= now:
+                return key, None
+            wait = not_before - now if wait is None else min(wait, not_before - now)
+        return None, wait
+
+    def _requeue(self, key, entry, delay, failures):
+        """Put entry back ahead of any newer state of the same key, to be written after delay seconds"""
+        newer = self._pending.pop(key, None)
+        # 待っている間に積まれた新しい状態より前に置き、順序を保つ
+        self._pending = {key: self._coalesce(entry, newer) if newer else entry, **self._pending}
+        self._retry_at[key] = (failures, time.monotonic() + delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # 最も古く積まれたキーから書き込む（再試行待ちのキーは時刻が来るまで飛ばす）
+                    key, wait = self._next_key()
+                    if key is not None:
+                        break
+                    self._cond.wait(wait)
+                entry = self._pending.pop(key)
+                self._in_flight.add(key)
+
+            error = None
+            try:
+                self._write(entry["state"], events=entry["events"], snapshot=entry["snapshot"])
+            except WarehouseUnavailable as e:
+                # 接続先の停止中は試行回数を消費せず、下書きとして積んだまま復旧を待つ
+                with self._cond:
+                    self._in_flight.discard(key)
+                    failures = self._retry_at.get(key, (0, 0))[0]
+                    self._requeue(key, entry, max(e.retry_after, self.retry_backoff), failures)
+                    self._cond.notify_all()
+                continue
+            except PoolExhausted:
+                # 他の処理が接続を使い切っているだけなので、試行回数を消費せずに少し待って再試行する
+                with self._cond:
+                    self._in_flight.discard(key)
+                    failures = self._retry_at.get(key, (0, 0))[0]
+                    self._requeue(key, entry, self.retry_backoff, failures)
+                    self._cond.notify_all()
+                continue
+            except TRANSIENT_ERRORS as e:
+                failures = self._retry_at.get(key, (0, 0))[0] + 1
+                if failures < self.max_retries:
+                    with self._cond:
+                        self._in_flight.discard(key)
+                        self._requeue(key, entry, backoff_delay(failures - 1, self.retry_backoff), failures)
+                        self._cond.notify_all()
+                    continue
+                error = e
+            except Exception as e:
+                # SQLの誤りや競合など、再試行しても結果が変わらないものはすぐに失敗とする
+                error = e
+
+            with self._cond:
+                self._in_flight.discard(key)
+                self._retry_at.pop(key, None)
+                if key in self._pending:
+                    if error is not None:
+                        # より新しい状態が積まれていれば、未保存のイベントごと引き継いでそちらを書き込む
+                        # (競合した場合も、編集元が分かるよう引き継いだうえで失敗として残る)
+                        self._pending[key] = self._coalesce(entry, self._pending[key])
+                elif error is None:
+                    self._status[key] = (self.SAVED, None)
+                else:
+                    self._failed[key] = entry
+                    self._status[key] = (self.CONFLICT if isinstance(error, SaveConflict) else self.FAILED, str(error))
+                self._cond.notify_all()
+
+
+@st.cache_resource(show_spinner=False)
+def get_save_queue(_manager, full_table_name, max_retries, retry_backoff, spool_path):
+    """Get the process-wide save queue for a table"""
+    return SaveQueue(_manager._write_state, max_retries=max_retries, retry_backoff=retry_backoff, spool_path=spool_path)
+
+
+# 月間コストの記入に使われる単位と、金額として読める書き方（"約100万円/月"、"50〜80万円"、"1億2000万円" など）
+COST_UNITS = {"千": 1e3, "万": 1e4, "億": 1e8}
+COST_AMOUNT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)([千万億]?)")
+COST_PATTERN = re.compile(
+    r"(?:約|月額?)?((?:\d+(?:\.\d+)?[千万億]?)+)(?:[~〜-]((?:\d+(?:\.\d+)?[千万億]?)+))?円?(?:/月|程度|前後|くらい|ぐらい)?"
+)
+
+
+def _parse_amount(text):
+    return sum(float(number) * COST_UNITS.get(unit, 1) for number, unit in COST_AMOUNT_PATTERN.findall(text))
+
+
+def parse_cost(cost):
+    """Parse a free-text monthly cost such as "1,200,000円", "100万円" or "50〜80万円" into a float
+
+    A range becomes its midpoint. Returns None when the text is not a
+    plain amount, so that the cost columns never hold a misread number.
+    """
+    if isinstance(cost, (int, float)):
+        return float(cost)
+    text = re.sub(r"[,\s]", "", unicodedata.normalize("NFKC", str(cost or "")))
+    match = COST_PATTERN.fullmatch(text)
+    if not match:
+        return None
+    low, high = match.groups()
+    if high is None:
+        return _parse_amount(low)
+    # "50〜80万円" のように単位が上限側にだけ書かれている場合は下限にも同じ単位を付ける
+    if low[-1].isdigit() and not high[-1].isdigit():
+        low += high[-1]
+    return (_parse_amount(low) + _parse_amount(high)) / 2
+
+
+def normalize_state(state):
+    """Split a state into typed rows for the analytical tables
+    
+    Returns (engagement, components, next_actions) where engagement is a
+    dict and the others are lists of dicts, keyed by column name.
+    """
+    customer_info = state.get("customer_info", {})
+    project_data = state.get("project_data", {})
+    
+    try:
+        meeting_date = datetime.strptime(customer_info.get("meeting_date", ""), "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        meeting_date = None
+        
+    engagement = {
+        "company": customer_info.get("company"),
+        "department": customer_info.get("department"),
+        "person": customer_info.get("person"),
+        "recorder": customer_info.get("writer"),
+        "meeting_date": meeting_date,
+        "persona": customer_info.get("persona"),
+        "interest": customer_info.get("interest"),
+        "budget": project_data.get("budget"),
+        "decision_process": project_data.get("decision_process"),
+        "timeframe": project_data.get("timeframe")
+    }
+    
+    components = []
+    for cloud, stacks in state.get("platform_data", {}).items():
+        for stack in stacks:
+            if not isinstance(stack, dict) or not stack.get("component"):
+                continue
+            product = stack.get("product")
+            # 製品IDのない古い状態や、カタログ外の製品は名前から製品IDを作る（別名は正式名のIDにまとめる）
+            product_id = stack.get("product_id") or CATALOG.product_search.canonical_id(product)
+            if not product_id and product:
+                product_id = ProductIndex.product_id(product)
+            components.append({
+                "cloud": cloud,
+                "category": CATALOG.category_of(stack["component"]),
+                "component": stack["component"],
+                "product": product,
+                "product_id": product_id or None,
+                "cost": parse_cost(stack.get("cost")),
+                "issues": json.dumps(stack.get("issues", []), ensure_ascii=False),
+                "details": stack.get("details")
+            })
+            
+    next_actions = [{"action": action} for action in state.get("next_actions", [])]
+    
+    return engagement, components, next_actions
+
+# 保存用の状態エンベロープ: マジック(3バイト) + フォーマットバージョン(1バイト) + 本体
+# v1: 空白なしのJSON(UTF-8) を zlib で圧縮したもの
+STATE_ENVELOPE_MAGIC = b"DDS"
+STATE_ENVELOPE_VERSION = 1
+STATE_ENVELOPE_DECODERS = {
+    1: lambda payload: json.loads(zlib.decompress(payload).decode("utf-8")),
+}
+
+
+def encode_state(state):
+    """Encode a state into the current binary envelope"""
+    payload = json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return STATE_ENVELOPE_MAGIC + bytes([STATE_ENVELOPE_VERSION]) + zlib.compress(payload, 6)
+
+
+def decode_state(value):
+    """Decode a stored state: a binary envelope of any known version, or legacy plain JSON text"""
+    if isinstance(value, str):
+        return json.loads(value)
+    value = bytes(value)
+    if not value.startswith(STATE_ENVELOPE_MAGIC):
+        # エンベロープ導入前にバイナリ列へ移されたJSON
+        return json.loads(value.decode("utf-8"))
+    version = value[len(STATE_ENVELOPE_MAGIC)]
+    if version not in STATE_ENVELOPE_DECODERS:
+        raise ValueError(f"Unsupported state envelope version: {version}")
+    return STATE_ENVELOPE_DECODERS[version](value[len(STATE_ENVELOPE_MAGIC) + 1:])
+
+# スキーマのマイグレーション定義（バージョン順に適用される）
+# {table} は履歴テーブル、{prefix} は "カタログ.スキーマ" に置換される
+# SQLで書けない手順（既存データの索引付けなど）はストアを受け取る関数として書く
+SCHEMA_MIGRATIONS = [
+    (1, "履歴テーブルの作成", [
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id STRING,
+            company STRING, 
+            record_date TIMESTAMP,
+            recorder STRING,
+            state_json STRING
+        )
+        USING DELTA
+        """
+    ]),
+    (2, "単一行コミットによる小ファイル化を抑える自動最適化の有効化", [
+        """
+        ALTER TABLE {table} SET TBLPROPERTIES (
+            'delta.autoOptimize.optimizeWrite' = 'true',
+            'delta.autoOptimize.autoCompact' = 'true'
+        )
+        """
+    ]),
+    (3, "分析用の正規化テーブルの作成", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_engagements (
+            id STRING,
+            company STRING,
+            department STRING,
+            person STRING,
+            recorder STRING,
+            meeting_date DATE,
+            persona STRING,
+            interest STRING,
+            budget STRING,
+            decision_process STRING,
+            timeframe STRING,
+            record_date TIMESTAMP
+        )
+        USING DELTA
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_components (
+            engagement_id STRING,
+            cloud STRING,
+            category STRING,
+            component STRING,
+            product STRING,
+            cost DOUBLE,
+            issues ARRAY<STRING>,
+            details STRING
+        )
+        USING DELTA
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_next_actions (
+            engagement_id STRING,
+            action STRING
+        )
+        USING DELTA
+        """
+    ]),
+    (4, "状態変更のイベントログとスナップショット", [
+        "ALTER TABLE {table} ADD COLUMNS (head_seq BIGINT, snapshot_seq BIGINT)",
+        """
+        CREATE TABLE IF NOT EXISTS {table}_events (
+            state_id STRING,
+            seq BIGINT,
+            event_type STRING,
+            payload STRING,
+            created_at TIMESTAMP
+        )
+        USING DELTA
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_snapshots (
+            state_id STRING,
+            seq BIGINT,
+            state_json STRING,
+            created_at TIMESTAMP
+        )
+        USING DELTA
+        """
+    ]),
+    (5, "状態を圧縮バイナリで保存する列の追加", [
+        "ALTER TABLE {table} ADD COLUMNS (state_blob BINARY)",
+        "ALTER TABLE {table}_snapshots ADD COLUMNS (state_blob BINARY)"
+    ]),
+    (6, "分析画面用の集計テーブルの作成と初期集計", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_issues (
+            component STRING,
+            issue STRING,
+            engagements BIGINT
+        )
+        USING DELTA
+        """,
+        """
+        INSERT OVERWRITE {table}_agg_issues
+        SELECT component, issue, COUNT(DISTINCT engagement_id)
+        FROM {table}_components LATERAL VIEW explode(issues) exploded AS issue
+        WHERE component IS NOT NULL AND issue IS NOT NULL AND issue != ''
+        GROUP BY component, issue
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_products (
+            cloud STRING,
+            component STRING,
+            product STRING,
+            engagements BIGINT
+        )
+        USING DELTA
+        """,
+        """
+        INSERT OVERWRITE {table}_agg_products
+        SELECT cloud, component, product, COUNT(DISTINCT engagement_id)
+        FROM {table}_components
+        WHERE cloud IS NOT NULL AND component IS NOT NULL AND product IS NOT NULL AND product != ''
+        GROUP BY cloud, component, product
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_next_actions (
+            action STRING,
+            engagements BIGINT
+        )
+        USING DELTA
+        """,
+        """
+        INSERT OVERWRITE {table}_agg_next_actions
+        SELECT action, COUNT(DISTINCT engagement_id)
+        FROM {table}_next_actions
+        WHERE action IS NOT NULL AND action != ''
+        GROUP BY action
+        """
+    ]),
+    (7, "全文検索用の転置インデックスの作成と既存データの索引付け", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_search_index (
+            term STRING,
+            engagement_id STRING,
+            tf INT
+        )
+        USING DELTA
+        CLUSTER BY (term)
+        """,
+        lambda store: store.rebuild_search_index()
+    ]),
+    (8, "楽観的排他制御用の書き込みIDの追加", [
+        "ALTER TABLE {table} ADD COLUMNS (write_id STRING)"
+    ]),
+    (9, "履歴テーブルのクラスタリングと削除ベクトルの有効化", [
+        # 一覧（record_date 順）とID指定の読み込みがファイルを絞り込めるよう、OPTIMIZE 時にこの2列でクラスタリングする
+        "ALTER TABLE {table} CLUSTER BY (id, record_date)",
+        # 削除・更新はファイルを書き換えず削除ベクトルに記録し、定期メンテナンスの REORG でまとめて除去する
+        "ALTER TABLE {table} SET TBLPROPERTIES ('delta.enableDeletionVectors' = 'true')"
+    ]),
+    # 正規化テーブルの作り直しは現在のスキーマ（v13の product_id 列）を前提にするため、v13でまとめて行う
+    (10, "処理なし（月間コストの再解析はv13の正規化テーブルの作り直しに統合）", []),
+    (11, "再取り込みで重複したスナップショットの除去", [
+        """
+        INSERT OVERWRITE {table}_snapshots
+        SELECT state_id, seq, state_json, created_at, state_blob
+        FROM {table}_snapshots
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY state_id, seq ORDER BY created_at DESC) = 1
+        """
+    ]),
+    (12, "一文字の検索語に一致させるための日本語の文字単位の索引付け", [
+        lambda store: store.rebuild_search_index()
+    ]),
+    (13, "製品IDによる製品集計と月間コストの再解析（正規化テーブルの作り直し）", [
+        "ALTER TABLE {table}_components ADD COLUMNS (product_id STRING)",
+        "DROP TABLE IF EXISTS {table}_agg_products",
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_products (
+            cloud STRING,
+            component STRING,
+            product_id STRING,
+            product STRING,
+            engagements BIGINT
+        )
+        USING DELTA
+        """,
+        lambda store: store.rebuild_analytics(),
+        lambda store: store.rebuild_aggregates()
+    ]),
+]
+
+# ローカル（SQLite）バックエンド用のマイグレーション定義
+# バージョン番号は SCHEMA_MIGRATIONS と揃え、同じスキーマ世代を表す
+LOCAL_SCHEMA_MIGRATIONS = [
+    (1, "履歴テーブルの作成", [
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT PRIMARY KEY,
+            company TEXT,
+            record_date TIMESTAMP,
+            recorder TEXT,
+            state_json TEXT
+        )
+        """
+    ]),
+    (2, "履歴一覧の並び順に沿ったインデックスの作成", [
+        "CREATE INDEX IF NOT EXISTS {table}_record_date_idx ON {table} (record_date, id)"
+    ]),
+    (3, "分析用の正規化テーブルの作成", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_engagements (
+            id TEXT,
+            company TEXT,
+            department TEXT,
+            person TEXT,
+            recorder TEXT,
+            meeting_date DATE,
+            persona TEXT,
+            interest TEXT,
+            budget TEXT,
+            decision_process TEXT,
+            timeframe TEXT,
+            record_date TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_components (
+            engagement_id TEXT,
+            cloud TEXT,
+            category TEXT,
+            component TEXT,
+            product TEXT,
+            cost REAL,
+            issues TEXT,
+            details TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_next_actions (
+            engagement_id TEXT,
+            action TEXT
+        )
+        """
+    ]),
+    (4, "状態変更のイベントログとスナップショット", [
+        "ALTER TABLE {table} ADD COLUMN head_seq INTEGER",
+        "ALTER TABLE {table} ADD COLUMN snapshot_seq INTEGER",
+        """
+        CREATE TABLE IF NOT EXISTS {table}_events (
+            state_id TEXT,
+            seq INTEGER,
+            event_type TEXT,
+            payload TEXT,
+            created_at TIMESTAMP,
+            PRIMARY KEY (state_id, seq)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_snapshots (
+            state_id TEXT,
+            seq INTEGER,
+            state_json TEXT,
+            created_at TIMESTAMP
+        )
+        """
+    ]),
+    (5, "状態を圧縮バイナリで保存する列の追加", [
+        "ALTER TABLE {table} ADD COLUMN state_blob BLOB",
+        "ALTER TABLE {table}_snapshots ADD COLUMN state_blob BLOB"
+    ]),
+    (6, "分析画面用の集計テーブルの作成と初期集計", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_issues (
+            component TEXT,
+            issue TEXT,
+            engagements INTEGER,
+            PRIMARY KEY (component, issue)
+        )
+        """,
+        "DELETE FROM {table}_agg_issues",
+        """
+        INSERT INTO {table}_agg_issues (component, issue, engagements)
+        SELECT c.component, j.value, COUNT(DISTINCT c.engagement_id)
+        FROM {table}_components AS c, json_each(c.issues) AS j
+        WHERE c.component IS NOT NULL AND j.value IS NOT NULL AND j.value != ''
+        GROUP BY c.component, j.value
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_products (
+            cloud TEXT,
+            component TEXT,
+            product TEXT,
+            engagements INTEGER,
+            PRIMARY KEY (cloud, component, product)
+        )
+        """,
+        "DELETE FROM {table}_agg_products",
+        """
+        INSERT INTO {table}_agg_products (cloud, component, product, engagements)
+        SELECT cloud, component, product, COUNT(DISTINCT engagement_id)
+        FROM {table}_components
+        WHERE cloud IS NOT NULL AND component IS NOT NULL AND product IS NOT NULL AND product != ''
+        GROUP BY cloud, component, product
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_next_actions (
+            action TEXT PRIMARY KEY,
+            engagements INTEGER
+        )
+        """,
+        "DELETE FROM {table}_agg_next_actions",
+        """
+        INSERT INTO {table}_agg_next_actions (action, engagements)
+        SELECT action, COUNT(DISTINCT engagement_id)
+        FROM {table}_next_actions
+        WHERE action IS NOT NULL AND action != ''
+        GROUP BY action
+        """
+    ]),
+    (7, "全文検索用の転置インデックスの作成と既存データの索引付け", [
+        """
+        CREATE TABLE IF NOT EXISTS {table}_search_index (
+            term TEXT,
+            engagement_id TEXT,
+            tf INTEGER,
+            PRIMARY KEY (term, engagement_id)
+        )
+        WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS {table}_search_index_engagement_idx ON {table}_search_index (engagement_id)",
+        lambda store: store.rebuild_search_index()
+    ]),
+    (8, "楽観的排他制御用の書き込みIDの追加", [
+        "ALTER TABLE {table} ADD COLUMN write_id TEXT"
+    ]),
+    # SQLiteでは主キーと (record_date, id) の索引（v2）が同じ役割を持つため変更はない
+    (9, "履歴テーブルのクラスタリングと削除ベクトルの有効化", []),
+    # 正規化テーブルの作り直しは現在のスキーマ（v13の product_id 列）を前提にするため、v13でまとめて行う
+    (10, "処理なし（月間コストの再解析はv13の正規化テーブルの作り直しに統合）", []),
+    (11, "再取り込みで重複したスナップショットの除去", [
+        """
+        DELETE FROM {table}_snapshots
+        WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table}_snapshots GROUP BY state_id, seq)
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS {table}_snapshots_seq_idx ON {table}_snapshots (state_id, seq)"
+    ]),
+    (12, "一文字の検索語に一致させるための日本語の文字単位の索引付け", [
+        lambda store: store.rebuild_search_index()
+    ]),
+    (13, "製品IDによる製品集計と月間コストの再解析（正規化テーブルの作り直し）", [
+        "ALTER TABLE {table}_components ADD COLUMN product_id TEXT",
+        "DROP TABLE IF EXISTS {table}_agg_products",
+        """
+        CREATE TABLE IF NOT EXISTS {table}_agg_products (
+            cloud TEXT,
+            component TEXT,
+            product_id TEXT,
+            product TEXT,
+            engagements INTEGER,
+            PRIMARY KEY (cloud, component, product_id)
+        )
+        """,
+        lambda store: store.rebuild_analytics(),
+        lambda store: store.rebuild_aggregates()
+    ]),
+]
+
+# 履歴テーブルに付随するテーブルの接尾辞（マイグレーションで作成されるもの）
+DERIVED_TABLE_SUFFIXES = ["_engagements", "_components", "_next_actions", "_events", "_snapshots",
+                          "_agg_issues", "_agg_products", "_agg_next_actions", "_search_index"]
+
+# 集計テーブルの元になる正規化テーブル
+AGGREGATE_SOURCES = {
+    "_agg_issues": "components",
+    "_agg_products": "components",
+    "_agg_next_actions": "next_actions",
+}
+
+# 集計テーブルの接尾辞と集計キーの列（各キーに該当する案件数を engagements 列に持つ）
+AGGREGATE_TABLES = {
+    "_agg_issues": ["component", "issue"],
+    "_agg_products": ["cloud", "component", "product_id"],
+    "_agg_next_actions": ["action"],
+}
+
+# 集計キーには含めず、表示用に集計行へ持たせる列（最後に保存された案件の値になる）
+AGGREGATE_LABEL_COLUMNS = {
+    "_agg_products": ["product"],
+}
+
+# 集計テーブルを正規化テーブルから数え直す文（定期メンテナンスで実行する）
+AGGREGATE_REBUILD_STATEMENTS = [
+    """
+    INSERT OVERWRITE {table}_agg_issues
+    SELECT component, issue, COUNT(DISTINCT engagement_id)
+    FROM {table}_components LATERAL VIEW explode(issues) exploded AS issue
+    WHERE component IS NOT NULL AND issue IS NOT NULL AND issue != ''
+    GROUP BY component, issue
+    """,
+    """
+    INSERT OVERWRITE {table}_agg_products
+    SELECT cloud, component, product_id, MAX(product), COUNT(DISTINCT engagement_id)
+    FROM {table}_components
+    WHERE cloud IS NOT NULL AND component IS NOT NULL AND product_id IS NOT NULL AND product_id != ''
+    GROUP BY cloud, component, product_id
+    """,
+    """
+    INSERT OVERWRITE {table}_agg_next_actions
+    SELECT action, COUNT(DISTINCT engagement_id)
+    FROM {table}_next_actions
+    WHERE action IS NOT NULL AND action != ''
+    GROUP BY action
+    """
+]
+
+LOCAL_AGGREGATE_REBUILD_STATEMENTS = [
+    "DELETE FROM {table}_agg_issues",
+    """
+    INSERT INTO {table}_agg_issues (component, issue, engagements)
+    SELECT c.component, j.value, COUNT(DISTINCT c.engagement_id)
+    FROM {table}_components AS c, json_each(c.issues) AS j
+    WHERE c.component IS NOT NULL AND j.value IS NOT NULL AND j.value != ''
+    GROUP BY c.component, j.value
+    """,
+    "DELETE FROM {table}_agg_products",
+    """
+    INSERT INTO {table}_agg_products (cloud, component, product_id, product, engagements)
+    SELECT cloud, component, product_id, MAX(product), COUNT(DISTINCT engagement_id)
+    FROM {table}_components
+    WHERE cloud IS NOT NULL AND component IS NOT NULL AND product_id IS NOT NULL AND product_id != ''
+    GROUP BY cloud, component, product_id
+    """,
+    "DELETE FROM {table}_agg_next_actions",
+    """
+    INSERT INTO {table}_agg_next_actions (action, engagements)
+    SELECT action, COUNT(DISTINCT engagement_id)
+    FROM {table}_next_actions
+    WHERE action IS NOT NULL AND action != ''
+    GROUP BY action
+    """
+]
+
+
+def aggregate_contributions(components, next_actions):
+    """Count, for each aggregate table, the engagements each key appears in
+
+    components and next_actions are analytical rows carrying an
+    engagement_id; issues may be a JSON string or a list. An engagement
+    counts once per key however many rows mention it.
+    """
+    keys = {suffix: set() for suffix in AGGREGATE_TABLES}
+    for row in components:
+        if not row.get("component"):
+            continue
+        issues = row.get("issues") or []
+        if isinstance(issues, str):
+            issues = json.loads(issues)
+        for issue in issues:
+            if issue:
+                keys["_agg_issues"].add((row["engagement_id"], row["component"], issue))
+        if row.get("cloud") and row.get("product_id"):
+            keys["_agg_products"].add((row["engagement_id"], row["cloud"], row["component"], row["product_id"]))
+    for row in next_actions:
+        if row.get("action"):
+            keys["_agg_next_actions"].add((row["engagement_id"], row["action"]))
+    return {suffix: Counter(key[1:] for key in suffix_keys) for suffix, suffix_keys in keys.items()}
+
+
+def aggregate_labels(components):
+    """Map each aggregate key of components to the values of its AGGREGATE_LABEL_COLUMNS"""
+    labels = {suffix: {} for suffix in AGGREGATE_LABEL_COLUMNS}
+    for row in components:
+        if row.get("component") and row.get("cloud") and row.get("product_id"):
+            labels["_agg_products"][(row["cloud"], row["component"], row["product_id"])] = (row.get("product"),)
+    return labels
+
+
+# 全文検索の対象にする状態のセクション
+SEARCH_SECTIONS = ["customer_info", "platform_data", "project_data", "next_actions"]
+
+# 英数字の語、または日本語（ひらがな・カタカナ・漢字）の連続
+SEARCH_TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff々〆]+")
+
+
+def tokenize(text, unigrams=False):
+    """Split text into search terms
+
+    Text is NFKC-normalized and lower-cased. Runs of letters and digits
+    become one term each; runs of Japanese characters, which have no
+    word boundaries, become overlapping character bigrams (a single
+    character stays a unigram). With unigrams, every character of a
+    Japanese run is also a term of its own, so that the index can
+    answer one-character queries.
+    """
+    terms = []
+    for match in SEARCH_TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = match.group()
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+            if unigrams:
+                terms.extend(run)
+    return terms
+
+
+def search_postings(state_id, state):
+    """Build the inverted-index rows (term, engagement_id, tf) for a state's text fields"""
+    texts = []
+    pending = [state.get(section) for section in SEARCH_SECTIONS]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+            
+    counts = Counter(term for text in texts for term in tokenize(text, unigrams=True))
+    return [{"term": term, "engagement_id": state_id, "tf": tf} for term, tf in counts.items()]
+
+
+class Warmup:
+    """Run a start-up task in a background thread, retrying with backoff until it succeeds
+
+    Lets pages render while a cold warehouse starts; `ready` and wait()
+    tell callers when the task has finished, and `error` holds the
+    failure of the last attempt while it is still retrying. `failures`
+    counts the failed attempts since the last retry_now(), not counting
+    waits for an open circuit breaker.
+    """
+
+    def __init__(self, task, retry_base_delay=2, retry_max_delay=30):
+        self._task = task
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.started_at = time.monotonic()
+        self.result = None
+        self.error = None
+        self.failures = 0
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def elapsed(self):
+        """Seconds since the warm-up started"""
+        return time.monotonic() - self.started_at
+
+    def wait(self, timeout=None):
+        """Wait until the task has succeeded; returns whether it has"""
+        return self._ready.wait(timeout)
+
+    def retry_now(self):
+        """Cut the current backoff short and start counting failures afresh"""
+        self.failures = 0
+        self._wake.set()
+
+    def _sleep(self, delay):
+        self._wake.wait(delay)
+        self._wake.clear()
+
+    def _run(self):
+        while True:
+            try:
+                self.result = self._task()
+            except WarehouseUnavailable as e:
+                # 回路が開いている間はバックグラウンドの疎通確認に任せ、次の確認の後に再試行する
+                self.error = e
+                self._sleep(max(e.retry_after, self.retry_base_delay))
+                continue
+            except Exception as e:
+                self.error = e
+                self.failures += 1
+                self._sleep(backoff_delay(self.failures - 1, self.retry_base_delay, self.retry_max_delay))
+                continue
+            self.error = None
+            self._ready.set()
+            return
+
+
+@st.cache_resource(show_spinner=False)
+def get_warmup(_manager, store_key):
+    """Start connecting and applying pending migrations once per process, in the background"""
+    return Warmup(_manager.apply_migrations)
+
+# 履歴ストレージの共通処理（バックエンド固有のSQLはサブクラスが実装する）
+class HistoryStore(ABC):
+    """Abstract base class for history storage backends
+
+    Implements save, list, get, delete, export, import and analytics on
+    top of a small set of backend hooks: _init_connection, _cursor,
+    _upsert_records, _swap_record, _insert_rows, _replace_rows,
+    _append_events and _apply_aggregate_deltas, plus the `migrations`, `version_table_ddl`
+    `aggregate_rebuild_statements` and `array_json_expression` class
+    attributes. Statements use named
+    `:name` parameters, which both backends accept. Backends also provide
+    the maintenance operations table_stats, purge_deleted_rows,
+    optimize_tables and vacuum_tables.
+    """
+    migrations = []
+    version_table_ddl = ""
+    aggregate_rebuild_statements = []
+    # 配列列をJSON文字列として読み出す式
+    array_json_expression = "{}"
+
+    def __init__(self, config, store_key):
+        """Initialize the store; subclasses set full_table_name, version_table_name and schema_prefix first"""
+        self.config = config
+        self.store_key = store_key
+        self.warmup = None
+        # テーブル -> 列名（テーブルの列順）。マイグレーションのたびに読み直す
+        self._column_order = {}
+        self.history_cache = get_history_cache(
+            store_key,
+            config["DELTA_TABLE"].get("HISTORY_CACHE_TTL_SECONDS", 60)
+        )
+        stats_config = config.get("QUERY_STATS", {})
+        self.query_stats = get_query_stats(
+            stats_config.get("WINDOW", 500),
+            stats_config.get("SLOW_QUERY_THRESHOLD_MS", 1000),
+            stats_config.get("SLOW_QUERY_LOG_PATH", "slow_queries.jsonl")
+        )
+        self._init_connection()
+        self._ensure_schema()
+
+    @property
+    @abstractmethod
+    def available(self):
+        """Whether the backend is connected and history features can be used"""
+
+    @property
+    def degraded(self):
+        """Whether the backend is temporarily unreachable (reads come from the cache, saves wait in the queue)"""
+        return False
+
+    @abstractmethod
+    def _init_connection(self):
+        """Connect to the backend; a backend that cannot connect reports available as False"""
+
+    @abstractmethod
+    def _cursor(self):
+        """Context manager yielding a cursor; where the backend has transactions, the block is committed as one"""
+
+    @abstractmethod
+    def _upsert_records(self, cursor, rows, insert_defaults=None):
+        """Insert or update history rows by id; insert_defaults are only written on insert
+
+        Every row must have the same keys, and ids must be unique.
+        """
+
+    @abstractmethod
+    def _swap_record(self, cursor, row, base_seq, insert_defaults=None):
+        """Compare-and-swap one history row and return whether it was written
+
+        An existing row is only updated while its head_seq is still base_seq,
+        or when its write_id equals row's (a retry of a save that already
+        went through). A missing row is inserted.
+        """
+
+    @abstractmethod
+    def _insert_rows(self, cursor, table, rows):
+        """Insert rows, all with the same keys, into table"""
+
+    @abstractmethod
+    def _replace_rows(self, cursor, table, key_column, keys, rows, array_columns=()):
+        """Atomically replace every row of table whose key_column is one of keys"""
+
+    @abstractmethod
+    def _upsert_snapshots(self, cursor, rows):
+        """Insert or overwrite snapshot rows by (state_id, seq), so that rewriting one never duplicates it"""
+
+    @abstractmethod
+    def _append_events(self, cursor, state_id, events):
+        """Append events to the event log, skipping any already written by an earlier attempt"""
+
+    @abstractmethod
+    def _apply_aggregate_deltas(self, cursor, table, key_columns, rows, label_columns=()):
+        """Add each row's delta to the engagements count of its key, dropping keys that reach zero
+
+        Non-null label_columns of a row overwrite the stored ones.
+        """
+
+    def _replace_search_postings(self, cursor, keys, postings):
+        """Replace the search index rows of the engagements in keys"""
+        self._replace_rows(cursor, f"{self.full_table_name}_search_index", "engagement_id", keys, postings)
+
+    def _table_columns(self, cursor, table):
+        """Column names of table in table order"""
+        if table not in self._column_order:
+            cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+            self._column_order[table] = [col[0] for col in cursor.description]
+        return self._column_order[table]
+
+    @property
+    def maintained_tables(self):
+        """The history table and every table derived from it"""
+        return [self.full_table_name] + [f"{self.full_table_name}{suffix}" for suffix in DERIVED_TABLE_SUFFIXES]
+
+    @abstractmethod
+    def table_stats(self):
+        """Return {"table", "files", "bytes"} for each maintained table; files is None where it does not apply"""
+
+    @abstractmethod
+    def purge_deleted_rows(self):
+        """Physically remove rows that were deleted or rewritten but are still kept in storage"""
+
+    @abstractmethod
+    def optimize_tables(self):
+        """Compact small files and recluster the maintained tables"""
+
+    @abstractmethod
+    def vacuum_tables(self, retention_hours):
+        """Delete storage no longer referenced by the tables and older than retention_hours"""
+
+    @property
+    def save_queue(self):
+        """The shared background save queue, or None when history is disabled"""
+        if not self.available:
+            return None
+
+        # 初回アクセス時に生成されるため、保存しないツールからの利用ではワーカーは起動しない
+        queue_config = self.config.get("SAVE_QUEUE", {})
+        return get_save_queue(
+            self,
+            self.store_key,
+            max_retries=queue_config.get("MAX_RETRIES", 5),
+            retry_backoff=queue_config.get("RETRY_BACKOFF_SECONDS", 1),
+            spool_path=queue_config.get("SPOOL_PATH", ".save_queue_spool.jsonl")
+        )
+
+    def _ensure_schema(self):
+        """Start bringing the history tables up to the latest schema version in the background
+
+        The first run in a process also opens the first connection, which
+        waits for a stopped warehouse to start; pages check `ready` instead
+        of blocking on it.
+        """
+        if not self.available:
+            return
+        self.warmup = get_warmup(self, self.store_key)
+
+    @property
+    def ready(self):
+        """Whether the connection is up and the schema is current"""
+        return self.warmup is not None and self.warmup.ready
+
+    @property
+    def schema_version(self):
+        """The applied schema version, or None until the warm-up has finished"""
+        return self.warmup.result if self.ready else None
+
+    def wait_until_ready(self, timeout=None):
+        """Block until the warm-up has finished; returns whether it has"""
+        return self.warmup is not None and self.warmup.wait(timeout)
+
+    @track_operation("ddl")
+    def apply_migrations(self):
+        """Apply pending schema migrations and return the resulting version"""
+        with self._cursor() as cursor:
+            cursor.execute(self.version_table_ddl.format(version_table=self.version_table_name))
+            cursor.execute(f"""
+                SELECT COALESCE(MAX(version), 0) FROM {self.version_table_name}
+                WHERE table_name = :table_name
+            """, {"table_name": self.full_table_name})
+            current_version = cursor.fetchone()[0]
+
+        for version, description, statements in self.migrations:
+            if version <= current_version:
+                continue
+
+            # マイグレーションごとにコミットし、関数の手順が別の接続で書き込めるようにする
+            with self._cursor() as cursor:
+                for statement in statements:
+                    if callable(statement):
+                        statement(self)
+                        continue
+                    cursor.execute(statement.format(
+                        table=self.full_table_name,
+                        prefix=self.schema_prefix
+                    ))
+                    # 列の追加で列順が変わるため、読み込んだ列順を捨てる
+                    self._column_order.clear()
+                cursor.execute(f"""
+                    INSERT INTO {self.version_table_name} (table_name, version, description, applied_at)
+                    VALUES (:table_name, :version, :description, :applied_at)
+                """, {"table_name": self.full_table_name, "version": version, "description": description,
+                      "applied_at": datetime.now()})
+            current_version = version
+
+        return current_version
+
+    def save_state(self, state):
+        """Save state to the history table"""
+        if not self.available:
+            return None
+
+        try:
+            return self._write_state(state)
+        except Exception as e:
+            st.error(f"状態の保存エラー: {e}")
+            return None
+
+    @track_operation("save")
+    def _write_state(self, state, events=None, snapshot=False):
+        """Persist a state and its analytical rows, raising on failure
+
+        When events are given only those events are appended and the record's
+        metadata is updated. The full state is written as a snapshot when no
+        events are given, when snapshot is set, or every SNAPSHOT_INTERVAL
+        events. The analytical tables, aggregates and search index are
+        refreshed on every save: fully with a snapshot, and otherwise only
+        for the sections of the state that the events changed.
+
+        head_seq is the record's version: unless events is None, the save is
+        made on the version before the first event (or on the state's own
+        version when there are no new events) and raises SaveConflict if
+        another writer has saved since.
+        """
+        # 起動直後はスキーマの準備ができるまで待つ（保存キューのワーカーからはここで待機する）
+        self.wait_until_ready()
+
+        # Generate new ID if not exists
+        if "id" not in state or not state["id"]:
+            state["id"] = str(uuid.uuid4())
+
+        # Extract basic info
+        state_id = state["id"]
+        company = state.get("customer_info", {}).get("company", "不明")
+        recorder = state.get("customer_info", {}).get("writer", "不明")
+        record_date = datetime.now()
+        head_seq = state.get("event_seq", 0)
+
+        if events and not snapshot:
+            # スナップショット間隔の境界をまたいだ場合はスナップショットを書く
+            interval = self.config["DELTA_TABLE"].get("SNAPSHOT_INTERVAL", 20)
+            snapshot = head_seq // interval > (events[0]["seq"] - 1) // interval
+        if events is None:
+            snapshot = True
+
+        values = {
+            "id": state_id,
+            "company": company,
+            "record_date": record_date,
+            "recorder": recorder,
+            "head_seq": head_seq
+        }
+
+        if snapshot:
+            # 圧縮エンベロープで保存し、旧形式のJSON列は空にする
+            state_blob = encode_state(state)
+            values.update(state_blob=state_blob, state_json=None, snapshot_seq=head_seq)
+            insert_defaults = None
+        else:
+            # 状態本体は書き換えず、メタデータと最新イベント番号だけを更新する
+            # (未保存の新規レコードは状態本体なしで作成され、読み込み時にイベントから再構築される)
+            insert_defaults = {"snapshot_seq": 0}
+
+        with self._cursor() as cursor:
+            if events is None:
+                # 1往復で挿入/更新を行う（値はすべてバインドパラメータ）
+                self._upsert_records(cursor, [dict(values, write_id=None)], insert_defaults)
+            else:
+                # イベントより先に行のバージョンを進め、競合に負けた保存がイベントログに触れないようにする
+                # 書き込みIDは先頭イベントから決まるため、途中で失敗した保存の再試行は自身の書き込みと判別できる
+                base_seq = events[0]["seq"] - 1 if events else head_seq
+                write_id = f"{events[0]['seq']}@{events[0]['created_at']}" if events else None
+                if not self._swap_record(cursor, dict(values, write_id=write_id), base_seq, insert_defaults):
+                    raise SaveConflict(state_id, base_seq)
+                if events:
+                    self._append_events(cursor, state_id, events)
+
+            if snapshot:
+                self._upsert_snapshots(cursor, [
+                    {"state_id": state_id, "seq": head_seq, "state_blob": state_blob, "created_at": record_date}
+                ])
+                self._write_normalized(cursor, {state_id: (state, record_date)})
+            elif events:
+                sections = {EVENT_SECTIONS[event["type"]] for event in events if event["type"] in EVENT_SECTIONS}
+                self._write_normalized(cursor, {state_id: (state, record_date)}, sections)
+
+        self.history_cache.invalidate()
+        return state_id
+
+    def _write_normalized(self, cursor, states, sections=None):
+        """Replace the engagements' rows in the analytical tables and the search index
+
+        states maps each engagement id to its (state, record_date). With
+        sections (names of state sections, see EVENT_SECTIONS), only the
+        rows derived from those sections are replaced, besides the
+        engagement row that carries record_date; the search index is
+        rebuilt when any section changed.
+        """
+        full = sections is None
+        refresh_components = full or "platform_data" in sections
+        refresh_next_actions = full or "next_actions" in sections
+        engagements, components, next_actions, postings = [], [], [], []
+        for state_id, (state, record_date) in states.items():
+            engagement, state_components, state_next_actions = normalize_state(state)
+            engagements.append(dict(engagement, id=state_id, record_date=record_date))
+            components.extend(dict(row, engagement_id=state_id) for row in state_components)
+            next_actions.extend(dict(row, engagement_id=state_id) for row in state_next_actions)
+            postings.extend(search_postings(state_id, state))
+
+        keys = list(states.keys())
+        self._replace_rows(cursor, f"{self.full_table_name}_engagements", "id", keys, engagements)
+        if refresh_components or refresh_next_actions:
+            previous = self._read_contributions(cursor, keys)
+            current = aggregate_contributions(components if refresh_components else [],
+                                              next_actions if refresh_next_actions else [])
+            # 書き換えない正規化テーブルから数える集計は、差分が出ないよう保存済みの値のままにする
+            refreshed = {"components": refresh_components, "next_actions": refresh_next_actions}
+            for suffix, source in AGGREGATE_SOURCES.items():
+                if not refreshed[source]:
+                    current[suffix] = previous[suffix]
+            if refresh_components:
+                self._replace_rows(cursor, f"{self.full_table_name}_components", "engagement_id", keys, components,
+                                   array_columns=["issues"])
+            if refresh_next_actions:
+                self._replace_rows(cursor, f"{self.full_table_name}_next_actions", "engagement_id", keys, next_actions)
+            self._update_aggregates(cursor, previous, current, aggregate_labels(components))
+        if full or sections:
+            self._replace_search_postings(cursor, keys, postings)
+
+    def _read_contributions(self, cursor, keys):
+        """Read what the stored analytical rows of the engagements contribute to the aggregates"""
+        key_parameters = {f"key_{i}": key for i, key in enumerate(keys)}
+        key_list = ", ".join(f":{name}" for name in key_parameters)
+        cursor.execute(f"""
+            SELECT engagement_id, cloud, component, product_id, {self.array_json_expression.format('issues')} AS issues
+            FROM {self.full_table_name}_components
+            WHERE engagement_id IN ({key_list})
+        """, key_parameters)
+        columns = [col[0] for col in cursor.description]
+        components = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.execute(f"""
+            SELECT engagement_id, action
+            FROM {self.full_table_name}_next_actions
+            WHERE engagement_id IN ({key_list})
+        """, key_parameters)
+        next_actions = [{"engagement_id": engagement_id, "action": action} for engagement_id, action in cursor.fetchall()]
+        return aggregate_contributions(components, next_actions)
+
+    def _update_aggregates(self, cursor, previous, current, labels=None):
+        """Apply the difference between two sets of contributions to the aggregate tables
+
+        labels (see aggregate_labels) gives the display columns written
+        with each key; keys without one keep their stored values.
+
+        previous is read before the rows are replaced, without isolation
+        from other processes, so the counts are only exact while a single
+        process writes a given engagement at a time (e.g. not `cli.py
+        import` while the app saves the same records). rebuild_aggregates
+        recounts them from the analytical tables.
+        """
+        labels = labels or {}
+        for suffix, key_columns in AGGREGATE_TABLES.items():
+            label_columns = AGGREGATE_LABEL_COLUMNS.get(suffix, [])
+            suffix_labels = labels.get(suffix, {})
+            delta = Counter(current[suffix])
+            delta.subtract(previous[suffix])
+            rows = [dict(zip(key_columns, key), **dict(zip(label_columns, suffix_labels.get(key, [None] * len(label_columns)))),
+                         delta=count)
+                    for key, count in delta.items() if count]
+            # 顧客情報だけの変更など、集計に影響しない保存では書き込まない
+            if rows:
+                self._apply_aggregate_deltas(cursor, f"{self.full_table_name}{suffix}", key_columns, rows, label_columns)
+
+    @track_operation("analytics")
+    def get_analytics(self):
+        """Get the portfolio aggregates as a dict of row lists, plus the number of engagements"""
+        if not self.available:
+            return None
+
+        cached = self.history_cache.get(("analytics",), allow_stale=self.degraded)
+        if cached is not None:
+            return cached
+        generation = self.history_cache.generation
+
+        try:
+            analytics = {}
+            with self._cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM {self.full_table_name}")
+                analytics["engagements"] = cursor.fetchone()[0]
+                for suffix, key_columns in AGGREGATE_TABLES.items():
+                    cursor.execute(f"""
+                        SELECT {', '.join(key_columns + AGGREGATE_LABEL_COLUMNS.get(suffix, []))}, engagements
+                        FROM {self.full_table_name}{suffix}
+                        ORDER BY engagements DESC
+                    """)
+                    columns = [col[0] for col in cursor.description]
+                    analytics[suffix[len("_agg_"):]] = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+            self.history_cache.put(("analytics",), analytics, generation)
+            return analytics
+        except Exception as e:
+            st.error(f"分析データの取得エラー: {e}")
+            return None
+
+    @track_operation("reindex")
+    def rebuild_aggregates(self):
+        """Recount every aggregate table from the analytical tables, correcting drift from concurrent writers"""
+        with self._cursor() as cursor:
+            for statement in self.aggregate_rebuild_statements:
+                cursor.execute(statement.format(table=self.full_table_name))
+        self.history_cache.invalidate()
+
+    @track_operation("reindex")
+    def rebuild_analytics(self, batch_size=200):
+        """Rewrite the analytical rows and search index of every stored state; returns the number of engagements"""
+        count = 0
+        batch = []
+        for record in self.iter_records(batch_size):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += self._normalize_batch(batch)
+                batch = []
+        if batch:
+            count += self._normalize_batch(batch)
+        return count
+
+    def _normalize_batch(self, records):
+        """Rewrite the analytical rows of a batch of records in one transaction"""
+        with self._cursor() as cursor:
+            self._write_normalized(cursor, {record["id"]: (record["state"], record["record_date"]) for record in records})
+        return len(records)
+
+    @track_operation("reindex")
+    def rebuild_search_index(self, batch_size=200):
+        """Re-tokenize every stored state into the search index; returns the number of engagements"""
+        count = 0
+        batch = []
+        for record in self.iter_records(batch_size):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += self._index_batch(batch)
+                batch = []
+        if batch:
+            count += self._index_batch(batch)
+        return count
+
+    def _index_batch(self, records):
+        """Replace the search index rows of a batch of records in one transaction"""
+        postings = [posting for record in records for posting in search_postings(record["id"], record["state"])]
+        with self._cursor() as cursor:
+            self._replace_search_postings(cursor, [record["id"] for record in records], postings)
+        return len(records)
+
+    @track_operation("search")
+    def search_history(self, query, limit=50, company=None, recorder=None, date_from=None, date_to=None):
+        """Rank saved engagements by how well their text matches query
+
+        Every term of the query must occur in an engagement. Matches are
+        scored with BM25 term weights (without length normalization), so
+        rare terms count for more than common ones. Returns history rows
+        like get_history_page, each with an extra score.
+        """
+        if not self.available:
+            return []
+
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        cache_key = ("search", tuple(terms), limit, company, recorder, date_from, date_to)
+        cached = self.history_cache.get(cache_key, allow_stale=self.degraded)
+        if cached is not None:
+            return cached
+        generation = self.history_cache.generation
+
+        term_parameters = {f"term_{i}": term for i, term in enumerate(terms)}
+        term_list = ", ".join(f":{name}" for name in term_parameters)
+        try:
+            with self._cursor() as cursor:
+                # 各語の文書頻度から重みを決める（どれかの語が一件もなければ結果は空）
+                cursor.execute(f"""
+                    SELECT term, COUNT(*) FROM {self.full_table_name}_search_index
+                    WHERE term IN ({term_list})
+                    GROUP BY term
+                """, term_parameters)
+                document_frequency = dict(cursor.fetchall())
+                if len(document_frequency) < len(terms):
+                    self.history_cache.put(cache_key, [], generation)
+                    return []
+                cursor.execute(f"SELECT COUNT(*) FROM {self.full_table_name}")
+                document_count = cursor.fetchone()[0]
+
+                parameters = dict(term_parameters)
+                weights = []
+                for i, term in enumerate(terms):
+                    df = document_frequency[term]
+                    parameters[f"weight_{i}"] = math.log(1 + (document_count - df + 0.5) / (df + 0.5))
+                    weights.append(f"WHEN :term_{i} THEN :weight_{i}")
+                conditions, filter_parameters = self._filter_conditions(company, recorder, date_from, date_to)
+                parameters.update(filter_parameters)
+                parameters["term_count"] = len(terms)
+
+                # 索引だけで全語を含む案件に絞ってから履歴テーブルと結合する
+                cursor.execute(f"""
+                    SELECT id, company, record_date, recorder, score
+                    FROM (
+                        SELECT engagement_id,
+                               SUM(CASE term {' '.join(weights)} END * tf * 2.2 / (tf + 1.2)) AS score
+                        FROM {self.full_table_name}_search_index
+                        WHERE term IN ({term_list})
+                        GROUP BY engagement_id
+                        HAVING COUNT(*) = :term_count
+                    ) AS matches
+                    JOIN {self.full_table_name} ON id = engagement_id
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    ORDER BY score DESC, record_date DESC
+                    LIMIT {int(limit)}
+                """, parameters)
+
+                columns = [col[0] for col in cursor.description]
+                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+            self.history_cache.put(cache_key, results, generation)
+            return results
+        except Exception as e:
+            st.error(f"履歴の検索エラー: {e}")
+            return []
+
+    @track_operation("export")
+    def iter_records(self, chunk_size=500, company=None, recorder=None, date_from=None, date_to=None):
+        """Yield every history record as a dict with id, company, record_date, recorder and state
+
+        Rows are streamed from the server chunk_size at a time with
+        fetchmany, so the whole table is never held in memory. Records
+        saved after their last snapshot are brought up to date by
+        replaying their events. The filters are those of the history list.
+        """
+        conditions, parameters = self._filter_conditions(company, recorder, date_from, date_to)
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, company, record_date, recorder, state_blob, state_json, snapshot_seq, head_seq
+                FROM {self.full_table_name}
+                {where_clause}
+                ORDER BY id
+            """, parameters)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                records = []
+                stale = []
+                for state_id, company, record_date, recorder, state_blob, state_json, snapshot_seq, head_seq in rows:
+                    snapshot_seq = snapshot_seq or 0
+                    head_seq = head_seq or snapshot_seq
+                    state = self._load_stored_state(state_blob, state_json)
+                    state["id"] = state_id
+                    state["event_seq"] = head_seq
+                    records.append({"id": state_id, "company": company, "record_date": record_date,
+                                    "recorder": recorder, "state": state})
+                    if head_seq > snapshot_seq:
+                        stale.append((state, snapshot_seq, head_seq))
+
+                if stale:
+                    # 読み出し中のカーソルとは別の接続でイベントを再生する
+                    with self._cursor() as replay_cursor:
+                        for state, snapshot_seq, head_seq in stale:
+                            self._replay_events(replay_cursor, state, state["id"], snapshot_seq, head_seq)
+                yield from records
+
+    @track_operation("import")
+    def import_records(self, records, batch_size=100):
+        """Write records as produced by iter_records, batch_size at a time; returns the count
+
+        Each record is stored as a snapshot of its state together with its
+        analytical rows. Existing records with the same id, and snapshots
+        with the same (id, seq), are overwritten, so importing the same
+        records again is harmless. A batch is one transaction only where the
+        backend has transactions: on Delta every statement commits on its
+        own, and an import that fails part-way can leave its last batch
+        half-written until it is run again.
+        """
+        count = 0
+        batch = {}
+        for record in records:
+            # 同じIDはバッチ内で後勝ち（MERGEの入力に重複があるとエラーになるため）
+            batch[record["id"]] = record
+            if len(batch) >= batch_size:
+                self._import_batch(list(batch.values()))
+                count += len(batch)
+                batch = {}
+        if batch:
+            self._import_batch(list(batch.values()))
+            count += len(batch)
+
+        self.history_cache.invalidate()
+        return count
+
+    def _import_batch(self, records):
+        """Write one batch of records with one statement per table"""
+        rows = []
+        snapshots = []
+        states = {}
+        for record in records:
+            state = dict(record["state"], id=record["id"])
+            head_seq = state.get("event_seq", 0)
+            record_date = record["record_date"] or datetime.now()
+            state_blob = encode_state(state)
+            rows.append({
+                "id": record["id"],
+                "company": record["company"],
+                "record_date": record_date,
+                "recorder": record["recorder"],
+                "head_seq": head_seq,
+                "state_blob": state_blob,
+                "state_json": None,
+                "snapshot_seq": head_seq
+            })
+            snapshots.append({"state_id": record["id"], "seq": head_seq, "state_blob": state_blob, "created_at": record_date})
+            states[record["id"]] = (state, record_date)
+
+        with self._cursor() as cursor:
+            self._upsert_records(cursor, rows)
+            self._upsert_snapshots(cursor, snapshots)
+            self._write_normalized(cursor, states)
+
+    @staticmethod
+    def _filter_conditions(company=None, recorder=None, date_from=None, date_to=None):
+        """Build the WHERE conditions and parameters of the history list filters"""
+        conditions = []
+        parameters = {}
+        if company:
+            conditions.append("LOWER(company) LIKE LOWER(:company)")
+            parameters["company"] = f"%{company}%"
+        if recorder:
+            conditions.append("LOWER(recorder) LIKE LOWER(:recorder)")
+            parameters["recorder"] = f"%{recorder}%"
+        if date_from:
+            conditions.append("record_date >= :date_from")
+            parameters["date_from"] = datetime.combine(date_from, datetime.min.time())
+        if date_to:
+            # 終了日当日を含める
+            conditions.append("record_date < :date_to")
+            parameters["date_to"] = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        return conditions, parameters
+
+    @track_operation("list")
+    def get_history_page(self, page_size=20, after=None, company=None, recorder=None, date_from=None, date_to=None):
+        """Get one page of history records, newest first
+
+        Uses keyset pagination on (record_date, id): `after` is the
+        (record_date, id) of the last row on the previous page. Returns
+        (rows, next_after), where next_after is None on the last page.
+        """
+        if not self.available:
+            return [], None
+
+        conditions, parameters = self._filter_conditions(company, recorder, date_from, date_to)
+        if after:
+            conditions.append("(record_date < :after_date OR (record_date = :after_date AND id < :after_id))")
+            parameters["after_date"], parameters["after_id"] = after
+
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        cache_key = (page_size, after, company, recorder, date_from, date_to)
+        cached = self.history_cache.get(cache_key, allow_stale=self.degraded)
+        if cached is not None:
+            return cached
+        generation = self.history_cache.generation
+
+        try:
+            with self._cursor() as cursor:
+                # 次ページの有無を判定するため1件多く取得する
+                cursor.execute(f"""
+                    SELECT id, company, record_date, recorder
+                    FROM {self.full_table_name}
+                    {where_clause}
+                    ORDER BY record_date DESC, id DESC
+                    LIMIT {int(page_size) + 1}
+                """, parameters)
+
+                # Convert to list of dicts
+                columns = [col[0] for col in cursor.description]
+                history = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+            next_after = None
+            if len(history) > page_size:
+                history = history[:page_size]
+                last = history[-1]
+                next_after = (last["record_date"], last["id"])
+
+            self.history_cache.put(cache_key, (history, next_after), generation)
+            return history, next_after
+        except Exception as e:
+            st.error(f"履歴の取得エラー: {e}")
+            return [], None
+
+    @track_operation("get")
     def get_state_by_id(self, state_id):
         """Get state by ID"""
-        if not self.connection:
+        if not self.available:
             return None
-            
+
         try:
-            with self.connection.cursor() as cursor:
+            with self._cursor() as cursor:
                 cursor.execute(f"""
-                    SELECT state_json
+                    SELECT state_blob, state_json, snapshot_seq, head_seq
                     FROM {self.full_table_name}
-                    WHERE id = '{state_id}'
-                """)
-                
+                    WHERE id = :state_id
+                """, {"state_id": state_id})
+
+                result = cursor.fetchone()
+                if not result:
+                    return None
+
+                state_blob, state_json, snapshot_seq, head_seq = result
+                snapshot_seq = snapshot_seq or 0
+                head_seq = head_seq or snapshot_seq
+                state = self._load_stored_state(state_blob, state_json)
+
+                # スナップショット以降のイベントを適用して最新状態にする
+                # (行のバージョンがイベントの書き込みより先に進んでいる場合は、適用できた分を版とする)
+                version = snapshot_seq
+                if head_seq > snapshot_seq:
+                    version = self._replay_events(cursor, state, state_id, snapshot_seq, head_seq)
+
+            state["id"] = state_id
+            state["event_seq"] = version
+            return state
+        except Exception as e:
+            st.error(f"状態の取得エラー: {e}")
+            return None
+
+    @track_operation("get_version")
+    def get_state_version(self, state_id, seq):
+        """Rebuild the state as it was after event seq from the nearest snapshot and the events after it"""
+        if not self.available:
+            return None
+
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT seq, state_blob, state_json
+                    FROM {self.full_table_name}_snapshots
+                    WHERE state_id = :state_id AND seq <= :seq
+                    ORDER BY seq DESC
+                    LIMIT 1
+                """, {"state_id": state_id, "seq": seq})
+
                 result = cursor.fetchone()
-                if result:
-                    return json.loads(result[0])
+                snapshot_seq, state = (result[0], self._load_stored_state(result[1], result[2])) if result else (0, new_state())
+                if seq > snapshot_seq:
+                    self._replay_events(cursor, state, state_id, snapshot_seq, seq)
+
+            state["id"] = state_id
+            state["event_seq"] = seq
+            return state
+        except Exception as e:
+            st.error(f"過去の状態の取得エラー: {e}")
+            return None
+
+    @track_operation("get_events")
+    def get_state_events(self, state_id, limit=50):
+        """Get the most recent events of a state, newest first"""
+        if not self.available:
+            return []
+
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT seq, event_type, created_at
+                    FROM {self.full_table_name}_events
+                    WHERE state_id = :state_id
+                    ORDER BY seq DESC
+                    LIMIT {int(limit)}
+                """, {"state_id": state_id})
+
+                columns = [col[0] for col in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            st.error(f"変更履歴の取得エラー: {e}")
+            return []
+
+    @staticmethod
+    def _load_stored_state(state_blob, state_json):
+        """Decode a stored state, preferring the binary envelope over legacy JSON text"""
+        if state_blob is not None:
+            return decode_state(state_blob)
+        if state_json:
+            return decode_state(state_json)
+        return new_state()
+
+    def _replay_events(self, cursor, state, state_id, after_seq, until_seq):
+        """Apply the events in (after_seq, until_seq] to state in order and return the last applied seq"""
+        cursor.execute(f"""
+            SELECT seq, event_type, payload
+            FROM {self.full_table_name}_events
+            WHERE state_id = :state_id AND seq > :after_seq AND seq <= :until_seq
+            ORDER BY seq
+        """, {"state_id": state_id, "after_seq": after_seq, "until_seq": until_seq})
+
+        last_seq = after_seq
+        for last_seq, event_type, payload in cursor.fetchall():
+            apply_state_event(state, event_type, json.loads(payload))
+        return last_seq
+
+    @track_operation("delete")
+    def delete_history(self, state_id):
+        """Delete history record by ID"""
+        if not self.available:
+            return False
+
+        try:
+            with self._cursor() as cursor:
+                previous = self._read_contributions(cursor, [state_id])
+                cursor.execute(f"""
+                    DELETE FROM {self.full_table_name}
+                    WHERE id = :state_id
+                """, {"state_id": state_id})
+                for table, key_column in [("engagements", "id"), ("components", "engagement_id"), ("next_actions", "engagement_id"),
+                                          ("events", "state_id"), ("snapshots", "state_id"),
+                                          ("search_index", "engagement_id")]:
+                    cursor.execute(f"""
+                        DELETE FROM {self.full_table_name}_{table}
+                        WHERE {key_column} = :state_id
+                    """, {"state_id": state_id})
+                self._update_aggregates(cursor, previous, aggregate_contributions([], []))
+            self.history_cache.invalidate()
+            return True
+        except Exception as e:
+            st.error(f"履歴の削除エラー: {e}")
+            return False
+
+# DeltaTableManager クラスを追加
+class DeltaTableManager(HistoryStore):
+    migrations = SCHEMA_MIGRATIONS
+    aggregate_rebuild_statements = AGGREGATE_REBUILD_STATEMENTS
+    array_json_expression = "to_json({})"
+    version_table_ddl = """
+        CREATE TABLE IF NOT EXISTS {version_table} (
+            table_name STRING,
+            version INT,
+            description STRING,
+            applied_at TIMESTAMP
+        )
+        USING DELTA
+    """
+
+    def __init__(self, config):
+        """Initialize the DeltaTableManager"""
+        self.catalog = os.environ.get("CATALOG_NAME", config["DELTA_TABLE"]["DEFAULT_CATALOG"])
+        self.schema = os.environ.get("SCHEMA_NAME", config["DELTA_TABLE"]["DEFAULT_SCHEMA"])
+        self.schema_prefix = f"{self.catalog}.{self.schema}"
+        self.table_name = config["DELTA_TABLE"]["TABLE_NAME"]
+        self.full_table_name = f"{self.schema_prefix}.{self.table_name}"
+        self.version_table_name = f"{self.schema_prefix}.{config['DELTA_TABLE'].get('SCHEMA_VERSION_TABLE', 'migration_tool_schema_version')}"
+        super().__init__(config, self.full_table_name)
+
+    @property
+    def available(self):
+        return self.pool is not None
+
+    @property
+    def degraded(self):
+        return self.pool is not None and self.breaker.is_open
+
+    def _init_connection(self):
+        """Attach to the shared Databricks SQL connection pool and circuit breaker"""
+        try:
+            # 環境変数から接続情報を取得
+            server_hostname = os.environ.get("DATABRICKS_SERVER_HOSTNAME")
+            http_path = os.environ.get("DATABRICKS_HTTP_PATH")
+            access_token = os.environ.get("DATABRICKS_TOKEN")
+
+            if not server_hostname or not http_path:
+                st.warning("Databricks接続情報が設定されていません。履歴機能は無効です。")
+                self.pool = None
+                return
+
+            delta_config = self.config["DELTA_TABLE"]
+            self.timeouts = {
+                "read": delta_config.get("READ_TIMEOUT_SECONDS", 30),
+                "write": delta_config.get("WRITE_TIMEOUT_SECONDS", 120),
+                "maintenance": None
+            }
+            self.read_retries = delta_config.get("READ_RETRIES", 2)
+            self.retry_base_delay = delta_config.get("RETRY_BASE_DELAY_SECONDS", 0.5)
+            self.retry_max_delay = delta_config.get("RETRY_MAX_DELAY_SECONDS", 5)
+            self.pool = get_connection_pool(
+                server_hostname,
+                http_path,
+                access_token,
+                size=delta_config.get("POOL_SIZE", 4),
+                idle_timeout=delta_config.get("POOL_IDLE_TIMEOUT_SECONDS", 600),
+                health_check_interval=delta_config.get("POOL_HEALTH_CHECK_INTERVAL_SECONDS", 60),
+                checkout_timeout=delta_config.get("POOL_CHECKOUT_TIMEOUT_SECONDS", 30),
+                connect_timeout=delta_config.get("CONNECT_TIMEOUT_SECONDS", 30)
+            )
+            self.breaker = get_circuit_breaker(
+                self.pool,
+                server_hostname,
+                http_path,
+                failure_threshold=delta_config.get("CIRCUIT_FAILURE_THRESHOLD", 3),
+                probe_interval=delta_config.get("CIRCUIT_PROBE_INTERVAL_SECONDS", 15)
+            )
+            # 疎通確認は画面の描画を止めないよう、バックグラウンドのウォームアップで行う
+        except Exception as e:
+            st.error(f"Delta Tableへの接続エラー: {e}")
+            self.pool = None
+
+    @contextmanager
+    def _cursor(self):
+        """Yield a WarehouseCursor, failing fast while the warehouse is unhealthy"""
+        if not self.breaker.allow():
+            raise WarehouseUnavailable(self.breaker.retry_after())
+
+        cursor = WarehouseCursor(self.pool, self.breaker, self.timeouts, read_retries=self.read_retries,
+                                 retry_base_delay=self.retry_base_delay, retry_max_delay=self.retry_max_delay)
+        instrumented = InstrumentedCursor(cursor, self.query_stats)
+        try:
+            yield instrumented
+        except sql.exc.ServerOperationError:
+            # ステートメント自体の失敗ではセッションは壊れていないため再利用する
+            cursor.close()
+            raise
+        except Exception:
+            cursor.close(broken=True)
+            raise
+        else:
+            cursor.close()
+        finally:
+            instrumented.finish()
+
+    @staticmethod
+    def _values_clause(rows, columns, array_columns=()):
+        """Build a multi-row VALUES list and its parameters for rows"""
+        parameters = {}
+        values = []
+        for i, row in enumerate(rows):
+            placeholders = []
+            for column in columns:
+                name = f"{column}_{i}"
+                value = row[column]
+                if isinstance(value, bytes):
+                    # ネイティブパラメータはバイナリ型を持たないため、Base64文字列で渡してサーバー側で戻す
+                    parameters[name] = base64.b64encode(value).decode("ascii")
+                    placeholders.append(f"unbase64(:{name})")
+                elif column in array_columns:
+                    # 配列列はJSON文字列として渡し、サーバー側で ARRAY<STRING> に変換する
+                    parameters[name] = value
+                    placeholders.append(f"from_json(:{name}, 'ARRAY<STRING>')")
+                else:
+                    parameters[name] = value
+                    placeholders.append(f":{name}")
+            values.append(f"({', '.join(placeholders)})")
+        return ", ".join(values), parameters
+
+    def _merge_records(self, cursor, rows, insert_defaults=None, matched_condition=None, parameters=None):
+        """Insert or update the history rows with a single MERGE, updating only rows matching matched_condition"""
+        insert_defaults = insert_defaults or {}
+        columns = list(rows[0].keys())
+        values, merge_parameters = self._values_clause(rows, columns)
+        merge_parameters.update({f"default_{column}": value for column, value in insert_defaults.items()})
+        merge_parameters.update(parameters or {})
+        updates = ",\n                ".join(f"{column} = source.{column}" for column in columns if column != "id")
+        insert_columns = columns + list(insert_defaults.keys())
+        insert_values = [f"source.{column}" for column in columns] + [f":default_{column}" for column in insert_defaults]
+
+        cursor.execute(f"""
+            MERGE INTO {self.full_table_name} AS target
+            USING (
+                SELECT * FROM VALUES {values} AS v({', '.join(columns)})
+            ) AS source
+            ON target.id = source.id
+            WHEN MATCHED{f' AND ({matched_condition})' if matched_condition else ''} THEN UPDATE SET
+                {updates}
+            WHEN NOT MATCHED THEN INSERT ({', '.join(insert_columns)})
+                VALUES ({', '.join(insert_values)})
+        """, merge_parameters)
+
+    def _upsert_records(self, cursor, rows, insert_defaults=None):
+        """Insert or update the history rows with a single MERGE"""
+        self._merge_records(cursor, rows, insert_defaults)
+
+    def _swap_record(self, cursor, row, base_seq, insert_defaults=None):
+        """Compare-and-swap the row with a conditional MERGE and check its affected row count"""
+        self._merge_records(
+            cursor, [row], insert_defaults,
+            matched_condition="COALESCE(target.head_seq, 0) = :base_seq OR target.write_id = source.write_id",
+            parameters={"base_seq": base_seq}
+        )
+        # MERGE は (num_affected_rows, num_updated_rows, num_deleted_rows, num_inserted_rows) を返す
+        return cursor.fetchone()[0] > 0
+
+    def _insert_rows(self, cursor, table, rows):
+        """Insert the rows with one multi-row INSERT"""
+        columns = list(rows[0].keys())
+        values, parameters = self._values_clause(rows, columns)
+        cursor.execute(f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES {values}
+        """, parameters)
+
+    def _upsert_snapshots(self, cursor, rows):
+        """Insert or overwrite the snapshots with a single MERGE on (state_id, seq)"""
+        columns = ["state_id", "seq", "state_blob", "created_at"]
+        values, parameters = self._values_clause(rows, columns)
+        cursor.execute(f"""
+            MERGE INTO {self.full_table_name}_snapshots AS target
+            USING (
+                SELECT * FROM VALUES {values} AS v({', '.join(columns)})
+            ) AS source
+            ON target.state_id = source.state_id AND target.seq = source.seq
+            WHEN MATCHED THEN UPDATE SET state_blob = source.state_blob, state_json = NULL, created_at = source.created_at
+            WHEN NOT MATCHED THEN INSERT ({', '.join(columns)})
+                VALUES ({', '.join(f'source.{column}' for column in columns)})
+        """, parameters)
+
+    def _append_events(self, cursor, state_id, events):
+        """Append events with a MERGE on (state_id, seq)"""
+        parameters = {"state_id": state_id}
+        values = []
+        for i, event in enumerate(events):
+            parameters[f"seq_{i}"] = event["seq"]
+            parameters[f"type_{i}"] = event["type"]
+            parameters[f"payload_{i}"] = json.dumps(event["payload"], ensure_ascii=False)
+            parameters[f"created_at_{i}"] = event["created_at"]
+            values.append(f"(:state_id, :seq_{i}, :type_{i}, :payload_{i}, CAST(:created_at_{i} AS TIMESTAMP))")
+
+        cursor.execute(f"""
+            MERGE INTO {self.full_table_name}_events AS target
+            USING (
+                SELECT * FROM VALUES {', '.join(values)} AS v(state_id, seq, event_type, payload, created_at)
+            ) AS source
+            ON target.state_id = source.state_id AND target.seq = source.seq
+            WHEN NOT MATCHED THEN INSERT *
+        """, parameters)
+
+    def _apply_aggregate_deltas(self, cursor, table, key_columns, rows, label_columns=()):
+        """Apply the deltas with a single MERGE"""
+        columns = list(key_columns) + list(label_columns)
+        values, parameters = self._values_clause(rows, columns + ["delta"])
+        updates = ["engagements = target.engagements + source.delta"]
+        updates.extend(f"{column} = COALESCE(source.{column}, target.{column})" for column in label_columns)
+        cursor.execute(f"""
+            MERGE INTO {table} AS target
+            USING (
+                SELECT * FROM VALUES {values} AS v({', '.join(columns)}, delta)
+            ) AS source
+            ON {' AND '.join(f'target.{column} = source.{column}' for column in key_columns)}
+            WHEN MATCHED AND target.engagements + source.delta <= 0 THEN DELETE
+            WHEN MATCHED THEN UPDATE SET {', '.join(updates)}
+            WHEN NOT MATCHED AND source.delta > 0 THEN INSERT ({', '.join(columns)}, engagements)
+                VALUES ({', '.join(f'source.{column}' for column in columns)}, source.delta)
+        """, parameters)
+
+    def _replace_search_postings(self, cursor, keys, postings):
+        """Replace the index rows with INSERT ... REPLACE WHERE, passing all postings as one JSON parameter"""
+        key_parameters = {f"key_{i}": key for i, key in enumerate(keys)}
+        # 1件の案件でも数百語になるため、行ごとのパラメータではなくJSON配列1つで渡してサーバー側で展開する
+        cursor.execute(f"""
+            INSERT INTO {self.full_table_name}_search_index (term, engagement_id, tf)
+            REPLACE WHERE engagement_id IN ({', '.join(f':{name}' for name in key_parameters)})
+            SELECT posting.term, posting.engagement_id, posting.tf
+            FROM (
+                SELECT explode(from_json(:postings, 'ARRAY<STRUCT<term: STRING, engagement_id: STRING, tf: INT>>')) AS posting
+            )
+        """, dict(key_parameters, postings=json.dumps(postings, ensure_ascii=False)))
+
+    def _replace_rows(self, cursor, table, key_column, keys, rows, array_columns=()):
+        """Replace the rows with INSERT ... REPLACE WHERE, deleting and inserting in one commit"""
+        key_parameters = {f"key_{i}": key for i, key in enumerate(keys)}
+        key_list = ", ".join(f":{name}" for name in key_parameters)
+        if not rows:
+            cursor.execute(f"DELETE FROM {table} WHERE {key_column} IN ({key_list})", key_parameters)
+            return
+
+        # REPLACE WHERE は列リストを取らないため、テーブルの列順に並べて選択する（行にない列は NULL）
+        columns = list(rows[0].keys())
+        values, parameters = self._values_clause(rows, columns, array_columns)
+        parameters.update(key_parameters)
+        selected = [f"source.{column}" if column in columns else "NULL" for column in self._table_columns(cursor, table)]
+        cursor.execute(f"""
+            INSERT INTO {table}
+            REPLACE WHERE {key_column} IN ({key_list})
+            SELECT {', '.join(selected)}
+            FROM VALUES {values} AS source({', '.join(columns)})
+        """, parameters)
+
+
+    def table_stats(self):
+        """Read the file count and size of each table from DESCRIBE DETAIL"""
+        stats = []
+        with self._cursor() as cursor:
+            for table in self.maintained_tables:
+                cursor.execute(f"DESCRIBE DETAIL {table}")
+                columns = [col[0] for col in cursor.description]
+                detail = dict(zip(columns, cursor.fetchone()))
+                stats.append({"table": table, "files": detail["numFiles"], "bytes": detail["sizeInBytes"]})
+        return stats
+
+    def purge_deleted_rows(self):
+        """Rewrite the files that carry deletion vectors so that deleted rows are dropped"""
+        with self._cursor() as cursor:
+            for table in self.maintained_tables:
+                cursor.execute(f"REORG TABLE {table} APPLY (PURGE)")
+
+    def optimize_tables(self):
+        """Run OPTIMIZE, which also applies each table's clustering keys"""
+        with self._cursor() as cursor:
+            for table in self.maintained_tables:
+                cursor.execute(f"OPTIMIZE {table}")
+
+    def vacuum_tables(self, retention_hours):
+        """Run VACUUM with the given retention"""
+        with self._cursor() as cursor:
+            for table in self.maintained_tables:
+                cursor.execute(f"VACUUM {table} RETAIN {int(retention_hours)} HOURS")
+
+
+# SQLiteの日時型は文字列で保存し、宣言型（TIMESTAMP / DATE）に応じて読み込み時に変換する
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", timespec="microseconds"))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+
+class LocalHistoryStore(HistoryStore):
+    """History store backed by a local SQLite file
+
+    Works without a warehouse, e.g. for field reps working offline or
+    for load tests and benchmarks.
+    """
+    migrations = LOCAL_SCHEMA_MIGRATIONS
+    aggregate_rebuild_statements = LOCAL_AGGREGATE_REBUILD_STATEMENTS
+    version_table_ddl = """
+        CREATE TABLE IF NOT EXISTS {version_table} (
+            table_name TEXT,
+            version INTEGER,
+            description TEXT,
+            applied_at TIMESTAMP
+        )
+    """
+
+    def __init__(self, config):
+        """Initialize the LocalHistoryStore"""
+        storage_config = config.get("STORAGE", {})
+        self.path = os.environ.get("LOCAL_HISTORY_PATH", storage_config.get("LOCAL_PATH", "discoverydojo_history.db"))
+        self.schema_prefix = "main"
+        self.table_name = config["DELTA_TABLE"]["TABLE_NAME"]
+        self.full_table_name = self.table_name
+        self.version_table_name = config["DELTA_TABLE"].get("SCHEMA_VERSION_TABLE", "migration_tool_schema_version")
+        super().__init__(config, f"{os.path.abspath(self.path)}:{self.table_name}")
+
+    @property
+    def available(self):
+        return self.path is not None
+
+    def _init_connection(self):
+        """Open the database file once to check it is writable"""
+        try:
+            connection = sqlite3.connect(self.path)
+            try:
+                # 保存キューのワーカーと画面の読み込みが互いにブロックしないようWALにする
+                connection.execute("PRAGMA journal_mode=WAL")
+            finally:
+                connection.close()
+        except Exception as e:
+            st.error(f"ローカル履歴データベースへの接続エラー: {e}")
+            self.path = None
+
+    @contextmanager
+    def _cursor(self):
+        """Open a connection and yield a cursor; the block is committed as one transaction"""
+        connection = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            cursor = InstrumentedCursor(connection.cursor(), self.query_stats)
+            try:
+                yield cursor
+            finally:
+                cursor.finish()
+                cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def _upsert_records(self, cursor, rows, insert_defaults=None):
+        """Insert or update the history rows with INSERT ... ON CONFLICT"""
+        insert_defaults = insert_defaults or {}
+        columns = list(rows[0].keys())
+        insert_columns = columns + list(insert_defaults.keys())
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id")
+
+        cursor.executemany(f"""
+            INSERT INTO {self.full_table_name} ({', '.join(insert_columns)})
+            VALUES ({', '.join(f':{column}' for column in insert_columns)})
+            ON CONFLICT (id) DO UPDATE SET {updates}
+        """, [dict(row, **insert_defaults) for row in rows])
+
+    def _swap_record(self, cursor, row, base_seq, insert_defaults=None):
+        """Compare-and-swap the row with a conditional ON CONFLICT update and check its row count"""
+        insert_defaults = insert_defaults or {}
+        columns = list(row.keys())
+        insert_columns = columns + list(insert_defaults.keys())
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id")
+
+        # 最初の書き込みで書き込みロックを取るため、同じ行への並行した保存はトランザクション単位で直列化される
+        cursor.execute(f"""
+            INSERT INTO {self.full_table_name} ({', '.join(insert_columns)})
+            VALUES ({', '.join(f':{column}' for column in insert_columns)})
+            ON CONFLICT (id) DO UPDATE SET {updates}
+            WHERE COALESCE({self.full_table_name}.head_seq, 0) = :base_seq
+                OR {self.full_table_name}.write_id = excluded.write_id
+        """, dict(row, base_seq=base_seq, **insert_defaults))
+        return cursor.rowcount > 0
+
+    def _insert_rows(self, cursor, table, rows):
+        """Insert the rows with executemany"""
+        columns = list(rows[0].keys())
+        cursor.executemany(f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join(f':{column}' for column in columns)})
+        """, rows)
+
+    def _upsert_snapshots(self, cursor, rows):
+        """Insert the snapshots, overwriting any with the same (state_id, seq)"""
+        cursor.executemany(f"""
+            INSERT INTO {self.full_table_name}_snapshots (state_id, seq, state_blob, created_at)
+            VALUES (:state_id, :seq, :state_blob, :created_at)
+            ON CONFLICT (state_id, seq) DO UPDATE SET
+                state_blob = excluded.state_blob, state_json = NULL, created_at = excluded.created_at
+        """, rows)
+
+    def _append_events(self, cursor, state_id, events):
+        """Append events, ignoring those whose (state_id, seq) already exists"""
+        cursor.executemany(f"""
+            INSERT OR IGNORE INTO {self.full_table_name}_events (state_id, seq, event_type, payload, created_at)
+            VALUES (:state_id, :seq, :event_type, :payload, :created_at)
+        """, [{
+            "state_id": state_id,
+            "seq": event["seq"],
+            "event_type": event["type"],
+            "payload": json.dumps(event["payload"], ensure_ascii=False),
+            "created_at": datetime.fromisoformat(event["created_at"])
+        } for event in events])
+
+    def _apply_aggregate_deltas(self, cursor, table, key_columns, rows, label_columns=()):
+        """Apply the deltas with INSERT ... ON CONFLICT, then drop keys that reached zero"""
+        columns = list(key_columns) + list(label_columns)
+        updates = ["engagements = engagements + excluded.engagements"]
+        updates.extend(f"{column} = COALESCE(excluded.{column}, {column})" for column in label_columns)
+        cursor.executemany(f"""
+            INSERT INTO {table} ({', '.join(columns)}, engagements)
+            VALUES ({', '.join(f':{column}' for column in columns)}, :delta)
+            ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {', '.join(updates)}
+        """, rows)
+        cursor.execute(f"DELETE FROM {table} WHERE engagements <= 0")
+
+    def _replace_rows(self, cursor, table, key_column, keys, rows, array_columns=()):
+        """Replace the rows with DELETE + INSERT inside the surrounding transaction"""
+        key_parameters = {f"key_{i}": key for i, key in enumerate(keys)}
+        cursor.execute(f"""
+            DELETE FROM {table}
+            WHERE {key_column} IN ({', '.join(f':{name}' for name in key_parameters)})
+        """, key_parameters)
+        if rows:
+            # 配列列はJSON文字列のまま保存する（json_each() で展開できる）
+            self._insert_rows(cursor, table, rows)
+
+    def table_stats(self):
+        """Read the size of each table's B-tree from the dbstat virtual table"""
+        tables = self.maintained_tables
+        with self._cursor() as cursor:
+            cursor.execute(f"""
+                SELECT name, SUM(pgsize)
+                FROM dbstat
+                WHERE name IN ({', '.join(f':table_{i}' for i in range(len(tables)))})
+                GROUP BY name
+            """, {f"table_{i}": table for i, table in enumerate(tables)})
+            sizes = dict(cursor.fetchall())
+        return [{"table": table, "files": None, "bytes": sizes.get(table, 0)} for table in tables]
+
+    def purge_deleted_rows(self):
+        """Nothing to do: pages freed by deletes are reused, and returned to the file system by VACUUM"""
+
+    def optimize_tables(self):
+        """Refresh the query planner statistics"""
+        with self._cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def vacuum_tables(self, retention_hours):
+        """Rebuild the database file and truncate the WAL; SQLite keeps no history, so retention does not apply"""
+        with self._cursor() as cursor:
+            cursor.execute("VACUUM")
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def create_history_store(config):
+    """Create the history store selected by STORAGE.BACKEND ("delta" or "local")"""
+    backend = os.environ.get("STORAGE_BACKEND", config.get("STORAGE", {}).get("BACKEND", "delta"))
+    if backend == "local":
+        return LocalHistoryStore(config)
+    if backend == "delta":
+        return DeltaTableManager(config)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+# AI Model Service
+# まとめの内容を決める状態の項目。これ以外（画面の位置など）が変わってもまとめは作り直さない
+SUMMARY_STATE_FIELDS = ("customer_info", "platform_data", "project_data", "next_actions")
+
+
+class SummaryCache:
+    """Process-wide LRU of generated summaries, keyed by a digest of their inputs"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        # key -> summary。最近使ったものほど末尾に並ぶ
+        self._summaries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, inputs):
+        """Digest of the summary kind and the JSON-serializable inputs it is generated from"""
+        payload = json.dumps([kind, inputs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached summary for key, or None"""
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self.misses += 1
                 return None
-        except Exception as e:
-            st.error(f"状態の取得エラー: {e}")
-            return None
-    
-    def delete_history(self, state_id):
-        """Delete history record by ID"""
-        if not self.connection:
-            return False
-            
+            self._summaries.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def put(self, key, summary):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._summaries)
+
+
+@st.cache_resource(show_spinner=False)
+def get_summary_cache(max_entries):
+    """Get the summary cache shared by all sessions"""
+    return SummaryCache(max_entries=max_entries)
+
+
+class LocalStubDeployClient:
+    """Offline stand-in for a chat serving endpoint, with the predict / predict_stream interface of mlflow.deployments clients
+
+    Echoes the last user message, so a summary prompt streams back the
+    template summary it was built from. The delays mimic the time to
+    first token and the pace of a real endpoint.
+    """
+
+    def __init__(self, first_token_delay=0.5, token_interval=0.02, chunk_chars=8):
+        self.first_token_delay = first_token_delay
+        self.token_interval = token_interval
+        self.chunk_chars = chunk_chars
+
+    @staticmethod
+    def _answer(inputs):
+        messages = (inputs or {}).get("messages", [])
+        prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        return f"（ローカルスタブの応答）\n{prompt}"
+
+    def predict(self, deployment_name=None, inputs=None, endpoint=None):
+        time.sleep(self.first_token_delay)
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": self._answer(inputs)},
+                             "finish_reason": "stop"}]}
+
+    def predict_stream(self, deployment_name=None, inputs=None, endpoint=None):
+        answer = self._answer(inputs)
+        time.sleep(self.first_token_delay)
+        for start in range(0, len(answer), self.chunk_chars):
+            if start:
+                time.sleep(self.token_interval)
+            yield {"choices": [{"index": 0, "delta": {"content": answer[start:start + self.chunk_chars]},
+                                "finish_reason": None}]}
+
+
+@st.cache_resource(show_spinner=False)
+def get_summary_client(target, stub_first_token_delay, stub_token_interval):
+    """The mlflow.deployments client for the summary endpoint; "stub" gives the local stand-in"""
+    if target == "stub":
+        return LocalStubDeployClient(first_token_delay=stub_first_token_delay, token_interval=stub_token_interval)
+    return mlflow.deployments.get_deploy_client(target)
+
+
+class TimedStream:
+    """Iterate produce() on a background thread that starts as soon as the stream is created
+
+    Iterating raises TimeoutError if the first item arrives later than
+    first_item_timeout or the whole stream later than total_timeout
+    (seconds), both counted from creation, so several streams can be
+    opened at once and read one after another. Once the stream is closed
+    or the consumer gives up, the producer stops at its next item.
+    """
+
+    def __init__(self, produce, first_item_timeout, total_timeout):
+        self._produce = produce
+        self._items = queue.Queue()
+        self._cancelled = threading.Event()
+        started = time.monotonic()
+        self._deadline = started + total_timeout
+        self._first_deadline = min(started + first_item_timeout, self._deadline)
+        threading.Thread(target=self._run, name="summary-stream", daemon=True).start()
+
+    def _run(self):
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute(f"""
-                    DELETE FROM {self.full_table_name}
-                    WHERE id = '{state_id}'
-                """)
-            return True
+            for item in self._produce():
+                if self._cancelled.is_set():
+                    return
+                self._items.put((True, item))
+            self._items.put((False, None))
         except Exception as e:
-            st.error(f"履歴の削除エラー: {e}")
-            return False
+            self._items.put((False, e))
+
+    def __iter__(self):
+        first = True
+        try:
+            while True:
+                timeout = (self._first_deadline if first else self._deadline) - time.monotonic()
+                try:
+                    more, item = self._items.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    raise TimeoutError(f"{'最初の応答' if first else '応答全体'}が制限時間内に届きませんでした")
+                if not more:
+                    if item is not None:
+                        raise item
+                    return
+                first = False
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._cancelled.set()
+
 
-# AI Model Service
 class AIModelService:
-    def __init__(self):
-        # Initialize the Databricks model deployment
-        # In a real application, we would connect to the actual model
-        # For this example, we'll use a mock implementation
-        pass
+    def __init__(self, config=None):
+        # まとめは定型文（template）か、サービングエンドポイントのLLM（llm）で作る
+        self.summary_config = (config or CONFIG).get("SUMMARY", {})
+        self.summary_mode = os.environ.get("SUMMARY_MODE", self.summary_config.get("MODE", "template"))
+        # 直近のストリーミング生成の所要時間（最初のトークンまで・全体、秒）
+        self.last_summary_timings = None
+        # 同じ内容のまとめはセッションをまたいで使い回す
+        self.summary_cache = get_summary_cache(self.summary_config.get("CACHE_MAX_ENTRIES", 256))
+
+    @property
+    def llm_enabled(self):
+        return self.summary_mode == "llm"
     
     def generate_deep_dive_question(self, stack_component, issues):
         """Generate deep dive question based on stack component and issues"""
         # 基本的な質問を取得
-        base_question = DEEPDIVE_QUESTIONS.get(
+        base_question = CATALOG.deepdive_question(
             stack_component, 
             "この技術スタックについて、現在どのような具体的な課題に直面していますか？"
         )
@@ -353,8 +3791,9 @@ class AIModelService:
         issue_specific_questions = ""
         if issues:
             for issue in issues:
-                if issue in ISSUE_SPECIFIC_QUESTIONS:
-                    issue_specific_questions += ISSUE_SPECIFIC_QUESTIONS[issue] + " "
+                question = CATALOG.issue_question(issue)
+                if question:
+                    issue_specific_questions += question + " "
         
         if issue_specific_questions:
             return base_question + " " + issue_specific_questions
@@ -362,18 +3801,64 @@ class AIModelService:
     
     def generate_summary(self, state: Dict[str, Any]) -> str:
         """Generate a summary of all collected information"""
-        # In a real application, this would call a deployed LLM
-        # For this example, we'll create a formatted text summary
-        
+        return "".join(text for text, _ in self.summary_sections(state))
+
+    def summary_sections(self, state):
+        """Yield the summary document of state as (text, rewrite) pieces in order
+
+        Each section is cached under a digest of the state slice it reads,
+        so an edit only rebuilds the sections it touches. rewrite is False
+        for headings and text derived from other sections, which the LLM
+        summary passes through unchanged.
+        """
         customer_info = state.get("customer_info", {})
         platform_data = state.get("platform_data", {})
         project_data = state.get("project_data", {})
         next_actions = state.get("next_actions", [])
-        
-        summary = f"""
-## DiscoveryDojo調査サマリー
 
-### 記入者情報
+        yield "\n## DiscoveryDojo調査サマリー\n\n", False
+        yield self._cached_section(
+            "customer_info", customer_info, lambda: self._customer_section(customer_info)
+        ), True
+        yield "### 現在の技術スタック状況\n", False
+
+        # Group the summary by cloud
+        all_components = set()
+        included_components = set()
+        for cloud, stacks in platform_data.items():
+            if not stacks:
+                continue
+            text, components, included = self._cached_section(
+                "platform_data", [cloud, stacks], lambda: self._cloud_section(cloud, stacks)
+            )
+            all_components |= components
+            included_components |= included
+            yield text, True
+
+        # Check for any components that weren't included
+        if all_components - included_components:
+            missing = list(all_components - included_components)
+            yield f"\n**注意: 次のコンポーネントについては情報が不完全です: {', '.join(missing)}**\n", False
+
+        yield self._cached_section("project_data", project_data, lambda: self._project_section(project_data)), True
+        yield self._cached_section(
+            "next_actions", next_actions, lambda: self._next_actions_section(next_actions)
+        ), True
+        yield self._cached_section(
+            "recommendations", sorted(all_components), lambda: self._recommendations_section(all_components)
+        ), False
+
+    def _cached_section(self, kind, inputs, build):
+        """Return build(), cached under a digest of kind and the state slice it reads"""
+        key = SummaryCache.key(kind, inputs)
+        section = self.summary_cache.get(key)
+        if section is None:
+            section = build()
+            self.summary_cache.put(key, section)
+        return section
+
+    def _customer_section(self, customer_info):
+        return f"""### 記入者情報
 - 面談日: {customer_info.get('meeting_date', '不明')}
 - 記入者: {customer_info.get('writer', '不明')}
 
@@ -384,91 +3869,81 @@ class AIModelService:
 - ペルソナ: {customer_info.get('persona', '不明')}
 - 関心領域: {customer_info.get('interest', '不明')}
 
-### 現在の技術スタック状況
 """
-        
-        # Collect all components across all clouds for better organization in summary
-        all_components = set()
-        for cloud, stacks in platform_data.items():
-            for stack in stacks:
-                if isinstance(stack, dict) and "component" in stack:
-                    all_components.add(stack.get("component", ""))
-        
-        # Track which components have been included in the summary
+
+    def _cloud_section(self, cloud, stacks):
+        """Return the stack section of one cloud with the components it mentions and those it describes"""
+        lines = [f"\n#### {cloud}\n"]
+        components = set()
         included_components = set()
-                
-        # Group the summary by cloud
-        for cloud, stacks in platform_data.items():
-            if stacks:
-                summary += f"\n#### {cloud}\n"
-                for stack in stacks:
-                    if not isinstance(stack, dict):
-                        continue
-                        
-                    component = stack.get("component", "")
-                    if not component:
-                        continue
-                        
-                    product = stack.get("product", "")
-                    cost = stack.get("cost", "不明")
-                    issues = stack.get("issues", [])
-                    details = stack.get("details", "")
-                    
-                    summary += f"- **{component}**: {product}\n"
-                    if cost:
-                        summary += f"  - 月間コスト: {cost}円\n"
-                    if issues:
-                        summary += f"  - 課題: {', '.join(issues)}\n"
-                    if details:
-                        summary += f"  - 詳細情報: {details}\n"
-                    
-                    included_components.add(component)
-        
-        # Check for any components that weren't included
-        if all_components - included_components:
-            missing = list(all_components - included_components)
-            summary += f"\n**注意: 次のコンポーネントについては情報が不完全です: {', '.join(missing)}**\n"
-        
+        for stack in stacks:
+            if not isinstance(stack, dict):
+                continue
+            if "component" in stack:
+                components.add(stack.get("component", ""))
+
+            component = stack.get("component", "")
+            if not component:
+                continue
+
+            product = stack.get("product", "")
+            cost = stack.get("cost", "不明")
+            issues = stack.get("issues", [])
+            details = stack.get("details", "")
+
+            lines.append(f"- **{component}**: {product}\n")
+            if cost:
+                lines.append(f"  - 月間コスト: {cost}円\n")
+            if issues:
+                lines.append(f"  - 課題: {', '.join(issues)}\n")
+            if details:
+                lines.append(f"  - 詳細情報: {details}\n")
+
+            included_components.add(component)
+        return "".join(lines), frozenset(components), frozenset(included_components)
+
+    def _project_section(self, project_data):
         # Add project information - 改善版
-        project_section = "\n### プロジェクト情報\n"
+        # 行はリストにためて最後に1回だけ結合する
+        lines = ["\n### プロジェクト情報\n"]
         
         # 1. 予算情報
         budget = project_data.get('budget', '未定')
-        project_section += f"- **予算**: {budget}\n"
+        lines.append(f"- **予算**: {budget}\n")
         
         # 2. 最終意思決定者の情報 - 構造化
         if project_data.get('authority_option') == "どなたか別の方のご意向にも影響を受ける" and project_data.get('authority_position') and project_data.get('authority_name'):
-            project_section += f"- **最終意思決定者**: 別の方の影響あり\n"
-            project_section += f"  - 役職: {project_data.get('authority_position', '不明')}\n"
-            project_section += f"  - 氏名: {project_data.get('authority_name', '不明')}\n"
+            lines.append("- **最終意思決定者**: 別の方の影響あり\n")
+            lines.append(f"  - 役職: {project_data.get('authority_position', '不明')}\n")
+            lines.append(f"  - 氏名: {project_data.get('authority_name', '不明')}\n")
         else:
-            project_section += f"- **最終意思決定者**: {project_data.get('authority', '未定')}\n"
+            lines.append(f"- **最終意思決定者**: {project_data.get('authority', '未定')}\n")
         
         # 3. 課題（ニーズ）
         need = project_data.get('need', '未定')
         if need:
-            project_section += f"- **課題（ニーズ）**: {need}\n"
+            lines.append(f"- **課題（ニーズ）**: {need}\n")
         
         # 4. 比較製品の情報 - リスト形式
         if project_data.get('competition_option') == "すでに他のサービスを比較予定 or 今後比較する予定がある" and project_data.get('competition_products'):
-            project_section += f"- **比較製品**:\n"
+            lines.append("- **比較製品**:\n")
             for product in project_data.get('competition_products', []):
                 if product:  # 空の項目はスキップ
-                    project_section += f"  - {product}\n"
+                    lines.append(f"  - {product}\n")
         else:
-            project_section += f"- **比較状況**: {project_data.get('competition', '未定')}\n"
+            lines.append(f"- **比較状況**: {project_data.get('competition', '未定')}\n")
         
         # 5. 選定基準
         criteria = project_data.get('decision_criteria', '未定')
-        project_section += f"- **選定基準**: {criteria}\n"
+        lines.append(f"- **選定基準**: {criteria}\n")
         
         # 6. 意思決定プロセス
         process = project_data.get('decision_process', '未定')
-        project_section += f"- **意思決定プロセス**: {process}\n"
+        lines.append(f"- **意思決定プロセス**: {process}\n")
         
         # 7. 導入時期（スケジュール）- タイムライン形式
         if project_data.get('timeframe_option') == "データ基盤構築・移行の具体的なスケジュールがある" and project_data.get('timeline_events'):
-            project_section += f"- **導入スケジュール**:\n"
+            lines.append("- **導入スケジュール**:\n")
             
             # タイムラインイベントを日付でソート
             events = project_data.get('timeline_events', [])
@@ -485,25 +3960,27 @@ class AIModelService:
             for month, month_events in groupby(sorted_events, key=lambda x: x.get('month')):
                 month_events_sorted = sorted(list(month_events), key=lambda x: timing_order.get(x.get('timing', '初旬'), 0))
                 for event in month_events_sorted:
-                    project_section += f"  - {event.get('month', '')}月{event.get('timing', '')}: {event.get('event', '')}\n"
+                    lines.append(f"  - {event.get('month', '')}月{event.get('timing', '')}: {event.get('event', '')}\n")
         else:
-            project_section += f"- **導入時期**: {project_data.get('timeframe', '未定')}\n"
+            lines.append(f"- **導入時期**: {project_data.get('timeframe', '未定')}\n")
         
         # 8. 商談情報補足
         additional_info = project_data.get('additional_info')
         if additional_info:
-            project_section += f"- **補足情報**: {additional_info}\n"
+            lines.append(f"- **補足情報**: {additional_info}\n")
         
-        summary += project_section
-        
-        # Add next actions
-        summary += f"""
+        return "".join(lines)
+
+    def _next_actions_section(self, next_actions):
+        return f"""
 ### 次のアクション
 {', '.join(next_actions) if next_actions else '未定'}
 """
 
+    def _recommendations_section(self, all_components):
+        """Suggest Databricks features for the components found in the stack"""
         # Generate Databricks recommendations based on components found
-        summary += f"""
+        heading = """
 ### Databricks役立つ機能の仮説
 現在の技術スタックおよび課題を考慮すると、以下のDatabricks機能が特に有効と考えられます：
 """
@@ -532,15 +4009,123 @@ class AIModelService:
         recommendations.append("**Databricks Lakehouse Platform** - データレイクとデータウェアハウスの統合により、データサイロを排除し、分析と機械学習のためのデータ準備を効率化します。")
         
         # Add numbered recommendations
-        for i, rec in enumerate(recommendations, 1):
-            summary += f"\n{i}. {rec}"
-        
-        return summary
-    
+        return heading + "".join(f"\n{i}. {rec}" for i, rec in enumerate(recommendations, 1))
+
+    def _llm_settings(self):
+        return {
+            name: self.summary_config.get(name)
+            for name in ["DEPLOYMENT_TARGET", "ENDPOINT", "MAX_TOKENS", "TEMPERATURE", "SYSTEM_PROMPT"]
+        }
+
+    def llm_summary_key(self, state):
+        """Cache key of the whole LLM summary of state, covering the generation settings"""
+        inputs = {field: state.get(field) for field in SUMMARY_STATE_FIELDS}
+        inputs["settings"] = self._llm_settings()
+        return SummaryCache.key("llm", inputs)
+
+    def summary_messages(self, section):
+        """Build the chat messages asking the LLM to rewrite one section of the template summary"""
+        return [
+            {"role": "system", "content": self.summary_config.get("SYSTEM_PROMPT", "")},
+            {"role": "user", "content": section}
+        ]
+
+    def _completion_chunks(self, client, section):
+        endpoint = self.summary_config.get("ENDPOINT")
+        inputs = {
+            "messages": self.summary_messages(section),
+            "max_tokens": self.summary_config.get("MAX_TOKENS", 1500),
+            "temperature": self.summary_config.get("TEMPERATURE", 0.2)
+        }
+        try:
+            chunks = client.predict_stream(endpoint=endpoint, inputs=inputs)
+        except (AttributeError, NotImplementedError):
+            # ストリーミングに対応していないクライアントでは全文をまとめて受け取る
+            yield client.predict(endpoint=endpoint, inputs=inputs)["choices"][0]["message"]["content"]
+            return
+        for chunk in chunks:
+            choices = chunk.get("choices") or [{}]
+            text = (choices[0].get("delta") or {}).get("content")
+            if text:
+                yield text
+
+    def _summary_chunks(self, state, deadline):
+        """Yield the LLM summary of state as (text, from_endpoint) pieces in document order
+
+        Rewritten sections are cached by content. Every section that is
+        not cached is requested from the endpoint before the first one is
+        read, so their round trips overlap instead of running one after
+        another; later sections buffer while the earlier ones stream.
+        """
+        client = None
+        pieces = []
+        streams = []
+        try:
+            for text, rewrite in self.summary_sections(state):
+                if not rewrite:
+                    pieces.append((text, None, None))
+                    continue
+                # 書き直した結果はセクションの内容ごとにキャッシュし、変更のあったセクションだけ問い合わせる
+                key = SummaryCache.key("llm_section", {"section": text, "settings": self._llm_settings()})
+                section = self.summary_cache.get(key)
+                if section is not None:
+                    pieces.append((section + "\n\n", None, None))
+                    continue
+                if client is None:
+                    client = get_summary_client(
+                        self.summary_config.get("DEPLOYMENT_TARGET", "databricks"),
+                        self.summary_config.get("STUB_FIRST_TOKEN_DELAY_SECONDS", 0.5),
+                        self.summary_config.get("STUB_TOKEN_INTERVAL_SECONDS", 0.02)
+                    )
+                stream = TimedStream(
+                    functools.partial(self._completion_chunks, client, text),
+                    self.summary_config.get("FIRST_TOKEN_TIMEOUT_SECONDS", 15),
+                    deadline - time.monotonic()
+                )
+                streams.append(stream)
+                pieces.append((None, key, stream))
+
+            for text, key, stream in pieces:
+                if stream is None:
+                    yield text, False
+                    continue
+                parts = []
+                for part in stream:
+                    parts.append(part)
+                    yield part, True
+                if not parts:
+                    raise ValueError("エンドポイントから空の応答が返りました")
+                self.summary_cache.put(key, "".join(parts))
+                yield "\n\n", False
+        finally:
+            # 途中で失敗・中断した場合も、先に問い合わせた残りのセクションを止める
+            for stream in streams:
+                stream.close()
+
+    def stream_summary(self, state):
+        """Yield the LLM summary of state as text chunks as they arrive
+
+        Sections rewritten before are replayed from the cache; the others
+        are streamed from the endpoint. Raises TimeoutError when a section's
+        first chunk or the whole answer is later than the configured limits,
+        and whatever the endpoint raises; callers fall back to
+        generate_summary. last_summary_timings holds the seconds to the
+        first chunk from the endpoint (None if every section was cached)
+        and to the end.
+        """
+        start = time.monotonic()
+        first_token = None
+        for text, from_endpoint in self._summary_chunks(state, start + self.summary_config.get("TOTAL_TIMEOUT_SECONDS", 90)):
+            # 見出しなどの定型文やキャッシュ済みのセクションはすぐに出るため、エンドポイントの最初の応答から計る
+            if from_endpoint and first_token is None:
+                first_token = time.monotonic() - start
+            yield text
+        self.last_summary_timings = (first_token, time.monotonic() - start)
+
     def _generate_databricks_points(self, component, issues):
         """Generate points where Databricks can contribute to solving the issues"""
         # 基本的な貢献ポイントを取得
-        base_points = DATABRICKS_CONTRIBUTIONS.get(
+        base_points = CATALOG.contribution(
             component, 
             "- **Databricks Lakehouse Platform**: データレイクとデータウェアハウスの統合により、データの一元管理と効率的な処理を実現"
         )
@@ -549,8 +4134,9 @@ class AIModelService:
         issue_specific_points = ""
         if issues:
             for issue in issues:
-                if issue in ISSUE_SPECIFIC_CONTRIBUTIONS:
-                    issue_specific_points += ISSUE_SPECIFIC_CONTRIBUTIONS[issue] + "\n"
+                point = CATALOG.issue_contribution(issue)
+                if point:
+                    issue_specific_points += point + "\n"
         
         if issue_specific_points:
             return base_points + "\n\n### 課題に対する特定の貢献ポイント\n" + issue_specific_points
@@ -581,7 +4167,8 @@ class MigrationToolUI:
                     'platform_discovery': False,
                     'project_data': False,
                     'next_actions': False,
-                    'summary': False
+                    'summary': False,
+                    'analytics': False
                 }
             
             # Navigation buttons
@@ -603,18 +4190,70 @@ class MigrationToolUI:
             if st.button("📝 まとめ"):
                 self._show_section('summary')
             
+            if st.button("📈 分析"):
+                self._show_section('analytics')
+            
             st.divider()
             
+            # 履歴ストレージの状態（起動直後はバックグラウンドでウェアハウスを起動している）
+            if self.delta_manager and self.delta_manager.available:
+                if self.delta_manager.degraded:
+                    st.caption("🔴 履歴ストレージ: 縮退モード")
+                elif not self.delta_manager.ready:
+                    st.caption("🟡 履歴ストレージ: 起動中")
+                else:
+                    st.caption("🟢 履歴ストレージ: 接続済み")
+            
             # 編集中の場合、履歴IDを表示
             if 'editing_history' in st.session_state and st.session_state.editing_history:
                 state_id = self.state_manager.get_id()
                 if state_id:
                     st.caption(f"編集中のID: {state_id}")
+                    self._render_save_status(state_id)
             
             st.caption("© shotkotani")
     
+    def _save_editing_state(self):
+        """Queue a background save of the history record being edited"""
+        if not st.session_state.get('editing_history'):
+            return
+        if not self.delta_manager or not self.delta_manager.save_queue:
+            return
+        if self.state_manager.get_id():
+            self.delta_manager.save_queue.enqueue(
+                self.state_manager.get_state(),
+                events=self.state_manager.drain_events(),
+                writer=self.state_manager.writer_id
+            )
+    
+    def _render_save_status(self, state_id):
+        """Show the background save status of a state"""
+        if not self.delta_manager or not self.delta_manager.save_queue:
+            return
+            
+        writer = self.state_manager.writer_id
+        status, error = self.delta_manager.save_queue.status(state_id, writer)
+        if status == SaveQueue.PENDING and self.delta_manager.degraded:
+            st.caption("📝 下書きとして保持中（接続の復旧後に保存されます）")
+        elif status == SaveQueue.PENDING:
+            st.caption("⏳ 保存待ち")
+        elif status == SaveQueue.SAVED:
+            st.caption("✅ 保存済み")
+        elif status == SaveQueue.FAILED:
+            st.caption(f"❌ 保存失敗: {error}")
+            if st.button("保存を再試行", key="retry_save"):
+                self.delta_manager.save_queue.retry(state_id, writer)
+                st.rerun()
+        elif status == SaveQueue.CONFLICT:
+            st.caption("⚠️ 他のユーザーが先に保存しました")
+            if st.button("変更を統合", key="resolve_conflict"):
+                self._show_section('merge_conflict')
+                st.rerun()
+    
     def _show_section(self, section):
         """Update session state to show the selected section"""
+        # 以前のバージョンで作られたセッションには新しい画面のキーがない
+        st.session_state.nav.setdefault(section, False)
         for key in st.session_state.nav:
             st.session_state.nav[key] = (key == section)
         st.session_state.current_section = section
@@ -630,61 +4269,95 @@ class MigrationToolUI:
         st.title("DiscoveryDojo")
         st.header("ヒアリング履歴")
         
-        # Delta Managerがない場合や接続できない場合
-        if not hasattr(self, 'delta_manager') or not self.delta_manager.connection:
-            st.warning("Delta Tableに接続できないため、履歴機能は利用できません。")
+        # 履歴ストアがない場合や接続できない場合
+        if not hasattr(self, 'delta_manager') or not self.delta_manager or not self.delta_manager.available:
+            st.warning("履歴ストレージに接続できないため、履歴機能は利用できません。")
             
             # 新規ヒアリングボタンのみ表示
-            if st.button("新規ヒアリングを開始", key="start_new_survey"):
-                # Reset state manager
-                self.state_manager.initialize()
-                # Navigate to customer info section
-                st.session_state.current_section = 'customer_info'
-                st.session_state.editing_history = False
-                st.rerun()
+            self._render_new_survey_button()
+            return
+        
+        # ウェアハウスの起動中は新規ヒアリングだけ先に始められるようにし、準備ができたら一覧を表示する
+        if not self._render_readiness("履歴"):
+            self._render_new_survey_button()
+            self._rerun_when_ready()
             return
             
-        # Get history list
-        history = self.delta_manager.get_history_list()
+        # 検索条件（SQL側で絞り込む）
+        with st.form("history_filter_form"):
+            keyword = st.text_input("キーワード（製品名・決裁者名・補足情報などの記入内容から検索）")
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                company = st.text_input("社名")
+            with col2:
+                recorder = st.text_input("記録者")
+            with col3:
+                date_from = st.date_input("記録日（から）", value=None)
+            with col4:
+                date_to = st.date_input("記録日（まで）", value=None)
+            
+            if st.form_submit_button("絞り込み"):
+                st.session_state.history_keyword = keyword.strip()
+                st.session_state.history_filters = {
+                    "company": company.strip() or None,
+                    "recorder": recorder.strip() or None,
+                    "date_from": date_from,
+                    "date_to": date_to
+                }
+                # 条件が変わったら先頭ページに戻る
+                st.session_state.history_page_cursors = [None]
+        
+        # ページごとの開始位置（直前ページ末尾の (record_date, id)）を積んでおく
+        if 'history_page_cursors' not in st.session_state:
+            st.session_state.history_page_cursors = [None]
+        filters = st.session_state.get('history_filters', {})
+        page_cursors = st.session_state.history_page_cursors
+        page_size = self.delta_manager.config["DELTA_TABLE"].get("HISTORY_PAGE_SIZE", 20)
+        keyword = st.session_state.get('history_keyword')
         
-        if not history:
-            st.info("履歴がありません。新規ヒアリングを開始してください。")
+        if keyword:
+            # キーワード検索では関連度順の上位のみを表示する（ページ送りなし）
+            results = self.delta_manager.search_history(
+                keyword,
+                limit=self.delta_manager.config["DELTA_TABLE"].get("SEARCH_RESULT_LIMIT", 50),
+                **filters
+            )
+            if not results:
+                st.info(f"「{keyword}」に一致する履歴がありません。")
+            else:
+                st.success(f"「{keyword}」に一致する履歴を関連度順に{len(results)}件表示しています。")
+                for item in results:
+                    self._render_history_card(item)
         else:
-            st.success(f"{len(history)}件のヒアリング履歴があります。")
+            # Get the visible page only
+            history, next_after = self.delta_manager.get_history_page(
+                page_size=page_size,
+                after=page_cursors[-1],
+                **filters
+            )
             
-            # Display each history item as a card
-            for item in history:
-                with st.container():
-                    col1, col2 = st.columns([3, 1])
-                    
-                    with col1:
-                        st.markdown(f"""
-                        <div class="history-card">
-                            <div class="history-title">{item['company']}</div>
-                            <div class="history-meta">
-                                記録日: {item['record_date']} | 
-                                記録者: {item['recorder']}
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    
-                    with col2:
-                        if st.button("編集", key=f"edit_{item['id']}"):
-                            # Load state from history
-                            state = self.delta_manager.get_state_by_id(item['id'])
-                            if state:
-                                # Set state in state manager
-                                self.state_manager.set_state(state)
-                                # Navigate to customer info section
-                                st.session_state.current_section = state.get("current_step", "customer_info")
-                                st.session_state.editing_history = True
-                                st.rerun()
-                        
-                        if st.button("削除", key=f"delete_{item['id']}"):
-                            # Confirm deletion
-                            if self.delta_manager.delete_history(item['id']):
-                                st.success("履歴を削除しました。")
-                                st.rerun()
+            if not history:
+                if len(page_cursors) > 1 or any(filters.values()):
+                    st.info("条件に一致する履歴がありません。")
+                else:
+                    st.info("履歴がありません。新規ヒアリングを開始してください。")
+            else:
+                st.success(f"{len(page_cursors)}ページ目: {len(history)}件のヒアリング履歴を表示しています。")
+                
+                # Display each history item as a card
+                for item in history:
+                    self._render_history_card(item)
+            
+            # Page navigation
+            col1, col2 = st.columns(2)
+            with col1:
+                if len(page_cursors) > 1 and st.button("← 前のページ", key="history_prev_page"):
+                    page_cursors.pop()
+                    st.rerun()
+            with col2:
+                if next_after and st.button("次のページ →", key="history_next_page"):
+                    page_cursors.append(next_after)
+                    st.rerun()
         
         # New survey button
         if st.button("新規ヒアリングを開始", key="start_new_survey"):
@@ -695,6 +4368,263 @@ class MigrationToolUI:
             st.session_state.editing_history = False
             st.rerun()
 
+    def _render_new_survey_button(self):
+        """Render the button that starts a new survey from a blank state"""
+        if st.button("新規ヒアリングを開始", key="start_new_survey"):
+            # Reset state manager
+            self.state_manager.initialize()
+            # Navigate to customer info section
+            st.session_state.current_section = 'customer_info'
+            st.session_state.editing_history = False
+            st.rerun()
+
+    def _render_readiness(self, content):
+        """Show a readiness indicator while the history store warms up; returns whether it is ready"""
+        if self.delta_manager.ready:
+            return True
+        warmup = self.delta_manager.warmup
+        st.info(f"⏳ SQL Warehouseを起動しています（{warmup.elapsed:.0f}秒経過）。準備ができ次第、{content}が表示されます。")
+        if warmup.error:
+            st.caption(f"直近の接続エラー: {warmup.error}")
+        return False
+
+    def _rerun_when_ready(self):
+        """Wait for the warm-up, then rerun so that the page fills in once the store is ready
+
+        The wait between reruns grows with the warm-up's failed attempts,
+        and after WARMUP_AUTO_RERUN_FAILURES of them the page stops
+        rerunning and offers a manual retry instead.
+        """
+        warmup = self.delta_manager.warmup
+        limit = CONFIG["DELTA_TABLE"].get("WARMUP_AUTO_RERUN_FAILURES", 5)
+        if warmup.failures >= limit:
+            # 認証情報やカタログの誤りなど、待っても直らない可能性が高いため自動の再実行をやめる
+            st.error(f"履歴ストレージの準備に{warmup.failures}回続けて失敗しました: {warmup.error}")
+            if st.button("再接続を試す", key="retry_warmup"):
+                warmup.retry_now()
+                st.rerun()
+            return
+        # 画面は描画済みのため、待っている間も表示は止まらない
+        timeout = min(2 * 2 ** warmup.failures, 30)
+        if self.delta_manager.wait_until_ready(timeout=timeout) or not self.delta_manager.degraded:
+            st.rerun()
+        # 縮退モード中は自動で再実行せず、復旧後の操作を待つ
+
+    def _render_history_card(self, item):
+        """Render one history record with its edit and delete buttons"""
+        with st.container():
+            col1, col2 = st.columns([3, 1])
+            
+            with col1:
+                st.markdown(f"""
+                <div class="history-card">
+                    <div class="history-title">{item['company']}</div>
+                    <div class="history-meta">
+                        記録日: {item['record_date']} | 
+                        記録者: {item['recorder']}
+                    </div>
+                </div>
+                """, unsafe_allow_html=True)
+            
+            with col2:
+                if st.button("編集", key=f"edit_{item['id']}"):
+                    # Load state from history
+                    state = self.delta_manager.get_state_by_id(item['id'])
+                    if state:
+                        # Set state in state manager
+                        self.state_manager.set_state(state)
+                        # Navigate to customer info section
+                        st.session_state.current_section = state.get("current_step", "customer_info")
+                        st.session_state.editing_history = True
+                        st.rerun()
+                
+                # 縮退中は一覧をキャッシュから表示しているため、削除はできない
+                if st.button("削除", key=f"delete_{item['id']}", disabled=self.delta_manager.degraded):
+                    # Confirm deletion
+                    if self.delta_manager.delete_history(item['id']):
+                        st.success("履歴を削除しました。")
+                        st.rerun()
+
+    @staticmethod
+    def _merge_field_label(path):
+        """Return a display label for a state_fields path"""
+        if path[0] == "customer_info":
+            return f"顧客基本情報: {path[1]}"
+        if path[0] == "platform_data":
+            return f"{path[1]}: {path[2]}"
+        if path[0] == "project_data":
+            return f"プロジェクト詳細: {path[1]}"
+        return "Next Action"
+
+    def render_merge_section(self):
+        """Render a field-level three-way merge of this session's edits with the newer saved version"""
+        st.header("変更の統合")
+        
+        state_id = self.state_manager.get_id()
+        writer = self.state_manager.writer_id
+        save_queue = self.delta_manager.save_queue if self.delta_manager else None
+        base_seq = save_queue.base_seq(state_id, writer) if save_queue and state_id else None
+        if base_seq is None:
+            st.info("統合が必要な変更はありません。")
+            return
+        
+        # 編集元のバージョン・最新の保存内容・このセッションの状態の3つを比較する
+        base = self.delta_manager.get_state_version(state_id, base_seq)
+        latest = self.delta_manager.get_state_by_id(state_id)
+        if base is None or latest is None:
+            st.error("保存済みの内容を読み込めませんでした。履歴が削除された可能性があります。")
+            return
+        mine = self.state_manager.get_state()
+        merged, conflicts = three_way_merge(base, mine, latest)
+        my_fields, their_fields = state_fields(mine), state_fields(latest)
+        
+        st.write(f"バージョン {base_seq} から編集している間に、他のユーザーがバージョン {latest['event_seq']} まで保存しました。"
+                 "片方だけが変更した項目はそのまま統合されます。")
+        if not conflicts:
+            st.success("競合する項目はありません。")
+        else:
+            st.warning(f"{len(conflicts)} 件の項目が両方で変更されています。採用する内容を選んでください。")
+        
+        for path in conflicts:
+            with st.expander(self._merge_field_label(path), expanded=True):
+                col1, col2 = st.columns(2)
+                for column, label, fields in [(col1, "あなたの変更", my_fields), (col2, "他のユーザーの変更", their_fields)]:
+                    with column:
+                        st.caption(label)
+                        if path in fields:
+                            st.code(json.dumps(fields[path], ensure_ascii=False, indent=2), language="json")
+                        else:
+                            st.caption("（削除）")
+                choice = st.radio("採用する内容", ["あなたの変更", "他のユーザーの変更"], horizontal=True,
+                                  key=f"merge_choice_{'_'.join(str(part) for part in path)}")
+                if choice == "あなたの変更":
+                    if path in my_fields:
+                        merged[path] = my_fields[path]
+                    else:
+                        merged.pop(path, None)
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("統合して保存", key="merge_save"):
+                # 最新の保存内容を起点に、統合結果との差分を新しいイベントとして記録し直す
+                save_queue.discard(state_id, writer)
+                self.state_manager.rebase(latest, state_from_fields(latest, merged))
+                save_queue.enqueue(self.state_manager.get_state(), events=self.state_manager.drain_events(), writer=writer)
+                self._show_section('summary')
+                st.rerun()
+        with col2:
+            if st.button("自分の変更を破棄", key="merge_discard"):
+                save_queue.discard(state_id, writer)
+                self.state_manager.set_state(latest)
+                self._show_section('summary')
+                st.rerun()
+
+    def render_analytics_section(self):
+        """Render the portfolio analytics across all saved engagements"""
+        st.title("DiscoveryDojo")
+        st.header("ポートフォリオ分析")
+        
+        if not self.delta_manager or not self.delta_manager.available:
+            st.warning("履歴ストレージに接続できないため、分析機能は利用できません。")
+            return
+        if not self._render_readiness("分析結果"):
+            self._rerun_when_ready()
+            return
+            
+        # 保存時に差分更新される集計テーブルを読むだけなので、案件数によらず高速に表示できる
+        analytics = self.delta_manager.get_analytics()
+        if analytics is None:
+            return
+            
+        st.metric("保存済みヒアリング件数", analytics["engagements"])
+        if not analytics["engagements"]:
+            st.info("まだ保存されたヒアリングがありません。")
+            return
+        
+        issues_tab, products_tab, next_actions_tab = st.tabs(["コンポーネント別の課題", "クラウド別の製品構成", "Next Action"])
+        
+        with issues_tab:
+            issues = pd.DataFrame(analytics["issues"], columns=["component", "issue", "engagements"])
+            recorded = set(issues["component"])
+            components = [component for component in CATALOG.components if component in recorded]
+            if not components:
+                st.info("課題が記録されたコンポーネントはまだありません。")
+            else:
+                component = st.selectbox("コンポーネント", components, key="analytics_component")
+                top_issues = issues[issues["component"] == component].nlargest(10, "engagements")
+                st.bar_chart(top_issues.set_index("issue")["engagements"])
+                
+                # 全コンポーネントの上位課題を一覧で表示
+                st.subheader("各コンポーネントで最も多い課題")
+                top_by_component = issues.sort_values("engagements", ascending=False).drop_duplicates("component")
+                st.dataframe(
+                    top_by_component.rename(columns={"component": "コンポーネント", "issue": "課題", "engagements": "件数"}),
+                    hide_index=True
+                )
+        
+        with products_tab:
+            products = pd.DataFrame(analytics["products"], columns=["cloud", "component", "product_id", "product", "engagements"])
+            # カタログにある製品は現在の正式名で表示する（別名で記録された案件も同じ行に数えられている）
+            products["product"] = [
+                (CATALOG.product_search.get(product_id) or {}).get("name", product)
+                for product_id, product in zip(products["product_id"], products["product"])
+            ]
+            clouds = [cloud for cloud in CLOUD_OPTIONS if cloud in set(products["cloud"])]
+            if not clouds:
+                st.info("製品が記録されたクラウドはまだありません。")
+            else:
+                cloud = st.selectbox("クラウド", clouds, key="analytics_cloud")
+                cloud_products = products[products["cloud"] == cloud]
+                st.bar_chart(cloud_products.groupby("product")["engagements"].sum().sort_values(ascending=False).head(15))
+                st.dataframe(
+                    cloud_products.sort_values(["component", "engagements"], ascending=[True, False])
+                    .drop(columns=["cloud", "product_id"])
+                    .rename(columns={"component": "コンポーネント", "product": "製品", "engagements": "件数"}),
+                    hide_index=True
+                )
+        
+        with next_actions_tab:
+            next_actions = pd.DataFrame(analytics["next_actions"], columns=["action", "engagements"])
+            if next_actions.empty:
+                st.info("Next Actionが記録されたヒアリングはまだありません。")
+            else:
+                # 選択肢の定義順に並べ、選ばれていない選択肢も0件として表示する
+                order = NEXT_ACTION_OPTIONS + [action for action in next_actions["action"] if action not in NEXT_ACTION_OPTIONS]
+                distribution = next_actions.set_index("action")["engagements"].reindex(order, fill_value=0)
+                st.bar_chart(distribution)
+                st.caption(f"全{analytics['engagements']}件のヒアリングのうち、各Next Actionが選ばれた件数")
+
+    def render_performance_view(self, trace):
+        """Show the statements issued by this rerun and the process-wide latency per operation"""
+        if not self.delta_manager or not self.delta_manager.available:
+            return
+        
+        with st.expander(f"⏱ パフォーマンス（この画面のSQL {len(trace)} 件・{sum(e['ms'] for e in trace):.0f} ms）", expanded=False):
+            if trace:
+                # 保存はバックグラウンドの保存キューで行われるため、ここには含まれない
+                st.dataframe(
+                    pd.DataFrame(trace, columns=["operation", "kind", "ms", "rows", "payload_bytes", "retries", "error", "statement"])
+                    .rename(columns={"operation": "操作", "kind": "種別", "rows": "行数", "payload_bytes": "状態サイズ(B)",
+                                     "retries": "再試行", "error": "エラー", "statement": "SQL"}),
+                    hide_index=True
+                )
+            else:
+                st.caption("この画面の表示ではSQLを実行していません（キャッシュから表示）。")
+            
+            stats = self.delta_manager.query_stats
+            histograms = stats.histograms()
+            if histograms:
+                st.caption(f"このプロセスの操作ごとの所要時間（直近{stats.window}件）")
+                bounds = [f"≤{bound}ms" for bound in stats.BUCKETS_MS] + [f">{stats.BUCKETS_MS[-1]}ms"]
+                st.dataframe(
+                    pd.DataFrame([
+                        {"操作": operation, "件数": summary["count"], "p50 ms": summary["p50_ms"],
+                         "p95 ms": summary["p95_ms"], "最大 ms": summary["max_ms"], **dict(zip(bounds, summary["buckets"]))}
+                        for operation, summary in histograms.items()
+                    ]),
+                    hide_index=True
+                )
+
     def render_customer_info_section(self):
         """Render the customer basic information section"""
         st.header("顧客基本情報の登録")
@@ -746,17 +4676,12 @@ class MigrationToolUI:
 
                 # ステートマネージャーを更新
                 self.state_manager.update_customer_info(customer_info)
+                self._save_editing_state()
                 
                 # ナビゲーションを更新
                 st.session_state.nav['platform_discovery'] = True
                 self._show_section('platform_discovery')
                 st.rerun()
-
-                # 編集モード時は状態を保存
-                if 'editing_history' in st.session_state and st.session_state.editing_history:
-                    state_id = self.state_manager.get_id()
-                    if state_id:
-                        self.delta_manager.save_state(self.state_manager.get_state())
                 
     def render_platform_discovery_section(self):
         """Render the platform discovery section with cloud tabs"""
@@ -797,7 +4722,7 @@ class MigrationToolUI:
         if 'platform_discovery' not in st.session_state:
             st.session_state.platform_discovery = {
                 'selected_components': {},
-                'highlighted_components': [],
+                'highlighted_components': frozenset(),
                 'selected_cloud': current_cloud
             }
         
@@ -805,8 +4730,8 @@ class MigrationToolUI:
         customer_persona = state.get("customer_info", {}).get("persona", "")
         
         # Update highlighted components based on persona
-        if customer_persona and customer_persona in PERSONA_STACK_MAPPING:
-            st.session_state.platform_discovery['highlighted_components'] = PERSONA_STACK_MAPPING[customer_persona]
+        if customer_persona and CATALOG.persona_components(customer_persona):
+            st.session_state.platform_discovery['highlighted_components'] = CATALOG.persona_components(customer_persona)
         
         # Cloud tabs
         cloud_tabs = st.tabs(CLOUD_OPTIONS)
@@ -833,16 +4758,18 @@ class MigrationToolUI:
                 </style>
                 """, unsafe_allow_html=True)
                 self.state_manager.move_to_project_data()
+                self._save_editing_state()
                 st.session_state.nav['project_data'] = True
                 self._show_section('project_data')
                 st.rerun()
-
-                # 編集モード時は状態を保存
-                if 'editing_history' in st.session_state and st.session_state.editing_history:
-                    state_id = self.state_manager.get_id()
-                    if state_id:
-                        self.delta_manager.save_state(self.state_manager.get_state())
     
+    @staticmethod
+    def _product_label(name, locations, cloud, component):
+        """Label a product option, noting where a search result is offered when it is not this cloud and component"""
+        if not locations or (cloud, component) in locations:
+            return name
+        return f"{name}（{' / '.join(f'{c}・{k}' for c, k in locations[:2])}）"
+
     def _render_cloud_platform_content(self, cloud, customer_persona):
         """Render the platform content for a specific cloud"""
         state = self.state_manager.get_state()
@@ -880,17 +4807,12 @@ class MigrationToolUI:
         
         # Function to save component data without page refresh
         def save_component_data(component, product, cost, issues, details):
-            # Find existing data for this component
-            existing_data = None
-            for item in platform_data:
-                if item.get("component") == component:
-                    existing_data = item
-                    break
-                    
             # Create or update component data
             component_data = {
                 "component": component,
                 "product": product,
+                # 別名で選ばれても同じ製品として集計できるよう、正式名の製品IDも記録する
+                "product_id": CATALOG.product_search.canonical_id(product),
                 "cost": cost,
                 "issues": issues,
                 "details": details
@@ -910,8 +4832,12 @@ class MigrationToolUI:
         with stack_container:
             st.subheader(f"{cloud}の現在のデータスタック")
             
+            # 記入済みのコンポーネント（ボタンごとにリストを走査しないよう先に集合にする）
+            selected_components = {item.get("component") for item in platform_data}
+            highlighted_components = st.session_state.platform_discovery.get('highlighted_components', frozenset())
+            
             # Render categories and components
-            for category, components in DATA_STACK.items():
+            for category, components in CATALOG.data_stack.items():
                 # Create row with category label and components
                 # Adjust column widths to give more space for buttons
                 cols = st.columns([1.2] + [1] * len(components))
@@ -931,14 +4857,10 @@ class MigrationToolUI:
                             display_name = component.replace("プラットフォーム", "<br>フォーム")
                         
                         # Check if component should be highlighted based on persona
-                        is_highlighted = component in st.session_state.platform_discovery.get('highlighted_components', [])
+                        is_highlighted = component in highlighted_components
                         
                         # Check if component is selected
-                        is_selected = False
-                        for item in platform_data:
-                            if item.get("component") == component:
-                                is_selected = True
-                                break
+                        is_selected = component in selected_components
                                 
                         # Check if this is the currently selected component
                         is_active = st.session_state.platform_selected_component.get(cloud) == component
@@ -978,7 +4900,7 @@ class MigrationToolUI:
                                     }
                                 else:
                                     # Get available products for this component and cloud
-                                    available_products = PRODUCTS_BY_CLOUD.get(cloud, {}).get(component, [])
+                                    available_products = CATALOG.products(cloud, component)
                                     default_product = available_products[0] if available_products else ""
                                     st.session_state.temp_form_data[key][form_key] = {
                                         "product": default_product,
@@ -1032,23 +4954,38 @@ class MigrationToolUI:
                         break
                 
                 # Get available products for this component and cloud
-                available_products = PRODUCTS_BY_CLOUD.get(cloud, {}).get(selected_component, [])
+                available_products = CATALOG.products(cloud, selected_component)
                 
                 # Create a form-like interface but without using st.form to avoid full page rerunning
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    # Product selection
-                    product_index = 0
+                    product = ""
                     if form_key in st.session_state.temp_form_data[key]:
                         product = st.session_state.temp_form_data[key][form_key].get("product", "")
-                        if product in available_products:
-                            product_index = available_products.index(product)
+                    
+                    # 製品名・別名で全製品から検索する（別のクラウドやコンポーネントに載っている製品も選べる）
+                    product_query = st.text_input("製品を検索", key=f"product_search_{form_key}",
+                                                  placeholder="製品名・別名の一部（例: Purview）")
+                    suggestions = CATALOG.product_search.search(product_query, limit=10, cloud=cloud, component=selected_component)
+                    if product_query and not suggestions:
+                        st.caption("一致する製品はありません。")
+                    
+                    if suggestions:
+                        options = [suggestion["name"] for suggestion in suggestions]
+                        locations = {suggestion["name"]: suggestion["locations"] for suggestion in suggestions}
+                    else:
+                        options = list(available_products)
+                        locations = {}
+                    # 記入済みの製品が候補にない場合も選択を保つ
+                    if product and product not in options:
+                        options.insert(0, product)
                     
                     selected_product = st.selectbox(
                         "使用中の製品",
-                        options=available_products,
-                        index=product_index,
+                        options=options,
+                        index=options.index(product) if product in options else 0,
+                        format_func=lambda name: self._product_label(name, locations.get(name), cloud, selected_component),
                         key=f"product_{form_key}"
                     )
                     if form_key in st.session_state.temp_form_data[key]:
@@ -1069,7 +5006,7 @@ class MigrationToolUI:
                         st.session_state.temp_form_data[key][form_key]["cost"] = cost
                 
                 # Common issues multiselect
-                common_issues = COMMON_ISSUES.get(selected_component, [])
+                common_issues = CATALOG.common_issues(selected_component)
                 default_issues = []
                 if form_key in st.session_state.temp_form_data[key]:
                     default_issues = st.session_state.temp_form_data[key][form_key].get("issues", [])
@@ -1443,17 +5380,12 @@ class MigrationToolUI:
             if submit:
                 # 状態を更新
                 self.state_manager.update_project_data(project_data)
+                self._save_editing_state()
                 
                 # 次のセクションへ
                 st.session_state.nav['next_actions'] = True
                 self._show_section('next_actions')
                 st.rerun()
-
-                # 編集モード時は状態を保存
-                if 'editing_history' in st.session_state and st.session_state.editing_history:
-                    state_id = self.state_manager.get_id()
-                    if state_id:
-                        self.delta_manager.save_state(self.state_manager.get_state())
                 
     def render_next_actions_section(self):
         """Render the next actions section"""
@@ -1477,18 +5409,59 @@ class MigrationToolUI:
             if submit:
                 # Update state
                 self.state_manager.update_next_actions(selected_actions)
+                self._save_editing_state()
                 
                 # Enable next section
                 st.session_state.nav['summary'] = True
                 self._show_section('summary')
                 st.rerun()
-
-                # 編集モード時は状態を保存
-                if 'editing_history' in st.session_state and st.session_state.editing_history:
-                    state_id = self.state_manager.get_id()
-                    if state_id:
-                        self.delta_manager.save_state(self.state_manager.get_state())
     
+    def _render_llm_summary(self, state):
+        """Stream the AI summary into the page as it is generated, falling back to the template summary"""
+        # 内容が変わっていなければ、再実行や他のセッションでも生成し直さない
+        key = self.ai_service.llm_summary_key(state)
+        cached = self.ai_service.summary_cache.get(key)
+        if cached is not None:
+            st.session_state.summary = cached["text"]
+            st.markdown(cached["text"])
+            st.caption(cached["caption"])
+            return
+        # 失敗はこのセッションだけで覚えておく（一時的な障害を他のセッションに持ち込まない）
+        failed = st.session_state.get("llm_summary_failure")
+        if failed and failed["key"] == key:
+            st.session_state.summary = failed["text"]
+            st.warning(failed["caption"])
+            if st.button("AIでまとめを再生成", key="regenerate_llm_summary"):
+                del st.session_state.llm_summary_failure
+                st.rerun()
+            st.markdown(failed["text"])
+            return
+        
+        status = st.empty()
+        status.caption("⏳ AIがまとめを生成しています...")
+        body = st.empty()
+        try:
+            with body.container():
+                summary = st.write_stream(self.ai_service.stream_summary(state))
+        except Exception as e:
+            # 失敗した内容で再実行のたびに待たされないよう、再生成ボタンが押されるまで定型のまとめを使う
+            summary = self.ai_service.generate_summary(state)
+            caption = f"AIによるまとめを生成できなかったため、定型のまとめを表示しています: {e}"
+            body.markdown(summary)
+            status.warning(caption)
+            st.session_state.summary = summary
+            st.session_state.llm_summary_failure = {"key": key, "text": summary, "caption": caption}
+            return
+        
+        first_token, total = self.ai_service.last_summary_timings
+        if first_token is None:
+            caption = f"AIが生成したまとめです（すべてのセクションを再利用・全体 {total:.1f} 秒）"
+        else:
+            caption = f"AIが生成したまとめです（最初の応答まで {first_token:.1f} 秒・全体 {total:.1f} 秒）"
+        status.caption(caption)
+        st.session_state.summary = summary
+        self.ai_service.summary_cache.put(key, {"text": summary, "caption": caption})
+
     def render_summary_section(self):
         """Render the summary section"""
         st.header("ヒアリングした結果のまとめ")
@@ -1499,20 +5472,36 @@ class MigrationToolUI:
         # Get state
         state = self.state_manager.get_state()
         
-        # Always regenerate summary to ensure it has the latest data
-        with st.spinner("結果のまとめを生成中..."):
-            summary = self.ai_service.generate_summary(state)
-            st.session_state.summary = summary
-        
-        # Display summary
-        st.markdown("### 結果まとめ")
-        st.markdown(st.session_state.summary)
+        if self.ai_service.llm_enabled:
+            st.markdown("### 結果まとめ")
+            self._render_llm_summary(state)
+        else:
+            # 変更のあったセクションだけ生成し直す
+            with st.spinner("結果のまとめを生成中..."):
+                summary = self.ai_service.generate_summary(state)
+                st.session_state.summary = summary
+            
+            # Display summary
+            st.markdown("### 結果まとめ")
+            st.markdown(st.session_state.summary)
         
         # Display debug information in an expander for troubleshooting
         with st.expander("デバッグ情報", expanded=False):
             st.write("### State Data:")
             st.json(state)
         
+        # 保存済みの場合、イベントログから過去の状態を再構築して確認できる
+        if self.state_manager.get_id() and self.delta_manager and self.delta_manager.ready:
+            with st.expander("変更履歴", expanded=False):
+                events = self.delta_manager.get_state_events(self.state_manager.get_id())
+                if not events:
+                    st.info("変更履歴はありません。")
+                else:
+                    st.dataframe(pd.DataFrame(events), hide_index=True)
+                    seq = st.selectbox("表示するバージョン", options=[e["seq"] for e in events], key="state_version_seq")
+                    if st.button("このバージョンを表示", key="show_state_version"):
+                        st.json(self.delta_manager.get_state_version(self.state_manager.get_id(), seq))
+        
         # Export options
         st.subheader("エクスポート")
         col1, col2 = st.columns(2)
@@ -1538,25 +5527,55 @@ class MigrationToolUI:
 
         # Save to Delta table
         if st.button("ヒアリング結果を保存", key="save_to_delta"):
+            if not self.delta_manager or not self.delta_manager.save_queue:
+                st.error("保存に失敗しました。")
+                return
+                
             with st.spinner("データを保存中..."):
-                state_id = self.delta_manager.save_state(state)
-                if state_id:
-                    self.state_manager.set_id(state_id)
-                    st.success(f"ヒアリング結果を保存しました。ID: {state_id}")
-                else:
-                    st.error("保存に失敗しました。")
+                # 編集中の保存と順序が入れ替わらないよう、同じキューを通して完了を待つ
+                save_queue = self.delta_manager.save_queue
+                writer = self.state_manager.writer_id
+                state_id = save_queue.enqueue(state, events=self.state_manager.drain_events(), snapshot=True, writer=writer)
+                self.state_manager.set_id(state_id)
+                # 接続の停止中は待たずに下書きとして積んでおく
+                status, error = save_queue.wait(state_id, timeout=0 if self.delta_manager.degraded else 30, writer=writer)
+                
+            if status == SaveQueue.SAVED:
+                st.success(f"ヒアリング結果を保存しました。ID: {state_id}")
+            elif status == SaveQueue.PENDING and self.delta_manager.degraded:
+                st.info(f"SQL Warehouseに接続できないため下書きとして保持し、復旧後に保存します。ID: {state_id}")
+            elif status == SaveQueue.PENDING:
+                st.info(f"バックグラウンドで保存中です。ID: {state_id}")
+            elif status == SaveQueue.CONFLICT:
+                st.warning(f"{error}。サイドバーの「変更を統合」から、あなたの変更を最新の内容に統合してください。")
+                st.session_state.editing_history = True
+            else:
+                st.error(f"保存に失敗しました。{error}")
 
 def main():
+    # この再実行で発行されたSQLを集める
+    QueryStats.start_trace()
+    
+    # 設定ファイルに誤りがある場合は、直前に読み込めた設定で動かしたまま知らせる
+    config_error = get_config_watcher(CONFIG_PATH, CONFIG_SNAPSHOT_PATH).error
+    if config_error:
+        st.error(f"設定ファイルの読み込みエラー: {config_error}")
+    
     # Initialize components
     ai_service = AIModelService()
     
-    # Delta Managerの初期化を試みる
+    # 設定で選択された履歴ストアの初期化を試みる
     try:
-        delta_manager = DeltaTableManager(CONFIG)
+        delta_manager = create_history_store(CONFIG)
     except Exception as e:
-        st.error(f"Delta Table管理の初期化エラー: {e}")
+        st.error(f"履歴ストレージの初期化エラー: {e}")
         delta_manager = None
     
+    # 接続先の障害中は、読み取りはキャッシュから、保存は下書きとして続けられることを知らせる
+    if delta_manager and delta_manager.available and delta_manager.degraded:
+        st.warning("SQL Warehouseに接続できないため縮退モードで動作しています。履歴は読み取り専用（直近のキャッシュ）で表示し、"
+                   "編集内容は下書きとして保持して復旧後に自動で保存します。")
+    
     # Initialize state manager if not exists
     if 'state_manager' not in st.session_state:
         st.session_state.state_manager = StateManager()
@@ -1565,7 +5584,7 @@ def main():
     ui = MigrationToolUI(ai_service, st.session_state.state_manager, delta_manager)
     
     # 履歴モードが失敗した場合のフォールバック
-    if not hasattr(ui, 'delta_manager') or not ui.delta_manager or not ui.delta_manager.connection:
+    if not hasattr(ui, 'delta_manager') or not ui.delta_manager or not ui.delta_manager.available:
         if 'current_section' not in st.session_state or st.session_state.current_section == 'history_selection':
             st.session_state.current_section = 'customer_info'
     
@@ -1594,7 +5613,7 @@ def main():
     # Initialize session state for current section if not already initialized
     if 'current_section' not in st.session_state:
         # 接続できない場合はhistory_selectionをスキップする
-        if delta_manager and delta_manager.connection:
+        if delta_manager and delta_manager.available:
             st.session_state.current_section = 'history_selection'
         else:
             st.session_state.current_section = 'customer_info'
@@ -1618,6 +5637,13 @@ def main():
         ui.render_next_actions_section()
     elif current_section == 'summary':
         ui.render_summary_section()
+    elif current_section == 'analytics':
+        ui.render_analytics_section()
+    elif current_section == 'merge_conflict':
+        ui.render_merge_section()
+    
+    if CONFIG.get("QUERY_STATS", {}).get("SHOW_PERFORMANCE_VIEW", True):
+        ui.render_performance_view(QueryStats.stop_trace())
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,239 @@
+"""Benchmark the single-MERGE upsert of history rows against the previous COUNT + UPDATE/INSERT path.
+
+Both paths write the same columns (id, company, record_date, recorder and
+the state as JSON) so that only the statements differ. The full
+HistoryStore.save_state, which also writes the snapshot, the analytical
+tables, the aggregates and the search index, is timed as a separate,
+labelled row for reference.
+
+Run from the repository root against a real SQL warehouse, or against the
+local SQLite backend without one:
+
+    python -m benchmarks.bench_save_state --iterations 20
+    python -m benchmarks.bench_save_state --backend local
+
+A dedicated table (default: migration_tool_history_bench) is created in the
+configured catalog/schema (or local database) and dropped afterwards unless
+--keep is given.
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import app
+
+
+class StatementStats:
+    """Counts statements and SQL text bytes sent through a cursor"""
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_bytes = 0
+
+
+class CountingCursor:
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, operation, parameters=None):
+        self._stats.statements += 1
+        self._stats.sql_bytes += len(operation.encode("utf-8"))
+        if parameters is None:
+            # sqlite3 はパラメータに None を受け付けない
+            return self._cursor.execute(operation)
+        return self._cursor.execute(operation, parameters)
+
+    def executemany(self, operation, seq_of_parameters):
+        self._stats.statements += 1
+        self._stats.sql_bytes += len(operation.encode("utf-8"))
+        return self._cursor.executemany(operation, seq_of_parameters)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def counting(manager, stats):
+    """Route every cursor the manager opens through CountingCursor"""
+    original = manager._cursor
+
+    @contextmanager
+    def _cursor():
+        with original() as cursor:
+            yield CountingCursor(cursor, stats)
+
+    manager._cursor = _cursor
+    try:
+        yield
+    finally:
+        manager._cursor = original
+
+
+def legacy_save_state(manager, state):
+    """The pre-MERGE save path: existence check, then UPDATE or INSERT with inlined values"""
+    if "id" not in state or not state["id"]:
+        state["id"] = str(uuid.uuid4())
+
+    def quote(value):
+        # 旧実装はエスケープしていなかったため、ベンチマークが失敗しないよう最低限のエスケープのみ行う
+        if isinstance(manager, app.LocalHistoryStore):
+            return str(value).replace("'", "''")
+        return str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+    state_id = state["id"]
+    company = quote(state.get("customer_info", {}).get("company", "不明"))
+    recorder = quote(state.get("customer_info", {}).get("writer", "不明"))
+    record_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    state_json = quote(json.dumps(state, ensure_ascii=False))
+
+    with manager._cursor() as cursor:
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM {manager.full_table_name}
+            WHERE id = '{state_id}'
+        """)
+        count = cursor.fetchone()[0]
+
+        if count > 0:
+            cursor.execute(f"""
+                UPDATE {manager.full_table_name}
+                SET company = '{company}',
+                    record_date = '{record_date}',
+                    recorder = '{recorder}',
+                    state_json = '{state_json}'
+                WHERE id = '{state_id}'
+            """)
+        else:
+            cursor.execute(f"""
+                INSERT INTO {manager.full_table_name} (id, company, record_date, recorder, state_json)
+                VALUES ('{state_id}', '{company}', '{record_date}', '{recorder}', '{state_json}')
+            """)
+    return state_id
+
+
+def merge_save_state(manager, state):
+    """The MERGE path alone: one _upsert_records call writing the same columns as legacy_save_state"""
+    if "id" not in state or not state["id"]:
+        state["id"] = str(uuid.uuid4())
+
+    row = {
+        "id": state["id"],
+        "company": state.get("customer_info", {}).get("company", "不明"),
+        "record_date": datetime.now(),
+        "recorder": state.get("customer_info", {}).get("writer", "不明"),
+        "state_json": json.dumps(state, ensure_ascii=False),
+    }
+    with manager._cursor() as cursor:
+        manager._upsert_records(cursor, [row])
+    return state["id"]
+
+
+def make_state(details_chars):
+    """Build a representative engagement with apostrophes in free-text fields"""
+    note = ("Customer's nightly batch doesn't finish; 夜間バッチが終わらない。" * (details_chars // 50 + 1))[:details_chars]
+    return {
+        "customer_info": {
+            "company": "O'Reilly Trading",
+            "writer": "bench",
+            "meeting_date": datetime.now().strftime("%Y-%m-%d"),
+        },
+        "platform_data": {
+            cloud: [
+                {
+                    "component": component,
+                    "product": products[0],
+                    "cost": "1000000",
+                    "issues": app.COMMON_ISSUES.get(component, [])[:2],
+                    "details": note,
+                }
+                for component, products in app.PRODUCTS_BY_CLOUD.get(cloud, {}).items()
+            ]
+            for cloud in app.CLOUD_OPTIONS
+        },
+        "project_data": {"additional_info": note},
+        "next_actions": app.NEXT_ACTION_OPTIONS[:2],
+        "current_step": "summary",
+        "current_cloud": "AWS",
+    }
+
+
+def run(label, save, manager, iterations, details_chars):
+    stats = StatementStats()
+    timings = []
+    with counting(manager, stats):
+        for _ in range(iterations):
+            # 新規保存と既存レコードの更新を交互に計測する
+            state = make_state(details_chars)
+            start = time.perf_counter()
+            save(state)
+            timings.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            save(state)
+            timings.append(time.perf_counter() - start)
+
+    saves = len(timings)
+    timings.sort()
+    return {
+        "label": label,
+        "saves": saves,
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95) - 1] * 1000,
+        "statements_per_save": stats.statements / saves,
+        "sql_bytes_per_save": stats.sql_bytes / saves,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--details-chars", type=int, default=2000, help="length of each free-text field")
+    parser.add_argument("--backend", choices=["delta", "local"], default=None,
+                        help="storage backend (default: STORAGE.BACKEND in config.yaml)")
+    parser.add_argument("--table", default="migration_tool_history_bench")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark table afterwards")
+    args = parser.parse_args()
+
+    config = copy.deepcopy(app.CONFIG)
+    config["DELTA_TABLE"]["TABLE_NAME"] = args.table
+    if args.backend:
+        config.setdefault("STORAGE", {})["BACKEND"] = args.backend
+        os.environ.pop("STORAGE_BACKEND", None)
+    manager = app.create_history_store(config)
+    if not manager.available:
+        raise SystemExit("履歴ストレージに接続できないため、ベンチマークを実行できません。")
+    # テーブルはバックグラウンドのウォームアップで作成される
+    manager.wait_until_ready()
+
+    try:
+        results = [
+            run("legacy (COUNT + UPDATE/INSERT)", lambda s: legacy_save_state(manager, s), manager, args.iterations, args.details_chars),
+            run("MERGE (bound parameters)", lambda s: merge_save_state(manager, s), manager, args.iterations, args.details_chars),
+            # 参考: イベント・スナップショット・分析用テーブル・索引まで含めた保存全体（MERGE単体の比較ではない）
+            run("full save_state (reference)", manager.save_state, manager, args.iterations, args.details_chars),
+        ]
+    finally:
+        if not args.keep:
+            with manager._cursor() as cursor:
+                for suffix in [""] + app.DERIVED_TABLE_SUFFIXES:
+                    cursor.execute(f"DROP TABLE IF EXISTS {manager.full_table_name}{suffix}")
+                # 次回実行時にマイグレーションが再適用されるようバージョン記録も消す
+                cursor.execute(f"""
+                    DELETE FROM {manager.version_table_name}
+                    WHERE table_name = :table_name
+                """, {"table_name": manager.full_table_name})
+
+    print(f"{'path':<32} {'saves':>6} {'median ms':>10} {'p95 ms':>10} {'stmts/save':>11} {'SQL bytes/save':>15}")
+    for r in results:
+        print(f"{r['label']:<32} {r['saves']:>6} {r['median_ms']:>10.1f} {r['p95_ms']:>10.1f} "
+              f"{r['statements_per_save']:>11.1f} {r['sql_bytes_per_save']:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Benchmark the stored state encodings: legacy JSON text against the binary envelope.
+
+No warehouse is needed:
+
+    python -m benchmarks.bench_state_encoding --iterations 200
+
+For each free-text size, prints the stored size, the size sent when
+writing to Delta (the envelope is bound as Base64 text), and the median
+encode/decode time.
+"""
+import argparse
+import base64
+import json
+import statistics
+import time
+
+import app
+from benchmarks.bench_save_state import make_state
+
+
+def legacy_encode(state):
+    return json.dumps(state, ensure_ascii=False)
+
+
+def measure(function, value, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(value)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--details-chars", type=int, nargs="+", default=[0, 500, 2000, 10000],
+                        help="length of each free-text field; one row per value")
+    args = parser.parse_args()
+
+    print(f"{'details':>8} {'format':<9} {'stored bytes':>13} {'write bytes':>12} {'encode ms':>10} {'decode ms':>10}")
+    for details_chars in args.details_chars:
+        state = make_state(details_chars)
+
+        legacy = legacy_encode(state)
+        legacy_bytes = len(legacy.encode("utf-8"))
+        envelope = app.encode_state(state)
+        assert app.decode_state(envelope) == app.decode_state(legacy) == state
+
+        rows = [
+            ("json", legacy_bytes, legacy_bytes,
+             measure(legacy_encode, state, args.iterations), measure(json.loads, legacy, args.iterations)),
+            ("envelope", len(envelope), len(base64.b64encode(envelope)),
+             measure(app.encode_state, state, args.iterations), measure(app.decode_state, envelope, args.iterations)),
+        ]
+        for label, stored, written, encode_ms, decode_ms in rows:
+            print(f"{details_chars:>8} {label:<9} {stored:>13} {written:>12} {encode_ms:>10.3f} {decode_ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Headless commands for the DiscoveryDojo history store and configuration.
+
+Run from the repository root (connection settings come from the same
+environment variables and config.yaml as the app):
+
+    python cli.py export history.jsonl
+    python cli.py export history.parquet
+    python cli.py import history.jsonl --backend local
+    python cli.py maintain --retention-hours 168
+    python cli.py build-config
+    python cli.py report reports --recorder 山田 --date-from 2025-04-01 --format html
+"""
+import argparse
+import copy
+import html
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime
+from itertools import islice
+
+import app
+
+
+EXPORT_FORMATS = ["jsonl", "parquet"]
+REPORT_FORMATS = ["md", "html"]
+
+HTML_REPORT = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+</head>
+<body>
+{body}</body>
+</html>
+"""
+
+
+def detect_format(path, fmt=None):
+    """Return fmt, or infer it from the file extension"""
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension not in EXPORT_FORMATS:
+        raise SystemExit(f"出力形式を判別できません: {path}（--format で指定してください）")
+    return extension
+
+
+def open_store(backend=None):
+    """Create the configured history store, optionally overriding the backend"""
+    config = copy.deepcopy(app.CONFIG)
+    if backend:
+        config.setdefault("STORAGE", {})["BACKEND"] = backend
+        os.environ.pop("STORAGE_BACKEND", None)
+    store = app.create_history_store(config)
+    if not store.available:
+        raise SystemExit("履歴ストレージに接続できません。")
+    # 接続とスキーマの準備はバックグラウンドで進むため、完了を待ってから使う
+    if not store.wait_until_ready(timeout=1):
+        print("SQL Warehouseの起動を待っています...", file=sys.stderr)
+        if not store.wait_until_ready(timeout=app.CONFIG["DELTA_TABLE"].get("CONNECT_TIMEOUT_SECONDS", 30) * 10):
+            raise SystemExit(f"履歴ストレージの準備ができませんでした: {store.warmup.error}")
+    return store
+
+
+def chunks(iterable, size):
+    """Yield lists of up to size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet形式には pyarrow が必要です。")
+    return pyarrow, pyarrow.parquet
+
+
+def _parquet_schema(pa):
+    # 状態はスキーマの変化に追従できるようJSON文字列の列で持つ
+    return pa.schema([
+        ("id", pa.string()),
+        ("company", pa.string()),
+        ("record_date", pa.timestamp("us")),
+        ("recorder", pa.string()),
+        ("state", pa.string()),
+    ])
+
+
+def export_history(store, path, fmt, chunk_size=500):
+    """Stream every record of store into path; returns the number of records written"""
+    count = 0
+    records = store.iter_records(chunk_size)
+    if fmt == "jsonl":
+        with open(path, "w", encoding="utf-8") as file:
+            for record in records:
+                record_date = record["record_date"]
+                file.write(json.dumps(dict(record, record_date=record_date.isoformat() if record_date else None),
+                                      ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+    pa, pq = _parquet()
+    schema = _parquet_schema(pa)
+    with pq.ParquetWriter(path, schema) as writer:
+        # チャンクごとに1つの行グループとして書き出す
+        for chunk in chunks(records, chunk_size):
+            columns = {name: [] for name in schema.names}
+            for record in chunk:
+                for name in ["id", "company", "record_date", "recorder"]:
+                    columns[name].append(record[name])
+                columns["state"].append(json.dumps(record["state"], ensure_ascii=False))
+            writer.write_table(pa.table(columns, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def read_history(path, fmt, chunk_size=500):
+    """Yield the records of an export file without loading it whole"""
+    if fmt == "jsonl":
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record_date = record.get("record_date")
+                record["record_date"] = datetime.fromisoformat(record_date) if record_date else None
+                yield record
+        return
+
+    _, pq = _parquet()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        for record in batch.to_pylist():
+            record["state"] = json.loads(record["state"])
+            yield record
+
+
+def import_history(store, path, fmt, batch_size=100):
+    """Write every record of an export file into store; returns the number of records imported"""
+    return store.import_records(read_history(path, fmt, batch_size), batch_size)
+
+
+def time_history_listing(store, runs=5):
+    """Time the first page of the history list, bypassing the cache; returns (median ms, min ms)"""
+    page_size = app.CONFIG["DELTA_TABLE"].get("HISTORY_PAGE_SIZE", 20)
+    timings = []
+    for _ in range(runs):
+        store.history_cache.invalidate()
+        start = time.perf_counter()
+        store.get_history_page(page_size)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), min(timings)
+
+
+def print_table_stats(stats):
+    print(f"{'table':<60} {'files':>8} {'MB':>10}")
+    for row in stats:
+        files = "-" if row["files"] is None else row["files"]
+        print(f"{row['table']:<60} {files:>8} {row['bytes'] / 1024 / 1024:>10.2f}")
+
+
+def maintain_history(store, retention_hours, rebuild_aggregates=True, purge=True, optimize=True, vacuum=True,
+                     timing_runs=5):
+    """Recount, compact and clean up the history tables, reporting table stats and list query timings before and after"""
+    print("== 実行前 ==")
+    print_table_stats(store.table_stats())
+    before = time_history_listing(store, timing_runs)
+    print(f"履歴一覧の取得: 中央値 {before[0]:.1f} ms / 最小 {before[1]:.1f} ms", file=sys.stderr)
+
+    # 集計の数え直し → 削除済み行の除去 → 小さなファイルの統合・クラスタリング → 不要になった古いファイルの削除、の順に行う
+    steps = [
+        ("集計テーブルの再集計", rebuild_aggregates, store.rebuild_aggregates),
+        ("削除済み行の除去", purge, store.purge_deleted_rows),
+        ("OPTIMIZE", optimize, store.optimize_tables),
+        (f"VACUUM（保持期間 {retention_hours} 時間）", vacuum, lambda: store.vacuum_tables(retention_hours)),
+    ]
+    for label, enabled, step in steps:
+        if not enabled:
+            continue
+        start = time.perf_counter()
+        step()
+        print(f"{label}: {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+
+    print("== 実行後 ==")
+    print_table_stats(store.table_stats())
+    after = time_history_listing(store, timing_runs)
+    print(f"履歴一覧の取得: 中央値 {after[0]:.1f} ms / 最小 {after[1]:.1f} ms", file=sys.stderr)
+    return before, after
+
+
+def _markdown_renderer():
+    try:
+        from markdown_it import MarkdownIt
+    except ImportError:
+        raise SystemExit("HTML形式には markdown-it-py が必要です。")
+    return MarkdownIt()
+
+
+# レポート作成プロセスごとに一度だけ用意するもの（まとめの生成とHTMLへの変換）
+_report_worker = {}
+
+
+def _init_report_worker(fmt):
+    _report_worker["ai_service"] = app.AIModelService()
+    _report_worker["render_html"] = _markdown_renderer().render if fmt == "html" else None
+
+
+def report_filename(record, fmt):
+    """File name of a record's report: the company name made safe for file systems, then the record id"""
+    company = re.sub(r'[\\/:*?"<>|\s]+', "_", record["company"] or "").strip("_") or "unknown"
+    return f"{company}_{record['id']}.{fmt}"
+
+
+def render_reports(records, output_dir, fmt):
+    """Write the summary report of each record into output_dir; runs in a worker process"""
+    ai_service = _report_worker["ai_service"]
+    for record in records:
+        report = ai_service.generate_summary(record["state"])
+        if fmt == "html":
+            report = HTML_REPORT.format(title=html.escape(record["company"] or ""),
+                                        body=_report_worker["render_html"](report))
+        with open(os.path.join(output_dir, report_filename(record, fmt)), "w", encoding="utf-8") as file:
+            file.write(report)
+    return len(records)
+
+
+def generate_reports(records, output_dir, fmt, workers=None, batch_size=20):
+    """Render the summary of every record into output_dir in a process pool; returns (count, seconds)
+
+    Records are handed to the workers batch_size at a time while they are
+    still being read, with at most two batches per worker in flight.
+    """
+    workers = workers or os.cpu_count() or 1
+    if fmt == "html":
+        # 依存ライブラリがなければワーカーを起動する前に止める
+        _markdown_renderer()
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_report_worker, initargs=(fmt,)) as pool:
+        pending = set()
+        for batch in chunks(records, batch_size):
+            pending.add(pool.submit(render_reports, batch, output_dir, fmt))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                count += sum(future.result() for future in done)
+        count += sum(future.result() for future in pending)
+    return count, time.perf_counter() - start
+
+
+def build_config(path, snapshot_path):
+    """Validate the config file and write the snapshot the app loads at start-up"""
+    try:
+        config = app.build_config_snapshot(path, snapshot_path)
+    except app.ConfigError as e:
+        for problem in e.problems:
+            print(problem, file=sys.stderr)
+        raise SystemExit(f"{path} に {len(e.problems)} 件の誤りがあるため、スナップショットを作成しませんでした。")
+    print(f"{path} を検証し、{snapshot_path} を作成しました（{len(config)} 項目）。", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["delta", "local"], default=None,
+                        help="storage backend (default: STORAGE.BACKEND in config.yaml)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="export every engagement to JSONL or Parquet")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default=None, help="default: from the file extension")
+    export_parser.add_argument("--chunk-size", type=int, default=500, help="rows fetched per round trip")
+
+    import_parser = subparsers.add_parser("import", help="import engagements from an export file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=EXPORT_FORMATS, default=None, help="default: from the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=100, help="engagements written per round of statements (one transaction on the local backend)")
+
+    maintenance_config = app.CONFIG.get("MAINTENANCE", {})
+    maintain_parser = subparsers.add_parser("maintain", help="compact, recluster and vacuum the history tables")
+    maintain_parser.add_argument("--retention-hours", type=int,
+                                 default=maintenance_config.get("VACUUM_RETENTION_HOURS", 168),
+                                 help="VACUUM keeps files younger than this (default: MAINTENANCE.VACUUM_RETENTION_HOURS)")
+    maintain_parser.add_argument("--skip-rebuild-aggregates", action="store_true",
+                                 help="do not recount the aggregate tables")
+    maintain_parser.add_argument("--skip-purge", action="store_true", help="do not purge deleted rows")
+    maintain_parser.add_argument("--skip-optimize", action="store_true", help="do not run OPTIMIZE")
+    maintain_parser.add_argument("--skip-vacuum", action="store_true", help="do not run VACUUM")
+    maintain_parser.add_argument("--timing-runs", type=int, default=maintenance_config.get("TIMING_RUNS", 5),
+                                 help="history list queries timed before and after")
+
+    report_parser = subparsers.add_parser("report", help="write the summary of each engagement as Markdown or HTML")
+    report_parser.add_argument("output_dir")
+    report_parser.add_argument("--format", choices=REPORT_FORMATS, default="md")
+    report_parser.add_argument("--company", default=None, help="only engagements whose company contains this")
+    report_parser.add_argument("--recorder", default=None, help="only engagements whose recorder contains this")
+    report_parser.add_argument("--date-from", type=date.fromisoformat, default=None, help="first save date (YYYY-MM-DD; record_date, not the meeting date)")
+    report_parser.add_argument("--date-to", type=date.fromisoformat, default=None, help="last save date (YYYY-MM-DD; record_date, not the meeting date)")
+    report_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    report_parser.add_argument("--batch-size", type=int, default=20, help="engagements rendered per worker task")
+    report_parser.add_argument("--chunk-size", type=int, default=500, help="rows fetched per round trip")
+
+    build_parser = subparsers.add_parser("build-config", help="validate config.yaml and write its start-up snapshot")
+    build_parser.add_argument("--config", default=app.CONFIG_PATH)
+    build_parser.add_argument("--output", default=app.CONFIG_SNAPSHOT_PATH)
+
+    args = parser.parse_args()
+    if args.command == "build-config":
+        # 履歴ストレージには接続しない
+        build_config(args.config, args.output)
+        return
+
+    store = open_store(args.backend)
+
+    if args.command == "export":
+        count = export_history(store, args.path, detect_format(args.path, args.format), args.chunk_size)
+        print(f"{count} 件を {args.path} に出力しました。", file=sys.stderr)
+    elif args.command == "import":
+        count = import_history(store, args.path, detect_format(args.path, args.format), args.batch_size)
+        print(f"{count} 件を {args.path} から取り込みました。", file=sys.stderr)
+    elif args.command == "maintain":
+        maintain_history(store, args.retention_hours, rebuild_aggregates=not args.skip_rebuild_aggregates,
+                         purge=not args.skip_purge, optimize=not args.skip_optimize,
+                         vacuum=not args.skip_vacuum, timing_runs=args.timing_runs)
+    elif args.command == "report":
+        records = store.iter_records(args.chunk_size, company=args.company, recorder=args.recorder,
+                                     date_from=args.date_from, date_to=args.date_to)
+        count, seconds = generate_reports(records, args.output_dir, args.format, args.workers, args.batch_size)
+        rate = count / seconds if seconds else 0
+        print(f"{count} 件のレポートを {args.output_dir} に出力しました（{seconds:.1f} 秒・{rate:.1f} 件/秒）。",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
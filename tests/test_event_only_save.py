@@ -0,0 +1,52 @@
+"""Event-only saves must keep the analytical tables and the search index current."""
+import copy
+
+import app
+
+
+def make_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("LOCAL_HISTORY_PATH", str(tmp_path / "history.db"))
+    config = copy.deepcopy(app.CONFIG)
+    config.setdefault("STORAGE", {})["BACKEND"] = "local"
+    store = app.LocalHistoryStore(config)
+    # スキーマはバックグラウンドのウォームアップで作成される
+    assert store.wait_until_ready(timeout=30)
+    return store
+
+
+def test_event_only_save_refreshes_search_and_engagements(tmp_path, monkeypatch):
+    store = make_store(tmp_path, monkeypatch)
+    manager = app.StateManager()
+    manager.update_customer_info({"company": "テスト株式会社", "writer": "山田", "meeting_date": "2025-01-01"})
+    state_id = store._write_state(manager.get_state(), events=manager.drain_events(), snapshot=True)
+
+    manager.update_customer_info({"company": "別会社", "writer": "山田", "meeting_date": "2025-01-01"})
+    events = manager.drain_events()
+    store._write_state(manager.get_state(), events=events)
+
+    # スナップショット間隔に達していない、イベントだけの保存であること
+    with store._cursor() as cursor:
+        cursor.execute(f"SELECT snapshot_seq, head_seq FROM {store.full_table_name} WHERE id = :id", {"id": state_id})
+        snapshot_seq, head_seq = cursor.fetchone()
+        cursor.execute(f"SELECT company FROM {store.full_table_name}_engagements WHERE id = :id", {"id": state_id})
+        company = cursor.fetchone()[0]
+    assert snapshot_seq < head_seq
+
+    assert company == "別会社"
+    assert [row["id"] for row in store.search_history("別会社")] == [state_id]
+    assert store.search_history("テスト株式会社") == []
+
+
+def test_event_only_save_keeps_untouched_aggregates(tmp_path, monkeypatch):
+    store = make_store(tmp_path, monkeypatch)
+    manager = app.StateManager()
+    manager.update_customer_info({"company": "テスト株式会社", "writer": "山田", "meeting_date": "2025-01-01"})
+    manager.update_platform_data([{"component": "ジョブ管理", "product": "AWS Step Functions", "issues": []}], "AWS")
+    store._write_state(manager.get_state(), events=manager.drain_events(), snapshot=True)
+
+    manager.update_next_actions(["製品デモ"])
+    store._write_state(manager.get_state(), events=manager.drain_events())
+
+    analytics = store.get_analytics()
+    assert [(row["product"], row["engagements"]) for row in analytics["products"]] == [("AWS Step Functions", 1)]
+    assert [(row["action"], row["engagements"]) for row in analytics["next_actions"]] == [("製品デモ", 1)]